@@ -2,10 +2,132 @@
 #define ___COMMAND_PACKET_HANDLER__H___
 
 
+#include <string.h>
 #include <CArrayDefs.h>
 #include <PacketWriter.h>
 
 
+/* Reserved command code of a batch request. */
+static const uint16_t CMD_BATCH = 0xFFFF;
+/* Record length in a batch response marking a failed command. */
+static const uint16_t BATCH_RECORD_ERROR = 0xFFFF;
+/* Reserved command codes to start/stop streaming the result of a command
+ * (see `CommandPacketHandler::poll_streams`). */
+static const uint16_t CMD_STREAM_START = 0xFFFE;
+static const uint16_t CMD_STREAM_STOP = 0xFFFD;
+
+/* Reserved command code of a fragment of a request too large for a single
+ * packet (see `CommandPacketHandler::process_chunk`). */
+static const uint16_t CMD_CHUNK = 0xFFFC;
+
+/* Reserved command code of a request to send the result of a command in
+ * several packets (see `CommandPacketHandler::process_chunked_response`). */
+static const uint16_t CMD_CHUNKED_RESPONSE = 0xFFFB;
+
+/* Chunked requests and streams reserve RAM for their buffers, so both are
+ * disabled by default.  To opt in, define the macros below before including
+ * this header (or with compiler flags, e.g., `-DRPC_CHUNK_BUFFER_SIZE=256
+ * -DRPC_MAX_STREAMS=2`), and set the matching `MAX_REQUEST_SIZE` attribute
+ * of the Python `Proxy`.  Reserved RAM is `RPC_CHUNK_BUFFER_SIZE + 2` bytes
+ * for chunked requests and `RPC_MAX_STREAMS * (RPC_STREAM_BUFFER_SIZE + 12)
+ * + RPC_STREAM_BUFFER_SIZE` bytes for streams. */
+
+/* Size of buffer to reassemble chunked requests in, i.e., the maximum size of
+ * a request (0: chunked requests are disabled). */
+#ifndef RPC_CHUNK_BUFFER_SIZE
+#define RPC_CHUNK_BUFFER_SIZE 0
+#endif
+
+/* Maximum number of concurrent streams (0: streaming is disabled). */
+#ifndef RPC_MAX_STREAMS
+#define RPC_MAX_STREAMS 0
+#endif
+/* Size of buffer for the serialized request (and response) of each stream
+ * command. */
+#ifndef RPC_STREAM_BUFFER_SIZE
+#define RPC_STREAM_BUFFER_SIZE 32
+#endif
+
+
+struct CommandStream {
+  /* Stream identifier (sent as the `iuid` of each stream packet), or 0 if
+   * the slot is unused. */
+  uint16_t id;
+  /* Minimum number of milliseconds between results (0: every poll). */
+  uint32_t interval_ms;
+  uint32_t last_ms;
+  uint16_t request_length;
+  uint8_t request[RPC_STREAM_BUFFER_SIZE];
+};
+
+
+/* # `process_batch_with_processor` #
+ *
+ * Process a batch request, i.e., a payload containing `CMD_BATCH` followed by
+ * one or more records, each a `uint16_t` length followed by a serialized
+ * command request.
+ *
+ * Commands are processed in order and the response of each command is
+ * written to the packet buffer as a record: a `uint16_t` length followed by
+ * the response data (or a length of `BATCH_RECORD_ERROR` if the command
+ * failed).
+ *
+ * To allow responses to be written from the start of the buffer, the
+ * requests are first moved to the end of the buffer.  Processing stops early
+ * if a response would overwrite requests that have not been processed yet. */
+template <typename Packet, typename Processor>
+UInt8Array process_batch_with_processor(Packet &packet,
+                                        Processor &processor) {
+    uint8_t *buffer = packet.payload_buffer_;
+    const uint16_t buffer_size = packet.buffer_size_;
+    const uint16_t requests_length = packet.payload_length_ - sizeof(uint16_t);
+    uint16_t read_offset = buffer_size - requests_length;
+    uint16_t write_offset = 0;
+
+    memmove(&buffer[read_offset], &buffer[sizeof(uint16_t)], requests_length);
+
+    while (read_offset + sizeof(uint16_t) <= buffer_size) {
+      uint16_t record_length;
+      memcpy(&record_length, &buffer[read_offset], sizeof(record_length));
+      read_offset += sizeof(uint16_t);
+      if (record_length < sizeof(uint16_t) ||
+          read_offset + record_length > buffer_size) { break; }
+
+      UInt8Array request;
+      request.data = &buffer[read_offset];
+      request.length = record_length;
+      read_offset += record_length;
+
+      /* Space available for the response, up to the start of the next
+       * request. */
+      UInt8Array output;
+      output.data = &buffer[write_offset + sizeof(uint16_t)];
+      output.length = read_offset - write_offset - sizeof(uint16_t);
+
+      UInt8Array result = processor.process_command(request, output);
+      if (result.data == NULL) {
+        record_length = BATCH_RECORD_ERROR;
+        result.length = 0;
+      } else if (result.length > output.length) {
+        /* Response does not fit in buffer. */
+        break;
+      } else {
+        record_length = result.length;
+        if (result.data != output.data) {
+          memmove(output.data, result.data, result.length);
+        }
+      }
+      memcpy(&buffer[write_offset], &record_length, sizeof(record_length));
+      write_offset += sizeof(uint16_t) + result.length;
+    }
+
+    UInt8Array result;
+    result.data = buffer;
+    result.length = write_offset;
+    return result;
+}
+
+
 /* # `process_packet` # */
 template <typename Packet, typename Processor>
 UInt8Array process_packet_with_processor(Packet &packet,
@@ -14,7 +136,11 @@ UInt8Array process_packet_with_processor(Packet &packet,
 
     UInt8Array result;
     if (packet.type() == Packet::packet_type::DATA &&
-        payload_bytes_to_process > 0) {
+        payload_bytes_to_process >= sizeof(uint16_t) &&
+        *reinterpret_cast<uint16_t *>(packet.payload_buffer_) == CMD_BATCH) {
+      result = process_batch_with_processor(packet, processor);
+    } else if (packet.type() == Packet::packet_type::DATA &&
+               payload_bytes_to_process > 0) {
 #if defined (SERIAL_DEBUG) && defined (DISABLE_SERIAL)
       /* Dump packet payload bytes as hex characters. */
       for (int i = 0; i < packet.payload_length_; i++) {
@@ -55,19 +181,263 @@ class CommandPacketHandler {
    * data is no longer than `packet.buffer_size_`.
    *
    * If no response should be sent, the type of the packet must be set to
-   * `Packet::packet_type::NONE`. */
+   * `Packet::packet_type::NONE`.
+   *
+   * The interface unique identifier (`iuid_`) of the request packet is
+   * echoed in the response packet, such that the host may match responses
+   * to requests when several requests are in flight (i.e., pipelined).
+   *
+   * The host may also request the result of a command to be streamed, i.e.,
+   * sent periodically as unsolicited `STREAM` packets tagged with a stream
+   * id (see `process_stream_command` and `poll_streams`). */
   public:
 
   OStream &ostream_;
   CommandProcessor &command_processor_;
+#if RPC_MAX_STREAMS > 0
+  CommandStream streams_[RPC_MAX_STREAMS];
+  uint8_t stream_buffer_[RPC_STREAM_BUFFER_SIZE];
+#endif
+#if RPC_CHUNK_BUFFER_SIZE > 0
+  uint8_t chunk_buffer_[RPC_CHUNK_BUFFER_SIZE];
+  /* Number of bytes of the chunked request received so far. */
+  uint16_t chunk_received_;
+#endif
 
   CommandPacketHandler(OStream &ostream, CommandProcessor &command_processor)
-    : ostream_(ostream), command_processor_(command_processor) {}
+    : ostream_(ostream), command_processor_(command_processor) {
+#if RPC_MAX_STREAMS > 0
+    for (uint8_t i = 0; i < RPC_MAX_STREAMS; i++) { streams_[i].id = 0; }
+#endif
+#if RPC_CHUNK_BUFFER_SIZE > 0
+    chunk_received_ = 0;
+#endif
+  }
+
+  template <typename Packet>
+  UInt8Array process_chunk(Packet &packet) {
+    /* Process a fragment of a request too large for a single packet.
+     *
+     * Payload: `CMD_CHUNK`, offset of the fragment in the request
+     * (`uint16_t`), total length of the request (`uint16_t`) and the
+     * fragment data.
+     *
+     * Fragments must be received in order (a fragment with offset 0 starts a
+     * new request) and are reassembled in `chunk_buffer_`.  Each fragment is
+     * acknowledged with an empty response, except the last, which is
+     * answered with the response of the reassembled command.  Returns a
+     * `NULL` result if a fragment is out of order or the request is too
+     * large. */
+    UInt8Array result;
+    result.data = NULL;
+    result.length = 0xffff;
+#if RPC_CHUNK_BUFFER_SIZE > 0
+    const uint8_t header_length = 3 * sizeof(uint16_t);
+    if (packet.payload_length_ < header_length) { return result; }
+    uint16_t offset;
+    uint16_t total_length;
+    memcpy(&offset, &packet.payload_buffer_[2], sizeof(offset));
+    memcpy(&total_length, &packet.payload_buffer_[4], sizeof(total_length));
+    const uint16_t length = packet.payload_length_ - header_length;
+    if (offset == 0) { chunk_received_ = 0; }
+    if (offset != chunk_received_ || total_length > RPC_CHUNK_BUFFER_SIZE ||
+        offset + length > total_length) {
+      /* Fragment out of order (e.g., previous fragment lost) or request too
+       * large, so drop the request. */
+      chunk_received_ = 0;
+      return result;
+    }
+    memcpy(&chunk_buffer_[offset], &packet.payload_buffer_[header_length],
+           length);
+    chunk_received_ += length;
+    if (chunk_received_ < total_length) {
+      result.data = packet.payload_buffer_;
+      result.length = 0;
+      return result;
+    }
+    chunk_received_ = 0;
+    UInt8Array request;
+    request.data = chunk_buffer_;
+    request.length = total_length;
+    UInt8Array buffer;
+    buffer.data = chunk_buffer_;
+    buffer.length = sizeof(chunk_buffer_);
+    result = command_processor_.process_command(request, buffer);
+#endif
+    return result;
+  }
+
+  template <typename Packet>
+  void process_chunked_response(Packet &packet) {
+    /* Process a command and send its result as a sequence of packets, e.g.,
+     * to return an array larger than the packet buffer (or the receive
+     * buffer of the host).
+     *
+     * Payload: `CMD_CHUNKED_RESPONSE`, maximum chunk size in bytes
+     * (`uint16_t`, 0 for the largest packet) and the serialized command request.
+     *
+     * A `DATA` packet with the total length of the result (`uint32_t`) is
+     * sent first, followed by one `DATA` packet per chunk of the result, all
+     * tagged with the `iuid` of the request.  Chunks are written directly
+     * from the result (e.g., a sample buffer in device memory) without
+     * copying.  A `NACK` packet is sent if the command fails. */
+    const uint8_t header_length = 2 * sizeof(uint16_t);
+    FixedPacket result_packet;
+    result_packet.iuid_ = packet.iuid_;
+    UInt8Array result;
+    result.data = NULL;
+    uint16_t chunk_size = 0;
+    if (packet.payload_length_ > header_length) {
+      memcpy(&chunk_size, &packet.payload_buffer_[sizeof(uint16_t)],
+             sizeof(chunk_size));
+      /* Process request in place, from the start of the packet buffer. */
+      UInt8Array request;
+      request.data = packet.payload_buffer_;
+      request.length = packet.payload_length_ - header_length;
+      memmove(request.data, &packet.payload_buffer_[header_length],
+              request.length);
+      UInt8Array buffer;
+      buffer.data = packet.payload_buffer_;
+      buffer.length = packet.buffer_size_;
+      result = command_processor_.process_command(request, buffer);
+    }
+    if (result.data == NULL) {
+      result_packet.type(FixedPacket::packet_type::NACK);
+      result_packet.payload_length_ = 0;
+      write_packet(ostream_, result_packet);
+      return;
+    }
+    uint32_t length = result.length;
+    result_packet.reset_buffer(sizeof(length),
+                               reinterpret_cast<uint8_t *>(&length));
+    result_packet.payload_length_ = sizeof(length);
+    result_packet.type(FixedPacket::packet_type::DATA);
+    write_packet(ostream_, result_packet);
+    /* Payload length of a packet is limited to 16 bits. */
+    if (chunk_size == 0) { chunk_size = 0xFFFF; }
+    for (uint32_t offset = 0; offset < length; offset += chunk_size) {
+      const uint16_t size = (length - offset < chunk_size) ? length - offset
+                                                           : chunk_size;
+      result_packet.reset_buffer(size, &result.data[offset]);
+      result_packet.payload_length_ = size;
+      result_packet.type(FixedPacket::packet_type::DATA);
+      write_packet(ostream_, result_packet);
+    }
+  }
+
+  template <typename Packet>
+  UInt8Array process_stream_command(Packet &packet, uint16_t command) {
+    /* Start or stop a stream.
+     *
+     * Start payload: `CMD_STREAM_START`, stream id (`uint16_t`), interval in
+     * milliseconds (`uint32_t`) and the serialized command request.
+     *
+     * Stop payload: `CMD_STREAM_STOP` and stream id (`uint16_t`).
+     *
+     * Returns an empty response on success, or a `NULL` result if the stream
+     * could not be started (e.g., no free slot or request too long). */
+    UInt8Array result;
+    result.data = NULL;
+    result.length = 0xffff;
+#if RPC_MAX_STREAMS > 0
+    const uint8_t header_length = 2 * sizeof(uint16_t);
+    if (packet.payload_length_ < header_length) { return result; }
+    uint16_t id;
+    memcpy(&id, &packet.payload_buffer_[sizeof(uint16_t)], sizeof(id));
+    const uint8_t start_length = header_length + sizeof(uint32_t);
+    if (command == CMD_STREAM_START &&
+        (id == 0 || packet.payload_length_ <= start_length ||
+         packet.payload_length_ - start_length > RPC_STREAM_BUFFER_SIZE)) {
+      /* Invalid request, so an existing stream with the same id (if any)
+       * keeps running. */
+      return result;
+    }
+    /* Slot of existing stream with the same id (i.e., restart/stop), or
+     * else the first free slot. */
+    CommandStream *slot = NULL;
+    for (uint8_t i = 0; i < RPC_MAX_STREAMS; i++) {
+      if (streams_[i].id == id) {
+        slot = &streams_[i];
+        break;
+      } else if (slot == NULL && streams_[i].id == 0) {
+        slot = &streams_[i];
+      }
+    }
+    if (command == CMD_STREAM_STOP) {
+      if (slot != NULL) { slot->id = 0; }
+    } else {
+      if (slot == NULL) { return result; }
+      memcpy(&slot->interval_ms, &packet.payload_buffer_[header_length],
+             sizeof(uint32_t));
+      slot->request_length = packet.payload_length_ - start_length;
+      memcpy(slot->request, &packet.payload_buffer_[start_length],
+             slot->request_length);
+      /* Emit first result on next poll. */
+      slot->last_ms = 0;
+      slot->id = id;
+    }
+    result.data = packet.payload_buffer_;
+    result.length = 0;
+#endif
+    return result;
+  }
+
+  void poll_streams(uint32_t now_ms) {
+    /* Process the request of each stream that is due and write the result as
+     * a `STREAM` packet, with the stream id as the `iuid`.
+     *
+     * Call on every iteration of the main loop (e.g.,
+     * `handler.poll_streams(millis())`). */
+#if RPC_MAX_STREAMS > 0
+    for (uint8_t i = 0; i < RPC_MAX_STREAMS; i++) {
+      CommandStream &stream = streams_[i];
+      if (stream.id == 0 || (stream.last_ms != 0 &&
+                             now_ms - stream.last_ms < stream.interval_ms)) {
+        continue;
+      }
+      stream.last_ms = now_ms ? now_ms : 1;
+      /* Request is processed in place, so process a copy. */
+      memcpy(stream_buffer_, stream.request, stream.request_length);
+      UInt8Array request;
+      request.data = stream_buffer_;
+      request.length = stream.request_length;
+      UInt8Array buffer;
+      buffer.data = stream_buffer_;
+      buffer.length = sizeof(stream_buffer_);
+      UInt8Array result = command_processor_.process_command(request, buffer);
+      if (result.data == NULL) {
+        /* Command failed, so stop stream. */
+        stream.id = 0;
+        continue;
+      }
+      FixedPacket stream_packet;
+      stream_packet.reset_buffer(result.length, result.data);
+      stream_packet.payload_length_ = result.length;
+      stream_packet.type(FixedPacket::packet_type::STREAM);
+      stream_packet.iuid_ = stream.id;
+      write_packet(ostream_, stream_packet);
+    }
+#endif
+  }
 
   template <typename Packet>
   void process_packet(Packet &packet) {
-    UInt8Array result = process_packet_with_processor(packet,
-                                                      command_processor_);
+    UInt8Array result;
+    uint16_t command = 0;
+    if (packet.type() == Packet::packet_type::DATA &&
+        packet.payload_length_ >= sizeof(uint16_t)) {
+      memcpy(&command, packet.payload_buffer_, sizeof(command));
+    }
+    if (command == CMD_CHUNKED_RESPONSE) {
+      process_chunked_response(packet);
+      return;
+    } else if (command == CMD_STREAM_START || command == CMD_STREAM_STOP) {
+      result = process_stream_command(packet, command);
+    } else if (command == CMD_CHUNK) {
+      result = process_chunk(packet);
+    } else {
+      result = process_packet_with_processor(packet, command_processor_);
+    }
     FixedPacket result_packet;
     if (result.data == NULL && result.length > 0) {
       /* There was an error encountered while processing the request. */
@@ -78,6 +448,7 @@ class CommandPacketHandler {
       result_packet.payload_length_ = result.length;
       result_packet.type(FixedPacket::packet_type::DATA);
     }
+    result_packet.iuid_ = packet.iuid_;
     write_packet(ostream_, result_packet);
   }
 };
@@ -1,10 +1,6 @@
 # coding: utf-8
-import nadamq
-import nanopb_helpers
-
 from typing import Dict, List
 from path_helpers import path
-from platformio_helpers import conda_arduino_include_path
 
 from ._version import get_versions
 
@@ -45,6 +41,8 @@ def get_includes() -> List[path]:
         ...
 
     """
+    from platformio_helpers import conda_arduino_include_path
+
     includes = (list(get_library_directory().walkdirs('src')) +
                 list(conda_arduino_include_path().walkdirs()))
     return includes
@@ -55,6 +53,9 @@ def get_sources() -> List[path]:
     Return Arduino source file paths.  This includes any supplementary source
     files that are not contained in Arduino libraries.
     """
+    import nadamq
+    import nanopb_helpers
+
     return nadamq.get_sources() + nanopb_helpers.get_sources()
 
 
@@ -0,0 +1,580 @@
+# coding: utf-8
+import asyncio
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from time import perf_counter_ns
+from typing import Optional
+
+import numpy as np
+from nadamq.NadaMq import cPacket, cPacketParser, PACKET_TYPES
+
+from .metrics import Metrics, command_names
+from .proxy import (CHUNK_HEADER, CMD_CHUNK, RESPONSE_LENGTH, START_FLAG,
+                    CommandTimeoutError, FramingError, ProxyBase,
+                    call_arguments, call_count, chunked_response_request,
+                    find_packet, followed_by_frame, frame_iuid, parse_frame)
+from .stream import AsyncStream, start_request, stop_request
+
+
+class AsyncProxyBase:
+    """
+    Base class for `asyncio` proxies (i.e., generated with `async_=True`).
+
+    Requests are written to an `asyncio.StreamWriter` and replies are read by
+    a single reader task, which resolves the future of each request based on
+    the identifier echoed in the reply packet header.  Each generated method
+    is a coroutine, so a single event loop may drive many devices
+    concurrently, with timeouts and cancellation provided by `asyncio` (e.g.,
+    `asyncio.wait_for(proxy.ram_free(), 0.5)`).
+
+    Example:
+
+        proxy = await Proxy.open_serial('/dev/ttyUSB0', baudrate=115200)
+        async with proxy:
+            values = await asyncio.gather(*(proxy.analog_read(i)
+                                            for i in range(6)))
+
+    .. note::
+        The `batch`, `pipeline` and `deadline` blocks of `ProxyBase` are not
+        available.  Concurrent calls (e.g., `asyncio.gather`) are already
+        pipelined, up to `pipeline_window` at once, but each is sent as a
+        separate packet.  Use `timeout` or `asyncio.wait_for` (or
+        `asyncio.timeout`) instead of deadlines.
+    """
+    # Maximum number of requests in flight at once.
+    pipeline_window = 8
+    # Size of packet buffer of device, size of buffer of device to reassemble
+    # larger requests in, and maximum number of fragments of such a request
+    # in flight at once (see `ProxyBase`).
+    PACKET_SIZE = ProxyBase.PACKET_SIZE
+    MAX_REQUEST_SIZE = ProxyBase.MAX_REQUEST_SIZE
+    chunk_window = ProxyBase.chunk_window
+    # Maximum number of bytes to read from the stream at once.
+    receive_buffer_size = 8 << 10
+    # Maximum number of bytes of a result per packet of a chunked response
+    # (see `ProxyBase.iter_chunks`).
+    response_chunk_size = 1 << 10
+    # Maximum number of seconds to wait for the reply to each command
+    # (`None` waits indefinitely).
+    timeout = None
+    # Call metrics (see `ProxyBase.enable_metrics`), or `None` if disabled.
+    metrics = None
+    # Commands resent if the reply is corrupted or times out, and resync
+    # counters (see `ProxyBase`).
+    idempotent_commands = frozenset()
+    retries = 2
+    _idempotent_codes = None
+    framing_errors = 0
+    discarded_bytes = 0
+    retried_calls = 0
+    _is_idempotent = ProxyBase._is_idempotent
+    _many_payloads = ProxyBase._many_payloads
+
+    def __init__(self, reader: asyncio.StreamReader,
+                 writer: asyncio.StreamWriter):
+        self._reader = reader
+        self._writer = writer
+        self._parser = cPacketParser()
+        self._in_flight = OrderedDict()
+        self._last_iuid = 0
+        self._window = None
+        # Lock held while sending a request in chunks (see `_send_chunked`).
+        self._chunk_lock = None
+        self._receive_task = None
+        self._streams = {}
+        self._receive_data = bytearray()
+        # Queues of packets of chunked responses, by request identifier.
+        self._chunk_queues = {}
+
+    @classmethod
+    async def open_serial(cls, port: str, baudrate: int = 115200, **kwargs):
+        """
+        Open serial port using `pyserial-asyncio` and return proxy instance.
+        """
+        import serial_asyncio
+
+        reader, writer = await serial_asyncio.open_serial_connection(
+            url=port, baudrate=baudrate, **kwargs)
+        return cls(reader, writer)
+
+    @classmethod
+    async def open_connection(cls, host: str, port: int, **kwargs):
+        """
+        Open TCP connection (e.g., to a serial-to-network bridge) and return
+        proxy instance.
+        """
+        reader, writer = await asyncio.open_connection(host, port, **kwargs)
+        return cls(reader, writer)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    async def close(self) -> None:
+        if self._receive_task is not None:
+            self._receive_task.cancel()
+            try:
+                await self._receive_task
+            except asyncio.CancelledError:
+                pass
+            self._receive_task = None
+        self._writer.close()
+        await self._writer.wait_closed()
+
+    async def _receive_loop(self) -> None:
+        """
+        Read replies from the device and resolve the matching request futures.
+        """
+        try:
+            while True:
+                chunk = await self._reader.read(self.receive_buffer_size)
+                if not chunk:
+                    raise ConnectionError('Connection to device closed.')
+                self._receive_data += chunk
+                self._scan()
+        except asyncio.CancelledError:
+            raise
+        except Exception as exception:
+            for future in self._in_flight.values():
+                if not future.done():
+                    future.set_exception(exception)
+            self._in_flight.clear()
+            for stream in self._streams.values():
+                stream.close()
+            for queue in self._chunk_queues.values():
+                queue.put_nowait(exception)
+            self._receive_task = None
+
+    def _scan(self) -> None:
+        """
+        Dispatch each complete packet in the received data.
+        """
+        data = self._receive_data
+        while True:
+            start, end = find_packet(data)
+            # Bytes before start flag (e.g., noise) are discarded.
+            self.discarded_bytes += start
+            if end is None:
+                if not followed_by_frame(self._parser, data, start, len(data)):
+                    del data[:start]
+                    break
+                # Header of incomplete frame is corrupted (e.g., payload
+                # length overlapping the next frame).
+                end = len(data)
+                packet = None
+            else:
+                packet = parse_frame(self._parser, data, start, end)
+            if packet is None:
+                iuid = frame_iuid(data, start, end)
+                self._resync(data, start)
+                self._fail_corrupted(FramingError('Corrupted packet received.',
+                                                  iuid))
+                continue
+            # Detach from packet parser, which is reused for the next reply.
+            packet = cPacket(iuid=packet.iuid, type_=packet.type_,
+                             data=packet.data())
+            del data[:end]
+            self._dispatch_response(packet)
+
+    def _resync(self, data: bytearray, start: int) -> None:
+        """
+        Discard received `data` up to and including the start flag of the
+        corrupted frame at `start`, such that scanning resumes at the next
+        start flag (see `ProxyBase._resync`).
+        """
+        self.framing_errors += 1
+        self.discarded_bytes += len(START_FLAG)
+        del data[:start + len(START_FLAG)]
+
+    def _fail_corrupted(self, exception: FramingError) -> None:
+        """
+        Fail the outstanding request whose reply was corrupted (if any).
+        """
+        queue = self._chunk_queues.get(exception.iuid)
+        if queue is not None:
+            queue.put_nowait(exception)
+            return
+        future = self._in_flight.pop(exception.iuid, None)
+        if future is not None and not future.done():
+            future.set_exception(exception)
+
+    def _dispatch_response(self, packet) -> None:
+        if packet.type_ == PACKET_TYPES.STREAM:
+            stream = self._streams.get(packet.iuid)
+            if stream is not None:
+                stream.push(packet.data())
+            return
+        queue = self._chunk_queues.get(packet.iuid)
+        if queue is not None:
+            queue.put_nowait(packet)
+            return
+        if packet.iuid in self._in_flight:
+            future = self._in_flight.pop(packet.iuid)
+        elif packet.iuid == 0 and self._in_flight:
+            # Device does not echo request identifiers; replies arrive in
+            # request order.
+            _, future = self._in_flight.popitem(last=False)
+        else:
+            # Reply to a request that was cancelled.
+            return
+        if not future.done():
+            future.set_result(packet)
+
+    def enable_metrics(self, metrics: Optional[Metrics] = None) -> Metrics:
+        """
+        Record metrics of each call to `metrics` (see
+        `ProxyBase.enable_metrics`).
+
+        Replies are received by the reader task while other calls are in
+        flight, so only the `encode`, `write` and `decode` phases are timed.
+        """
+        if metrics is None:
+            metrics = Metrics(command_names(type(self)))
+        self.metrics = metrics
+        return metrics
+
+    async def _call(self, packet, dtype: Optional[str] = None,
+                    array: bool = False, encode_start: int = 0,
+                    out: Optional[np.ndarray] = None,
+                    chunk_size: Optional[int] = None):
+        """
+        Send command packet and return decoded response (see
+        `ProxyBase._decode_response`).
+
+        Raises `CommandTimeoutError` if the reply is not received within
+        `timeout` seconds.
+
+        If `chunk_size` is specified, an array response is sent by the device
+        in chunks of up to `chunk_size` bytes (see `ProxyBase._call_chunked`).
+        """
+        if chunk_size is not None:
+            return await self._call_chunked(packet, dtype, chunk_size, out)
+        if self.metrics is not None:
+            return await self._call_instrumented(packet, dtype, array,
+                                                 encode_start, out)
+        return ProxyBase._decode_response(await self._request(packet), dtype,
+                                          array, out)
+
+    async def _request(self, packet, write_times: Optional[list] = None):
+        """
+        Send command packet and return the reply packet.
+
+        Commands listed in `idempotent_commands` are resent (up to `retries`
+        times) if the reply is corrupted or times out.
+
+        If `write_times` is a list, the times (`time.perf_counter_ns`) the
+        request write started and ended are appended to it.
+
+        Requests larger than `PACKET_SIZE` are sent in chunks (see
+        `_send_chunked`).
+        """
+        if packet.buffer_size > self.PACKET_SIZE:
+            return await self._send_chunked(packet.data(), write_times)
+        attempts = 1 + (self.retries if self._is_idempotent(packet) else 0)
+        for attempt in range(attempts):
+            if attempt:
+                self.retried_calls += 1
+                if write_times is not None:
+                    del write_times[:]
+            try:
+                return await self._request_once(packet, write_times)
+            except (FramingError, CommandTimeoutError):
+                if attempt == attempts - 1:
+                    raise
+
+    async def _send_chunked(self, request: bytes,
+                            write_times: Optional[list] = None):
+        """
+        Send command request larger than `PACKET_SIZE` as a sequence of
+        fragments, with up to `chunk_window` fragments in flight, and return
+        the response packet (see `ProxyBase._send_chunked`).
+
+        The device reassembles a single chunked request at a time, so
+        concurrent chunked requests are sent one after another.
+
+        If `write_times` is a list, the times the write of the last fragment
+        started and ended are appended to it.
+        """
+        if len(request) > self.MAX_REQUEST_SIZE:
+            raise ValueError(f'Request of {len(request)} bytes is larger than '
+                             f'`PACKET_SIZE` ({self.PACKET_SIZE} bytes) and '
+                             f'`MAX_REQUEST_SIZE` ({self.MAX_REQUEST_SIZE} '
+                             'bytes, see `RPC_CHUNK_BUFFER_SIZE`).')
+        if self._chunk_lock is None:
+            self._chunk_lock = asyncio.Lock()
+        chunk_size = self.PACKET_SIZE - CHUNK_HEADER.size
+        offsets = range(0, len(request), chunk_size)
+        window = asyncio.Semaphore(self.chunk_window)
+
+        async def send(offset: int):
+            # Fragments acquire the window (and are written) in order.
+            async with window:
+                chunk = (CHUNK_HEADER.pack(CMD_CHUNK, offset, len(request)) +
+                         request[offset:offset + chunk_size])
+                return await self._request_once(
+                    cPacket(data=chunk, type_=PACKET_TYPES.DATA),
+                    write_times if offset == offsets[-1] else None)
+
+        async with self._chunk_lock:
+            responses = await asyncio.gather(*(send(offset)
+                                               for offset in offsets))
+        if any(response.type_ != PACKET_TYPES.DATA for response in responses):
+            raise IOError('Chunked request rejected by device.')
+        return responses[-1]
+
+    async def _request_once(self, packet,
+                            write_times: Optional[list] = None):
+        if self._window is None:
+            self._window = asyncio.Semaphore(self.pipeline_window)
+        if self._receive_task is None:
+            self._receive_task = asyncio.ensure_future(self._receive_loop())
+        async with self._window:
+            # Cycle through identifiers 1-0xFFFF (0 marks untagged packets).
+            self._last_iuid = self._last_iuid % 0xFFFF + 1
+            iuid = packet.iuid = self._last_iuid
+            future = asyncio.get_running_loop().create_future()
+            self._in_flight[iuid] = future
+            try:
+                if write_times is not None:
+                    write_times.append(perf_counter_ns())
+                self._writer.write(packet.tostring())
+                await self._writer.drain()
+                if write_times is not None:
+                    write_times.append(perf_counter_ns())
+                return await asyncio.wait_for(future, self.timeout)
+            except asyncio.TimeoutError:
+                # Partially received packets (e.g., replies to other
+                # requests) are kept (see `ProxyBase._receive_packet`).
+                raise CommandTimeoutError('Timed out waiting for reply.')
+            finally:
+                self._in_flight.pop(iuid, None)
+
+    async def _receive_chunks(self, request: bytes, dtype: str,
+                              chunk_size: Optional[int] = None):
+        """
+        Send command request for a chunked response and asynchronously yield
+        `(offset, total length, payload)` of each chunk of the result as it
+        arrives (see `ProxyBase._receive_chunks`).
+
+        Raises `CommandTimeoutError` if a packet of the response is not
+        received within `timeout` seconds.
+        """
+        if self._window is None:
+            self._window = asyncio.Semaphore(self.pipeline_window)
+        if self._receive_task is None:
+            self._receive_task = asyncio.ensure_future(self._receive_loop())
+        payload = chunked_response_request(request, np.dtype(dtype).itemsize,
+                                           chunk_size or
+                                           self.response_chunk_size)
+        async with self._window:
+            self._last_iuid = self._last_iuid % 0xFFFF + 1
+            iuid = self._last_iuid
+            queue = self._chunk_queues[iuid] = asyncio.Queue()
+            try:
+                packet = cPacket(iuid=iuid, data=payload,
+                                 type_=PACKET_TYPES.DATA)
+                self._writer.write(packet.tostring())
+                await self._writer.drain()
+                offset = 0
+                total_length = None
+                while total_length is None or offset < total_length:
+                    try:
+                        response = await asyncio.wait_for(queue.get(),
+                                                          self.timeout)
+                    except asyncio.TimeoutError:
+                        raise CommandTimeoutError('Timed out waiting for '
+                                                  'reply.')
+                    if isinstance(response, Exception):
+                        raise response
+                    data = response.data()
+                    if total_length is None:
+                        if (response.type_ != PACKET_TYPES.DATA or
+                                len(data) != RESPONSE_LENGTH.size):
+                            raise IOError('Command failed.')
+                        total_length, = RESPONSE_LENGTH.unpack(data)
+                        continue
+                    if response.type_ != PACKET_TYPES.DATA or not data:
+                        raise IOError('Chunked response interrupted.')
+                    yield offset, total_length, data
+                    offset += len(data)
+            finally:
+                del self._chunk_queues[iuid]
+
+    async def _call_chunked(self, packet, dtype: str, chunk_size: int,
+                            out: Optional[np.ndarray] = None):
+        """
+        Send command packet and decode the chunked array response into a new
+        array (or into `out`, if specified), filled in place as each chunk
+        arrives (see `ProxyBase._call_chunked`).
+        """
+        metrics = None
+        if self.metrics is not None:
+            request = packet.data()
+            metrics = self.metrics.command(int.from_bytes(request[:2],
+                                                          'little'))
+            metrics.calls += 1
+            metrics.request_bytes += len(request)
+        itemsize = np.dtype(dtype).itemsize
+        values = None
+        try:
+            async for offset, total_length, payload in \
+                    self._receive_chunks(packet.data(), dtype, chunk_size):
+                if values is None:
+                    count = total_length // itemsize
+                    if out is None:
+                        out = np.empty(count, dtype=dtype)
+                    else:
+                        ProxyBase._check_out(dtype, out, count)
+                    values = memoryview(out).cast('B')
+                values[offset:offset + len(payload)] = payload
+                if metrics is not None:
+                    metrics.response_bytes += len(payload)
+        except Exception:
+            if metrics is not None:
+                metrics.errors += 1
+            raise
+        if values is None:
+            # Empty result.
+            return np.empty(0, dtype=dtype) if out is None else out[:0]
+        return out[:count]
+
+    async def iter_chunks(self, method, *args,
+                          chunk_size: Optional[int] = None, **kwargs):
+        """
+        Call generated `Proxy` coroutine `method` (returning an array) and
+        asynchronously yield the result in chunks (i.e., `numpy` arrays) as
+        they arrive (see `ProxyBase.iter_chunks`).
+
+        Example:
+
+            async for block in proxy.iter_chunks(proxy.read_samples, 10000):
+                ...
+        """
+        request, dtype, array = await self._capture_request(method, *args,
+                                                            **kwargs)
+        if not array:
+            raise ValueError('Command does not return an array.')
+        async for _, _, payload in self._receive_chunks(request, dtype,
+                                                        chunk_size):
+            yield np.frombuffer(payload, dtype=dtype)
+
+    async def many(self, method, *args):
+        """
+        Call generated `Proxy` coroutine `method` once for each value of the
+        sequence arguments in `args` and return the results stacked in a
+        single array (see `ProxyBase.many`).
+
+        Batch packets (or, for methods with array arguments or results, the
+        individual calls) are sent concurrently, up to `pipeline_window` at
+        once.
+
+        Example:
+
+            voltages = await proxy.many(proxy.analog_read_at, 0,
+                                        np.arange(10000))
+        """
+        count = call_count(args)
+        if not count:
+            return np.empty(0)
+        request, dtype, array = await self._capture_request(
+            method, *call_arguments(args, 0))
+        payloads = self._many_payloads(method, args, count, request, dtype,
+                                       array)
+        if payloads is None:
+            results = await asyncio.gather(*(method(*call_arguments(args, i))
+                                             for i in range(count)))
+            return ProxyBase._stack_results(results, dtype, array)
+        responses = await asyncio.gather(*(self._request(cPacket(
+            data=payload, type_=PACKET_TYPES.DATA))
+            for _, _, payload in payloads))
+        return ProxyBase._decode_many([(start, length, response)
+                                       for (start, length, _), response in
+                                       zip(payloads, responses)], dtype, count)
+
+    async def _call_instrumented(self, packet, dtype: Optional[str],
+                                 array: bool, encode_start: int,
+                                 out: Optional[np.ndarray] = None):
+        """
+        Instrumented version of `_call` (see `enable_metrics`).
+        """
+        encode_end = perf_counter_ns()
+        request = packet.data()
+        metrics = self.metrics.command(int.from_bytes(request[:2], 'little'))
+        metrics.calls += 1
+        metrics.request_bytes += len(request)
+        if encode_start:
+            metrics.phases['encode'].record(encode_end - encode_start)
+        write_times = []
+        try:
+            response = await self._request(packet, write_times)
+            decode_start = perf_counter_ns()
+            metrics.response_bytes += len(response.data())
+            result = ProxyBase._decode_response(response, dtype, array, out)
+        except Exception:
+            metrics.errors += 1
+            raise
+        write_start, write_end = write_times
+        metrics.phases['write'].record(write_end - write_start)
+        metrics.phases['decode'].record(perf_counter_ns() - decode_start)
+        return result
+
+    async def _capture_request(self, method, *args, **kwargs):
+        """
+        Return serialized command request, response type and array flag of a
+        call to generated `Proxy` coroutine `method` (without sending it).
+        """
+        captured = []
+
+        async def capture(packet, dtype=None, array=False, **kwargs):
+            captured.append((packet.data(), dtype, array))
+
+        self._call = capture
+        try:
+            await method(*args, **kwargs)
+        finally:
+            del self._call
+        return captured[0]
+
+    @asynccontextmanager
+    async def stream(self, method, *args, interval_ms: int = 0,
+                     buffer_size: int = 1 << 20, **kwargs):
+        """
+        Asynchronous context manager to stream the result of a command (see
+        `ProxyBase.stream`).
+
+        Yields a `arduino_rpc.stream.AsyncStream`, which asynchronously
+        yields `numpy` blocks of results as they arrive.
+
+        Example:
+
+            async with proxy.stream(proxy.analog_read, 0) as samples:
+                async for block in samples:
+                    ...
+        """
+        request, dtype, _ = await self._capture_request(method, *args,
+                                                        **kwargs)
+        if dtype is None:
+            raise ValueError('Command has no result to stream.')
+        stream_id = next(i for i in range(1, 0x10000) if i not in self._streams)
+        stream = AsyncStream(stream_id, dtype, buffer_size=buffer_size)
+        self._streams[stream_id] = stream
+        try:
+            await self._stream_command(start_request(stream_id, interval_ms,
+                                                     request))
+            try:
+                yield stream
+            finally:
+                await self._stream_command(stop_request(stream_id))
+        finally:
+            stream.close()
+            del self._streams[stream_id]
+
+    async def _stream_command(self, payload: bytes) -> None:
+        response = await self._request(cPacket(data=payload,
+                                               type_=PACKET_TYPES.DATA))
+        if response.type_ != PACKET_TYPES.DATA:
+            raise IOError('Stream request rejected by device (e.g., no free '
+                          'stream, or streaming disabled, see '
+                          '`RPC_MAX_STREAMS`).')
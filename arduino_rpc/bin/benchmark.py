@@ -0,0 +1,326 @@
+# coding: utf-8
+"""
+Benchmark host-side round trip latency and CPU usage of `ProxyBase` against a
+fake device connected through a pseudo-terminal (no hardware required).
+
+The fake device echoes the payload of each request packet back to the host
+after an optional delay, emulating the time a device takes to process a
+command.
+
+Example:
+
+    python -m arduino_rpc.bin.benchmark -n 1000 --delay 0.002
+
+With `--dispatch`, instead benchmark command dispatch of the generated
+`CommandProcessor` (see `arduino_rpc.native.build_native_emulator`), i.e.,
+time `rpc_process_command` calls of a native emulator of a class with
+`--methods` methods, for each dispatch mode:
+
+    python -m arduino_rpc.bin.benchmark -n 100000 --dispatch switch \
+        --dispatch table
+"""
+import ctypes
+import os
+import pty
+import struct
+import sys
+import tempfile
+import threading
+import time
+import tty
+from functools import partial
+
+import numpy as np
+from nadamq.NadaMq import cPacket, cPacketParser, PACKET_TYPES
+
+from ..proxy import ProxyBase, find_packet
+
+
+class PtyEchoDevice:
+    """
+    Fake device attached to the master side of a pseudo-terminal.
+
+    Each complete request packet is echoed back as a `DATA` packet with the
+    same payload (and interface identifier) after `delay` seconds.
+    """
+    def __init__(self, delay: float = 0):
+        self.delay = delay
+        self.master, self.slave = pty.openpty()
+        tty.setraw(self.master)
+        tty.setraw(self.slave)
+        self.port = os.ttyname(self.slave)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        parser = cPacketParser()
+        data = bytearray()
+        while True:
+            try:
+                data += os.read(self.master, 4096)
+            except OSError:
+                # Pseudo-terminal was closed.
+                break
+            # Several (pipelined) requests may arrive in a single read.
+            while True:
+                start, end = find_packet(data)
+                if end is None:
+                    del data[:start]
+                    break
+                parser.reset()
+                packet = parser.parse(memoryview(data)[start:end])
+                if parser.message_completed:
+                    if self.delay:
+                        time.sleep(self.delay)
+                    response = cPacket(iuid=packet.iuid, data=packet.data(),
+                                       type_=PACKET_TYPES.DATA)
+                    os.write(self.master, response.tostring())
+                del data[:end]
+
+    def close(self):
+        os.close(self.master)
+        os.close(self.slave)
+
+
+class SerialProxy(ProxyBase):
+    def __init__(self, serial):
+        self._serial = serial
+
+
+class SpinningSerialProxy(SerialProxy):
+    """
+    Proxy using the legacy receive loop, which busy-polls `inWaiting()`.
+    """
+    def _send_command(self, packet):
+        self._serial.write(packet.tostring())
+        parser = cPacketParser()
+        while True:
+            response = self._serial.read(self._serial.inWaiting())
+            if not response:
+                continue
+            result = parser.parse(np.frombuffer(response, dtype='uint8'))
+            if parser.message_completed:
+                return result
+            elif parser.error:
+                raise IOError('Error parsing.')
+
+
+def benchmark(proxy: ProxyBase, count: int, payload_size: int,
+              window: int = 1) -> dict:
+    """
+    Time `count` round trips of a `payload_size`-byte request through `proxy`,
+    with up to `window` requests in flight.
+
+    Returns
+    -------
+    dict
+        Mean and minimum round trip latency, calls per second, and host CPU
+        time consumed as a fraction of wall clock time.
+    """
+    latencies = np.empty(count)
+    cpu_start = time.process_time()
+    wall_start = time.perf_counter()
+    if window > 1:
+        sent = np.empty(count)
+        received = np.empty(count)
+
+        def record(i, future):
+            received[i] = time.perf_counter()
+
+        with proxy.pipeline(window=window):
+            futures = []
+            for i in range(count):
+                packet = cPacket(data=bytes(payload_size),
+                                 type_=PACKET_TYPES.DATA)
+                sent[i] = time.perf_counter()
+                future = proxy._call(packet)
+                future.add_done_callback(partial(record, i))
+                futures.append(future)
+        # All replies are received when the `pipeline` block exits; raise
+        # errors of failed calls (if any).
+        for future in futures:
+            future.result()
+        # Latency of each call, from before its request was sent (which may
+        # block while the pipeline window is full) until its reply was
+        # received.
+        latencies[:] = received - sent
+    else:
+        packet = cPacket(data=bytes(payload_size), type_=PACKET_TYPES.DATA)
+        for i in range(count):
+            start = time.perf_counter()
+            proxy._send_command(packet)
+            latencies[i] = time.perf_counter() - start
+    wall = time.perf_counter() - wall_start
+    cpu = time.process_time() - cpu_start
+    return {'mean_latency_s': latencies.mean(), 'min_latency_s': latencies.min(),
+            'calls_per_s': count / wall, 'cpu_fraction': cpu / wall}
+
+
+# Command code of the first method of the class used to benchmark dispatch.
+DISPATCH_FIRST_CODE = 0x20
+# Request of a method of the class used to benchmark dispatch: command code
+# and `int32_t` argument.
+DISPATCH_REQUEST = struct.Struct('<Hi')
+
+
+def get_dispatch_sig_info(method_count: int):
+    """
+    Return signature frame (see
+    `arduino_rpc.code_gen.get_multilevel_method_sig_frame`) of the `Bench`
+    class written by `write_dispatch_header`.
+    """
+    import pandas as pd
+
+    columns = ['method_i', 'method_name', 'camel_name', 'arg_count',
+               'arg_name', 'ndims', 'atom_type', 'atom_np_type',
+               'struct_atom_type', 'struct_size', 'return_atom_type',
+               'return_atom_np_type', 'return_ndims',
+               'return_struct_atom_type', 'class_name', 'header_name']
+    rows = [(DISPATCH_FIRST_CODE + i, f'method{i}', f'Method{i}', 1, 'value',
+             0, 'int32_t', 'int32', 'int32_t', 4, 'int32_t', 'int32', 0,
+             'int32_t', 'Bench', 'Bench.h') for i in range(method_count)]
+    return pd.DataFrame(rows, columns=columns).astype(object)
+
+
+def write_dispatch_header(output_dir: str, method_count: int) -> str:
+    """
+    Write header declaring `Bench` class with `method_count` methods (one
+    per command) to `output_dir`, and return its path.
+    """
+    lines = ['#include <stdint.h>', '', 'class Bench {', 'public:',
+             '  int32_t total = 0;']
+    # Methods are not inlined, such that each command calls a method, like
+    # on a device.
+    lines += [f'  __attribute__((noinline)) int32_t method{i}(int32_t value) '
+              f'{{ return total += {i + 1} * value; }}'
+              for i in range(method_count)]
+    lines += ['};', '']
+    header = os.path.join(output_dir, 'Bench.h')
+    with open(header, 'w') as output:
+        output.write('\n'.join(lines))
+    return header
+
+
+def benchmark_dispatch(library: str, method_count: int, count: int,
+                       repeat: int = 5) -> dict:
+    """
+    Time `count` calls of `rpc_process_command` of a native emulator of the
+    `Bench` class (see `build_native_emulator`), cycling through its
+    `method_count` commands in random order.
+
+    Returns
+    -------
+    dict
+        Minimum (over `repeat` runs) and median time per call, and minimum
+        time per call without the `ctypes` call overhead (i.e., minus the
+        time of calls rejected before processing the request), in
+        nanoseconds.
+    """
+    from ..native import NativeEmulatedSerial
+
+    serial = NativeEmulatedSerial(library)
+    try:
+        process_command = serial.library.rpc_process_command
+        codes = (DISPATCH_FIRST_CODE +
+                 np.random.RandomState(0).permutation(np.arange(count) %
+                                                      method_count))
+        requests = [DISPATCH_REQUEST.pack(int(code), 1) for code in codes]
+        output = bytearray(16)
+        target = (ctypes.c_char * len(output)).from_buffer(output)
+        if process_command(serial._device, requests[0], DISPATCH_REQUEST.size,
+                           target, len(output)) != 4:
+            raise IOError('Command failed.')
+
+        def run(length):
+            start = time.perf_counter_ns()
+            for request in requests:
+                process_command(serial._device, request, length, target,
+                                len(output))
+            return (time.perf_counter_ns() - start) / count
+
+        durations = [run(DISPATCH_REQUEST.size) for _ in range(repeat)]
+        # Requests larger than the packet buffer are rejected before they
+        # are processed.
+        overhead = min(run(0xFFFF) for _ in range(repeat))
+    finally:
+        serial.close()
+    return {'min_ns': min(durations), 'median_ns': float(np.median(durations)),
+            'dispatch_ns': min(durations) - overhead}
+
+
+def main_dispatch(args) -> None:
+    from ..native import build_native_emulator
+
+    with tempfile.TemporaryDirectory() as output_dir:
+        header = write_dispatch_header(output_dir, args.methods)
+        df_sig_info = get_dispatch_sig_info(args.methods)
+        for dispatch in args.dispatch:
+            library = build_native_emulator(df_sig_info, header, 'Bench',
+                                            os.path.join(output_dir,
+                                                         dispatch),
+                                            namespace='bench',
+                                            cxxflags=args.cxxflags.split(),
+                                            dispatch=dispatch)
+            result = benchmark_dispatch(library, args.methods, args.count)
+            print(f'{dispatch:>8}: {args.methods} methods '
+                  f'min={result["min_ns"]:.1f}ns '
+                  f'median={result["median_ns"]:.1f}ns per call '
+                  f'(excluding ctypes overhead: '
+                  f'{result["dispatch_ns"]:.1f}ns)')
+
+
+def parse_args(args=None):
+    """Parses arguments, returns (options, args)."""
+    from argparse import ArgumentParser
+
+    if args is None:
+        args = sys.argv[1:]
+
+    parser = ArgumentParser(description='Benchmark host-side RPC round trips '
+                            'against a fake pseudo-terminal device.')
+    parser.add_argument('-n', '--count', type=int, default=1000)
+    parser.add_argument('-s', '--payload-size', type=int, default=8)
+    parser.add_argument('--delay', type=float, default=0.001,
+                        help='Simulated device processing time (seconds).')
+    parser.add_argument('-w', '--window', type=int, default=8,
+                        help='Number of requests in flight when pipelining.')
+    parser.add_argument('--dispatch', action='append',
+                        choices=['switch', 'table'],
+                        help='Benchmark command dispatch of a native emulator '
+                        'instead (may be repeated to compare modes).')
+    parser.add_argument('--methods', type=int, default=64,
+                        help='Number of methods (i.e., commands) of the '
+                        'class used to benchmark dispatch.')
+    parser.add_argument('--cxxflags', default='-O2',
+                        help='Compiler flags of the native emulator used to '
+                        'benchmark dispatch.')
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    args = parse_args(args)
+    if args.dispatch:
+        main_dispatch(args)
+        return
+
+    from serial import Serial
+
+    device = PtyEchoDevice(delay=args.delay)
+    try:
+        serial = Serial(device.port, timeout=0)
+        runs = (('spin', SpinningSerialProxy, 1), ('event', SerialProxy, 1),
+                ('pipeline', SerialProxy, args.window))
+        for name, proxy_class, window in runs:
+            result = benchmark(proxy_class(serial), args.count,
+                               args.payload_size, window=window)
+            print(f'{name:>8}: mean={result["mean_latency_s"] * 1e6:.1f}us '
+                  f'min={result["min_latency_s"] * 1e6:.1f}us '
+                  f'rate={result["calls_per_s"]:.0f}/s '
+                  f'cpu={result["cpu_fraction"]:.1%}')
+        serial.close()
+    finally:
+        device.close()
+
+
+if __name__ == '__main__':
+    main()
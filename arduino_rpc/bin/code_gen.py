@@ -1,9 +1,12 @@
 # coding: utf-8
+import json
 import sys
 from path_helpers import path
 
-from ..rpc_data_frame import get_c_commands_header_code, get_python_code
+from ..rpc_data_frame import (get_c_command_processor_header_code,
+                              get_c_commands_header_code, get_python_code)
 from ..code_gen import write_code
+from ..schema import get_schema
 
 
 def parse_args(args=None):
@@ -19,6 +22,10 @@ def parse_args(args=None):
     parser.add_argument('cpp_header', type=path, default=None)
     parser.add_argument('class_name', help='C++ class name to read methods '
                         'from.')
+    parser.add_argument('-b', '--base', nargs=2, action='append', default=[],
+                        metavar=('BASE_HEADER', 'BASE_CLASS_NAME'),
+                        help='C++ header and name of base class to read '
+                        'methods from, in inheritance order (may be repeated).')
     parser.add_argument('-o', '--out_file', type=path, default='-')
     parser.add_argument('-f', '--force-overwrite', action='store_true')
     action.add_argument('--python', help='Generate Python code.',
@@ -26,10 +33,47 @@ def parse_args(args=None):
     action.add_argument('--cpp', help='Name for C++ command processor class '
                         'in underscore format (e.g., `my_class_name`)',
                         default=None)
+    action.add_argument('--schema', help='Generate JSON method signature '
+                        'schema (see `arduino_rpc.schema.get_proxy_class`).',
+                        action='store_true')
+    parser.add_argument('--command-processor', type=path, default=None,
+                        help='With `--cpp`, also write `CommandProcessor` '
+                        'C++ header (which includes `Commands.h`) to this '
+                        'path.')
+    parser.add_argument('--dispatch', choices=('switch', 'table'),
+                        default='switch', help='Command dispatch of '
+                        '`CommandProcessor` (see `arduino_rpc.rpc_data_frame.'
+                        'get_c_command_processor_header_code`).')
+    parser.add_argument('--code-map', type=path, default=None,
+                        help='Command code mapping file (JSON), created if it '
+                        'does not exist, to keep command codes stable between '
+                        'builds.')
+    parser.add_argument('--prune', action='store_true',
+                        help='Free command codes of methods removed since the '
+                        '`--code-map` file was written (by default, their '
+                        'codes are never reused).')
+    cache = parser.add_mutually_exclusive_group()
+    cache.add_argument('--cache-dir', type=path, default=None,
+                       help='Header parse cache directory (default: '
+                       '`$ARDUINO_RPC_CACHE_DIR` or `~/.cache/arduino_rpc`).')
+    cache.add_argument('--no-cache', action='store_true',
+                       help='Always parse headers (i.e., disable parse cache).')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='Number of headers (i.e., `cpp_header` and '
+                        '`--base` headers) to parse in parallel (`0` for '
+                        'number of CPUs).')
+    parser.add_argument('--async', dest='async_', action='store_true',
+                        help='Generate `asyncio` Python code (i.e., `Proxy` '
+                        'methods are coroutines).')
 
     args = parser.parse_args()
     if args.out_file.isfile() and not args.force_overwrite:
         parser.error('Output file already exists.  Use `--force-overwrite` to overwrite.')
+    if args.command_processor is not None:
+        if args.cpp is None:
+            parser.error('`--command-processor` requires `--cpp`.')
+        elif args.command_processor.isfile() and not args.force_overwrite:
+            parser.error('Command processor file already exists.  Use `--force-overwrite` to overwrite.')
     return args
 
 
@@ -37,8 +81,21 @@ if __name__ == '__main__':
     args = parse_args()
 
     if args.python:
-        f_get_code = get_python_code
+        f_get_code = lambda df_sig_info: get_python_code(df_sig_info, async_=args.async_)
+    elif args.schema:
+        f_get_code = lambda df_sig_info: json.dumps(get_schema(df_sig_info), indent=1)
     else:
-        f_get_code = lambda *args_: get_c_commands_header_code(*(args_ + (args.cpp, )))
+        def f_get_code(df_sig_info):
+            if args.command_processor is not None:
+                args.command_processor.write_text(
+                    get_c_command_processor_header_code(df_sig_info, args.cpp,
+                                                        dispatch=args.dispatch))
+            return get_c_commands_header_code(df_sig_info, args.cpp)
+
+    cpp_headers = [path(header) for header, class_name in args.base] + [args.cpp_header]
+    class_names = [class_name for header, class_name in args.base] + [args.class_name]
 
-    write_code(args.cpp_header, args.class_name, args.out_file, f_get_code)
+    write_code(cpp_headers, class_names, args.out_file, f_get_code,
+               code_map=args.code_map, prune_code_map=args.prune,
+               cache_dir=False if args.no_cache else args.cache_dir,
+               jobs=args.jobs)
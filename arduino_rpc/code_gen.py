@@ -1,12 +1,20 @@
 # coding: utf-8
+from concurrent.futures import ProcessPoolExecutor
+import functools
+import hashlib
+import json
+import os
+import pickle
 import sys
-from typing import Union
+import tempfile
+from typing import Dict, List, Optional, Tuple, Union
 
 from clang_helpers import open_cpp_source, extract_class_declarations
 from clang_helpers.data_frame import get_clang_methods_frame
 from path_helpers import path
 import pandas as pd
 
+from . import __version__
 from .rpc_data_frame import get_struct_sig_info_frame
 
 # Generic messages to prepend to generated source files.
@@ -22,6 +30,284 @@ PYTHON_GENERATED_WARNING_MESSAGE = '''
 # ############################################################################
 '''
 
+# Range of command codes available to methods (higher codes are reserved,
+# e.g., `arduino_rpc.proxy.CMD_BATCH`).
+FIRST_COMMAND_CODE = 0
+LAST_COMMAND_CODE = 0xFFFA
+
+# Version of parse cache entries (increment to invalidate existing entries).
+PARSE_CACHE_VERSION = 1
+
+
+def get_parse_cache_dir() -> path:
+    """
+    Return default directory of the header parse cache, i.e., the
+    `ARDUINO_RPC_CACHE_DIR` environment variable (if set), or
+    `$XDG_CACHE_HOME/arduino_rpc` (`~/.cache/arduino_rpc` by default).
+    """
+    if os.environ.get('ARDUINO_RPC_CACHE_DIR'):
+        return path(os.environ['ARDUINO_RPC_CACHE_DIR'])
+    cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return path(cache_home).joinpath('arduino_rpc')
+
+
+def _file_digest(filepath: str, digests: Optional[dict] = None) -> Optional[str]:
+    """
+    Return SHA-256 digest of file contents (`None` if file is not readable).
+
+    If `digests` is specified, digests are looked up in (and added to) it,
+    i.e., each file is only read and hashed once.
+    """
+    if digests is not None and filepath in digests:
+        return digests[filepath]
+    try:
+        with open(filepath, 'rb') as input_:
+            digest = hashlib.sha256(input_.read()).hexdigest()
+    except OSError:
+        digest = None
+    if digests is not None:
+        digests[filepath] = digest
+    return digest
+
+
+def _parse_cache_key(header: Union[str, path], class_: str, pointer_width: int, args: tuple,
+                     kwargs: dict) -> Optional[str]:
+    """
+    Return parse cache key of a class in a header, i.e., hash of the header
+    path and contents, class name, `pointer_width` and `clang` arguments
+    (`None` if header is not readable).
+
+    Contents of headers included by the header are not part of the key;
+    they are checked against the digests stored in the cache entry (see
+    `get_class_sig_frame`).
+    """
+    digest = _file_digest(header)
+    if digest is None:
+        return None
+    key = [PARSE_CACHE_VERSION, __version__, os.path.abspath(header), digest, class_, pointer_width,
+           [str(arg) for arg in args], repr(sorted(kwargs.items()))]
+    return hashlib.sha256(json.dumps(key).encode('utf8')).hexdigest()
+
+
+def _parse_cache_path(header: Union[str, path], class_: str, pointer_width: int,
+                      cache_dir: Union[str, path, bool, None], args: tuple,
+                      kwargs: dict) -> Optional[path]:
+    """
+    Return path of parse cache entry of a class in a header (`None` if cache
+    is disabled, i.e., `cache_dir` is `False`, or header is not readable).
+    """
+    if cache_dir is None:
+        cache_dir = get_parse_cache_dir()
+    key = _parse_cache_key(header, class_, pointer_width, args, kwargs) if cache_dir else None
+    return None if key is None else path(cache_dir).joinpath(key[:2], key + '.pickle')
+
+
+def _read_parse_cache(filepath: path, digests: Optional[dict] = None) -> Optional[pd.DataFrame]:
+    """
+    Return signature frame from parse cache entry, or `None` if there is no
+    entry, or if any header included when the entry was written has changed.
+
+    Digests of included headers are added to `digests` (if specified), to be
+    reused by `_write_parse_cache` on a cache miss.
+    """
+    try:
+        with open(filepath, 'rb') as input_:
+            entry = pickle.load(input_)
+    except Exception:
+        return None
+    if any(_file_digest(include, digests) != digest for include, digest in entry['includes'].items()):
+        return None
+    return entry['frame']
+
+
+def _write_parse_cache(filepath: path, root, frame: pd.DataFrame,
+                       digests: Optional[dict] = None) -> None:
+    """
+    Write signature frame to parse cache entry, along with the digest of each
+    header included by the translation unit of `root` (reusing digests
+    already computed in `digests`, if specified).
+
+    The entry is written to a temporary file and then renamed, so concurrent
+    builds never read a partially written entry.
+    """
+    try:
+        includes = {include.include.name for include in root.translation_unit.get_includes()}
+    except AttributeError:
+        # Includes are unknown, so entry could not be validated.
+        return
+    entry = {'includes': {include: _file_digest(include, digests) for include in sorted(includes)},
+             'frame': frame}
+    filepath.parent.makedirs(exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=filepath.parent, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as output:
+            pickle.dump(entry, output, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, filepath)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def get_class_sig_frame(header: Union[str, path], class_: str, *args,
+                        pointer_width: int = 16, cache_dir: Union[str, path, bool, None] = None,
+                        **kwargs) -> pd.DataFrame:
+    """
+    Return signature frame (see `get_struct_sig_info_frame`) of methods of a
+    C++ class in a header, with one row per method argument.
+
+    Parsing headers with `libclang` may take several seconds, so frames are
+    cached in `cache_dir`.  Cache entries are keyed on the header contents,
+    class name, `pointer_width` and `clang` arguments, and are only used if
+    none of the headers (transitively) included by the header has changed
+    since the entry was written.
+
+    Arguments
+    ---------
+
+     - `header`: Path to C++ header.
+     - `class_`: C++ class name (including namespace).
+     - `*args`: Extra `clang` arguments (e.g., `-I<include path>`).
+     - `pointer_width`: Pointer width of target device (in bits).
+     - `cache_dir`: Parse cache directory (`get_parse_cache_dir()` by
+       default), or `False` to disable cache.
+     - `**kwargs`: Extra keyword arguments to `open_cpp_source`.
+    """
+    frame, header_class = _read_class_sig_frame(header, class_, pointer_width, cache_dir, args, kwargs)
+    if frame is not None:
+        return frame
+    return _parse_class_sig_frame(header_class, args, pointer_width, kwargs)
+
+
+def _read_class_sig_frame(header: Union[str, path], class_: str, pointer_width: int,
+                          cache_dir: Union[str, path, bool, None], args: tuple,
+                          kwargs: dict) -> Tuple[Optional[pd.DataFrame], tuple]:
+    """
+    Return signature frame of a class in a header from the parse cache
+    (`None` on a cache miss), and the `(header, class_, cache_path, digests)`
+    tuple to parse it with `_parse_class_sig_frame` on a cache miss.
+    """
+    cache_path = _parse_cache_path(header, class_, pointer_width, cache_dir, args, kwargs)
+    digests = {}
+    frame = None if cache_path is None else _read_parse_cache(cache_path, digests)
+    return frame, (header, class_, cache_path, digests)
+
+
+def _parse_class_sig_frame(header_class: tuple, args: tuple, pointer_width: int,
+                           kwargs: dict) -> pd.DataFrame:
+    """
+    Parse signature frame of a class in a header and write it to the parse
+    cache (i.e., on a cache miss of `get_class_sig_frame`).
+
+    `header_class` is a `(header, class_, cache_path, digests)` tuple (e.g.,
+    for `ProcessPoolExecutor.map`), where `cache_path` is the path of the
+    parse cache entry (`None` if cache is disabled) and `digests` holds
+    include digests already computed while reading the entry.
+    """
+    header, class_, cache_path, digests = header_class
+    try:
+        root = open_cpp_source(str(header), *args, **kwargs)
+        node_class = extract_class_declarations(root)[class_]
+    except Exception as exception:
+        # Name the header, e.g., if parsed in a worker process.
+        raise IOError(f'Failed to read class `{class_}` from `{header}`: {exception!r}') from exception
+    df_sig_info = get_clang_methods_frame(node_class, std_types=True)
+    frame = get_struct_sig_info_frame(df_sig_info, pointer_width=pointer_width)
+
+    if cache_path is not None:
+        _write_parse_cache(cache_path, root, frame, digests)
+    return frame
+
+
+def read_code_map(filepath: Union[str, path]) -> Dict[str, int]:
+    """
+    Read command code of each method name from a mapping file written by
+    `write_code_map` (empty if the file does not exist).
+    """
+    filepath = path(filepath)
+    if not filepath.isfile():
+        return {}
+    return {name: int(code, 16) for name, code in json.loads(filepath.text()).items()}
+
+
+def write_code_map(codes: Dict[str, int], filepath: Union[str, path]) -> None:
+    """
+    Write command code of each method name to a mapping file (JSON, ordered by
+    code), e.g., to keep command codes stable between builds (see
+    `allocate_command_codes`).
+    """
+    path(filepath).write_text(json.dumps({name: '0x%02x' % code
+                                          for name, code in sorted(codes.items(), key=lambda item: item[1])},
+                                         indent=1) + '\n')
+
+
+def allocate_command_codes(method_names: List[str], code_map: Optional[Dict[str, int]] = None,
+                           first_code: int = FIRST_COMMAND_CODE, prune: bool = False) -> Dict[str, int]:
+    """
+    Allocate a command code to each method, packed densely from `first_code`.
+
+    Methods in `code_map` (e.g., read from the mapping file of a previous
+    build with `read_code_map`) keep their code.  Other methods are allocated
+    the lowest free codes, in order, so the result only depends on
+    `method_names` and `code_map`.
+
+    Codes of methods in `code_map` which are not in `method_names` (i.e.,
+    removed methods) are *retired*: they are never allocated to other
+    methods (unless `prune` is `True`), so proxies and firmware built before
+    a method was removed never call a different command.
+
+    Arguments
+    ---------
+
+     - `method_names`: Method names, in order (e.g., order of classes, then of
+       methods within each class).
+     - `code_map`: Existing command code of each method name (optional).
+     - `first_code`: First command code to allocate to methods not in
+       `code_map`.
+     - `prune`: If `True`, codes of methods not in `method_names` may be
+       allocated to other methods.
+
+    Returns
+    -------
+
+    dict
+        Command code of each method in `method_names`, along with the retired
+        codes of `code_map` (unless `prune` is `True`), e.g., to write back
+        to the mapping file with `write_code_map`.
+
+    Raises
+    ------
+
+     - `ValueError`: If `code_map` assigns the same code to several methods
+       (i.e., collisions), or a code outside of `FIRST_COMMAND_CODE` to
+       `LAST_COMMAND_CODE`, or there are not enough codes for all methods.
+    """
+    names = set(method_names)
+    codes = {name: code for name, code in (code_map or {}).items() if name in names or not prune}
+    methods_by_code = {}
+    for name, code in codes.items():
+        methods_by_code.setdefault(code, []).append(name)
+    errors = [f'{", ".join(names)} (code 0x{code:02x})' for code, names in sorted(methods_by_code.items())
+              if len(names) > 1]
+    if errors:
+        raise ValueError(f'Command code collisions: {"; ".join(errors)}')
+    invalid = [f'{name} (code 0x{code:02x})' for name, code in codes.items()
+               if not FIRST_COMMAND_CODE <= code <= LAST_COMMAND_CODE]
+    if invalid:
+        raise ValueError(f'Command codes out of range 0x{FIRST_COMMAND_CODE:02x}-0x{LAST_COMMAND_CODE:04x}: '
+                         f'{", ".join(invalid)}')
+    code = max(first_code, FIRST_COMMAND_CODE)
+    for name in method_names:
+        if name in codes:
+            continue
+        while code in methods_by_code:
+            code += 1
+        if code > LAST_COMMAND_CODE:
+            raise ValueError(f'Not enough command codes for {len(method_names)} methods.')
+        codes[name] = code
+        methods_by_code[code] = [name]
+    return codes
+
 
 def get_multilevel_method_sig_frame(cpp_header: Union[str, list],
                                     class_name: Union[str, list],
@@ -47,6 +333,20 @@ def get_multilevel_method_sig_frame(cpp_header: Union[str, list],
        included in the data frame.  The order is determined by the order of the
        headers and classes provided in the `cpp_header` argument and the
        `class_name` argument, respectively.
+     - Command codes (i.e., `method_i`) are packed densely across classes (see
+       `allocate_command_codes`).  If a `code_map` keyword argument is
+       specified, codes are read from (and written back to) the mapping file
+       at that path, so the codes of existing methods are stable between
+       builds (see `read_code_map`).  Codes of methods removed since are
+       kept in the mapping file and never reused, unless the
+       `prune_code_map` keyword argument is `True`.
+     - Signature frames of each class are cached on disk (see
+       `get_class_sig_frame`).  The `cache_dir` keyword argument sets the
+       cache directory (`False` disables the cache).
+     - Headers are parsed in up to `jobs` worker processes if a `jobs`
+       keyword argument is specified (`0` for the number of CPUs).  Frames
+       are merged in the order of the headers regardless, so the *last*
+       occurrence of each method name is still included.
     """
     if isinstance(cpp_header, str):
         cpp_header = [cpp_header]
@@ -57,33 +357,42 @@ def get_multilevel_method_sig_frame(cpp_header: Union[str, list],
     # Default to 16-bit pointer size (i.e., assume 8-bit AVR Arduino by
     # default).
     pointer_width = kwargs.pop('pointer_width', 16)
+    code_map_path = kwargs.pop('code_map', None)
+    prune_code_map = kwargs.pop('prune_code_map', False)
+    cache_dir = kwargs.pop('cache_dir', None)
+    jobs = kwargs.pop('jobs', 1)
+    if not jobs or jobs < 1:
+        jobs = os.cpu_count() or 1
+
+    if jobs > 1 and len(cpp_header) > 1:
+        # Read cached frames first, so only headers which are not cached are
+        # parsed in worker processes.  The cache path and include digests
+        # computed while reading are passed on to the parser, so headers are
+        # not read and hashed again on a cache miss.
+        frames, header_classes = zip(*[_read_class_sig_frame(header, class_, pointer_width, cache_dir, args,
+                                                             kwargs)
+                                       for header, class_ in zip(cpp_header, class_name)])
+        frames = list(frames)
+        pending = [i for i, frame in enumerate(frames) if frame is None]
+        f_parse = functools.partial(_parse_class_sig_frame, args=args, pointer_width=pointer_width,
+                                    kwargs=kwargs)
+        if len(pending) > 1:
+            with ProcessPoolExecutor(max_workers=min(jobs, len(pending))) as executor:
+                # `map` yields results in order of headers, regardless of the
+                # order in which parsing completes.
+                parsed_frames = list(executor.map(f_parse, [header_classes[i] for i in pending]))
+        else:
+            parsed_frames = [f_parse(header_classes[i]) for i in pending]
+        for i, frame in zip(pending, parsed_frames):
+            frames[i] = frame
+    else:
+        frames = [get_class_sig_frame(header, class_, *args, pointer_width=pointer_width, cache_dir=cache_dir,
+                                      **kwargs)
+                  for header, class_ in zip(cpp_header, class_name)]
 
-    frames = []
-    for header, class_ in zip(cpp_header, class_name):
-        try:
-            root = open_cpp_source(str(header), *args, **kwargs)
-        except Exception as e:
-            print(f'[Warning] Failed to  read {header}')
-            # print(e)
-            # from IPython import embed
-            # embed()
-            # raise e
-        class_declarations = extract_class_declarations(root)
-        node_class = class_declarations[class_]
-        from pprint import pprint
-        # for key, value in class_declarations.items():
-        #     if key != class_:
-        #         from clang.cindex import CursorKind
-        #         print([m.displayname for m in value.get_children() if m.kind == CursorKind.CXX_METHOD])
-
-        # ret = get_clang_methods_frame(value, std_types=True)
-        # if ret is not None:
-        #     pprint(ret.method_name.values)
-        df_sig_info = get_clang_methods_frame(node_class, std_types=True)
-        frame = get_struct_sig_info_frame(df_sig_info, pointer_width=pointer_width)
+    for frame, header, class_ in zip(frames, cpp_header, class_name):
         frame['header_name'] = path(header).name
         frame['class_name'] = class_
-        frames.append(frame)
 
     # Method names may occur in multiple headers.  Only process the last occurrence in the table for each method.
     if len(frames) > 1:
@@ -98,9 +407,16 @@ def get_multilevel_method_sig_frame(cpp_header: Union[str, list],
     else:
         df_unique_methods = pd.concat(frames, ignore_index=True)
 
-    class_i = df_unique_methods.class_name.unique()
-    # **N.B.,** Allocate 256 command slots for each class.
-    df_unique_methods.method_i += 0xFF * df_unique_methods.class_name.map(lambda x: (x == class_i).argmax())
+    # Pack command codes densely across classes, in order of classes and of
+    # methods within each class, starting from the first code of the first
+    # class (see `allocate_command_codes`).
+    codes = allocate_command_codes(df_unique_methods.method_name.unique().tolist(),
+                                   read_code_map(code_map_path) if code_map_path else None,
+                                   first_code=int(df_unique_methods.method_i.min()),
+                                   prune=prune_code_map)
+    df_unique_methods.method_i = df_unique_methods.method_name.map(codes)
+    if code_map_path:
+        write_code_map(codes, code_map_path)
     return df_unique_methods
 
 
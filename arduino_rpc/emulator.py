@@ -0,0 +1,378 @@
+# coding: utf-8
+"""
+In-process Python emulation of a device running the generated C++
+`CommandProcessor` and `CommandPacketHandler`.
+
+The emulator decodes command requests exactly like the generated C++ code
+(packed `*Request` structures with array data offsets relative to the start
+of the request structure), calls the corresponding method of a Python object,
+and encodes the result as the packed `*Response` structure.  Combined with
+`EmulatedSerial`, the complete host path of a generated `Proxy` (encode,
+frame, parse, decode) may be exercised without hardware.
+
+Example:
+
+    class Node:
+        def ram_free(self):
+            return 1024
+
+    df_sig_info = get_multilevel_method_sig_frame('Node.h', 'Node')
+    serial = EmulatedSerial(DeviceEmulator(df_sig_info, Node()))
+    proxy = Proxy(serial)
+    proxy.ram_free()
+"""
+import io
+import time
+from typing import Any, List, Optional
+
+import numpy as np
+import pandas as pd
+from nadamq.NadaMq import cPacket, cPacketParser, PACKET_TYPES
+
+from .proxy import (CHUNK_HEADER, CHUNKED_RESPONSE_HEADER, CMD_BATCH,
+                    CMD_CHUNK, CMD_CHUNKED_RESPONSE, RECORD_ERROR,
+                    RECORD_LENGTH, RESPONSE_LENGTH, find_packet)
+from .stream import (CMD_STREAM_START, CMD_STREAM_STOP, STREAM_START,
+                     STREAM_STOP)
+
+
+# Interval (in seconds) at which emulated ports poll streams while waiting
+# for data.
+STREAM_POLL_INTERVAL = 1e-3
+
+
+class _CommandSpec:
+    """
+    Request/response layout of a single command, as generated by
+    `get_c_commands_header_code`.
+    """
+    def __init__(self, df_method_i: pd.DataFrame, pointer_width: int):
+        first = df_method_i.iloc[0]
+        self.method_name = first.method_name
+        fields = []
+        self.args = []
+        if first.arg_count > 0:
+            for i, arg_i in df_method_i.iterrows():
+                if arg_i.ndims > 0:
+                    fields += [(f'{arg_i.arg_name}_length', 'uint32'),
+                               (f'{arg_i.arg_name}_data', f'uint{pointer_width}')]
+                    self.args.append((arg_i.arg_name, np.dtype(arg_i.atom_np_type)))
+                else:
+                    fields.append((arg_i.arg_name, arg_i.atom_np_type))
+                    self.args.append((arg_i.arg_name, None))
+        # Structured dtypes are packed (i.e., no padding), like the
+        # `__attribute__((packed))` request structures.
+        self.request_dtype = np.dtype(fields)
+        self.return_dtype = (np.dtype(first.return_atom_np_type)
+                             if first.return_atom_type is not None else None)
+        self.return_array = bool(first.return_ndims > 0)
+
+
+class DeviceEmulator:
+    """
+    Emulate a device processing command requests with the methods of `obj`.
+
+    Arguments
+    ---------
+
+     - `df_sig_info`: A `pandas.DataFrame` with one row per method argument (as
+       returned by `arduino_rpc.code_gen.get_multilevel_method_sig_frame`).
+     - `obj`: Object implementing a Python method for each method in
+       `df_sig_info`.  Array arguments are passed as `numpy` arrays (views of
+       the request buffer).
+     - `pointer_width`: Pointer size (in bits) of the emulated device (must
+       match the `pointer_width` of the generated `Proxy`).
+     - `packet_size`: Size of the packet buffer of the emulated device.
+     - `max_streams`: Maximum number of concurrent streams (i.e.,
+       `RPC_MAX_STREAMS`, 0 by default, i.e., streaming is disabled).
+     - `stream_buffer_size`: Maximum size of streamed command requests and
+       responses (i.e., `RPC_STREAM_BUFFER_SIZE`).
+     - `chunk_buffer_size`: Maximum size of chunked requests (i.e.,
+       `RPC_CHUNK_BUFFER_SIZE`, 0 by default, i.e., chunked requests are
+       disabled).
+    """
+    def __init__(self, df_sig_info: pd.DataFrame, obj: Any,
+                 pointer_width: int = 16, packet_size: int = 80,
+                 max_streams: int = 0, stream_buffer_size: int = 32,
+                 chunk_buffer_size: int = 0):
+        self.obj = obj
+        self.packet_size = packet_size
+        self.chunk_buffer_size = chunk_buffer_size
+        # Chunked request reassembled so far.
+        self._chunks = bytearray()
+        self.max_streams = max_streams
+        self.stream_buffer_size = stream_buffer_size
+        # Active streams: `[interval_ms, last_ms, request]` by identifier.
+        self.streams = {}
+        self.commands = {int(method_i): _CommandSpec(df_method_i, pointer_width)
+                         for method_i, df_method_i in
+                         df_sig_info.groupby('method_i', sort=False)}
+
+    def process_command(self, request: memoryview) -> Optional[bytes]:
+        """
+        Process serialized command request (i.e., command code followed by
+        `*Request` structure) and return serialized `*Response` structure.
+
+        Return `None` if the command code is unknown, like the `default` case
+        of the generated `CommandProcessor::process_command`.
+        """
+        command = int.from_bytes(request[:2], 'little')
+        spec = self.commands.get(command)
+        if spec is None:
+            return None
+        request = request[2:]
+        args = []
+        if spec.args:
+            struct = np.frombuffer(request, dtype=spec.request_dtype, count=1)[0]
+            for name, atom_dtype in spec.args:
+                if atom_dtype is None:
+                    args.append(struct[name])
+                else:
+                    # Array data offset is relative to start of request
+                    # structure.
+                    args.append(np.frombuffer(request, dtype=atom_dtype,
+                                              count=int(struct[name + '_length']),
+                                              offset=int(struct[name + '_data'])))
+        result = getattr(self.obj, spec.method_name)(*args)
+        if spec.return_dtype is None:
+            return b''
+        elif spec.return_array:
+            return np.ascontiguousarray(result, dtype=spec.return_dtype).tobytes()
+        return np.array(result, dtype=spec.return_dtype).tobytes()
+
+    def process_batch(self, payload: memoryview) -> bytes:
+        """
+        Process batch request like `process_batch_with_processor`, including
+        stopping early if a response would overwrite a request that has not
+        been processed yet.
+        """
+        requests_length = len(payload) - RECORD_LENGTH.size
+        read_offset = self.packet_size - requests_length
+        write_offset = 0
+        offset = RECORD_LENGTH.size
+        output = bytearray()
+        while offset + RECORD_LENGTH.size <= len(payload):
+            record_length, = RECORD_LENGTH.unpack_from(payload, offset)
+            offset += RECORD_LENGTH.size
+            read_offset += RECORD_LENGTH.size
+            if (record_length < RECORD_LENGTH.size or
+                    offset + record_length > len(payload)):
+                break
+            result = self.process_command(payload[offset:offset + record_length])
+            offset += record_length
+            read_offset += record_length
+            if result is None:
+                output += RECORD_LENGTH.pack(RECORD_ERROR)
+            elif len(result) > read_offset - write_offset - RECORD_LENGTH.size:
+                break
+            else:
+                output += RECORD_LENGTH.pack(len(result)) + result
+            write_offset = len(output)
+        return bytes(output)
+
+    def process_chunk(self, payload: memoryview) -> Optional[bytes]:
+        """
+        Process fragment of a chunked request, like
+        `CommandPacketHandler::process_chunk`.
+        """
+        if len(payload) < CHUNK_HEADER.size:
+            return None
+        _, offset, total_length = CHUNK_HEADER.unpack_from(payload)
+        data = payload[CHUNK_HEADER.size:]
+        if offset == 0:
+            self._chunks.clear()
+        if (offset != len(self._chunks) or
+                total_length > self.chunk_buffer_size or
+                offset + len(data) > total_length):
+            self._chunks.clear()
+            return None
+        self._chunks += data
+        if len(self._chunks) < total_length:
+            return b''
+        request = bytes(self._chunks)
+        self._chunks.clear()
+        return self.process_command(memoryview(request))
+
+    def process_stream_command(self, payload: memoryview) -> Optional[bytes]:
+        """
+        Start or stop a stream, like
+        `CommandPacketHandler::process_stream_command`.
+
+        Start and stop requests are rejected if streams are disabled (i.e.,
+        `max_streams` is 0).
+        """
+        if not self.max_streams or len(payload) < STREAM_STOP.size:
+            return None
+        command, stream_id = STREAM_STOP.unpack_from(payload)
+        if command == CMD_STREAM_STOP:
+            self.streams.pop(stream_id, None)
+            return b''
+        request = bytes(payload[STREAM_START.size:])
+        # Invalid requests leave an existing stream with the same identifier
+        # running.
+        if (stream_id == 0 or not request or
+                len(request) > self.stream_buffer_size or
+                (stream_id not in self.streams and
+                 len(self.streams) >= self.max_streams)):
+            return None
+        _, _, interval_ms = STREAM_START.unpack_from(payload)
+        self.streams[stream_id] = [interval_ms, None, request]
+        return b''
+
+    def poll_streams(self, now_ms: int) -> List[cPacket]:
+        """
+        Process the request of each stream that is due and return the
+        results as stream packets, like `CommandPacketHandler::poll_streams`.
+        """
+        packets = []
+        for stream_id, stream in list(self.streams.items()):
+            interval_ms, last_ms, request = stream
+            if last_ms is not None and now_ms - last_ms < interval_ms:
+                continue
+            stream[1] = now_ms
+            result = self.process_command(memoryview(request))
+            if result is None or len(result) > self.stream_buffer_size:
+                del self.streams[stream_id]
+                continue
+            packets.append(cPacket(iuid=stream_id, data=result,
+                                   type_=PACKET_TYPES.STREAM))
+        return packets
+
+    def process_chunked_response(self, packet) -> List[cPacket]:
+        """
+        Process command and return its result as a sequence of packets, like
+        `CommandPacketHandler::process_chunked_response`.
+        """
+        payload = memoryview(packet.data())
+        result = None
+        if len(payload) > CHUNKED_RESPONSE_HEADER.size:
+            _, chunk_size = CHUNKED_RESPONSE_HEADER.unpack_from(payload)
+            result = self.process_command(
+                payload[CHUNKED_RESPONSE_HEADER.size:])
+        if result is None:
+            return [cPacket(iuid=packet.iuid, type_=PACKET_TYPES.NACK)]
+        chunk_size = chunk_size or 0xFFFF
+        return [cPacket(iuid=packet.iuid, type_=PACKET_TYPES.DATA,
+                        data=RESPONSE_LENGTH.pack(len(result)))] + \
+            [cPacket(iuid=packet.iuid, type_=PACKET_TYPES.DATA,
+                     data=result[offset:offset + chunk_size])
+             for offset in range(0, len(result), chunk_size)]
+
+    def process_request(self, packet) -> List[cPacket]:
+        """
+        Process request packet and return the response packets (i.e., a
+        single packet, unless a chunked response was requested).
+        """
+        payload = packet.data()
+        if (packet.type_ == PACKET_TYPES.DATA and
+                payload[:RECORD_LENGTH.size] ==
+                RECORD_LENGTH.pack(CMD_CHUNKED_RESPONSE)):
+            return self.process_chunked_response(packet)
+        return [self.process_packet(packet)]
+
+    def process_packet(self, packet) -> cPacket:
+        """
+        Process request packet and return response packet, like
+        `CommandPacketHandler::process_packet`.
+        """
+        result = None
+        payload = memoryview(packet.data())
+        if packet.type_ == PACKET_TYPES.DATA and len(payload) > 0:
+            command = (RECORD_LENGTH.unpack_from(payload)[0]
+                       if len(payload) >= RECORD_LENGTH.size else None)
+            if command == CMD_BATCH:
+                result = self.process_batch(payload)
+            elif command == CMD_CHUNK:
+                result = self.process_chunk(payload)
+            elif command in (CMD_STREAM_START, CMD_STREAM_STOP):
+                result = self.process_stream_command(payload)
+            else:
+                result = self.process_command(payload)
+        if result is None:
+            response = cPacket(iuid=packet.iuid, type_=PACKET_TYPES.NACK)
+        else:
+            response = cPacket(iuid=packet.iuid, data=result,
+                               type_=PACKET_TYPES.DATA)
+        return response
+
+
+class EmulatedSerial:
+    """
+    File-like serial port connected to a `DeviceEmulator`.
+
+    Each request packet written to the port is processed immediately and the
+    response is buffered for reading, so the proxy measures host-side
+    overhead only.  Reads of an empty buffer wait up to `timeout` seconds
+    (`0` returns immediately) for stream results, like `serial.Serial`.
+    """
+    def __init__(self, emulator: DeviceEmulator, timeout: Optional[float] = 0):
+        self.emulator = emulator
+        self.timeout = timeout
+        self._parser = cPacketParser()
+        self._requests = bytearray()
+        self._responses = bytearray()
+
+    def fileno(self):
+        raise io.UnsupportedOperation('Emulated port has no file descriptor.')
+
+    def _poll_streams(self) -> None:
+        if self.emulator.streams:
+            for packet in self.emulator.poll_streams(int(time.monotonic() *
+                                                         1e3)):
+                self._responses += packet.tostring()
+
+    @property
+    def in_waiting(self) -> int:
+        self._poll_streams()
+        return len(self._responses)
+
+    def write(self, data) -> int:
+        self._requests += data
+        while True:
+            start, end = find_packet(self._requests)
+            if end is None:
+                del self._requests[:start]
+                break
+            self._parser.reset()
+            packet = self._parser.parse(memoryview(self._requests)[start:end])
+            if self._parser.message_completed:
+                for response in self.emulator.process_request(packet):
+                    self._responses += response.tostring()
+            del self._requests[:end]
+        return len(data)
+
+    def _wait(self) -> None:
+        """
+        Wait up to `timeout` seconds for the next result of a stream, if no
+        response is buffered.
+
+        Responses to requests are buffered as soon as the request is written,
+        so if no stream is active, no data may arrive while waiting.
+        """
+        end = None if self.timeout is None else time.monotonic() + self.timeout
+        while not self._responses:
+            remaining = None if end is None else end - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                break
+            if not self.emulator.streams:
+                if remaining is not None:
+                    time.sleep(remaining)
+                break
+            time.sleep(STREAM_POLL_INTERVAL if remaining is None else
+                       min(remaining, STREAM_POLL_INTERVAL))
+            self._poll_streams()
+
+    def readinto(self, buffer) -> int:
+        self._poll_streams()
+        self._wait()
+        count = min(len(buffer), len(self._responses))
+        buffer[:count] = self._responses[:count]
+        del self._responses[:count]
+        return count
+
+    def read(self, size: int = 1) -> bytes:
+        buffer = bytearray(size)
+        return bytes(buffer[:self.readinto(buffer)])
+
+    def close(self) -> None:
+        pass
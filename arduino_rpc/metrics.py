@@ -0,0 +1,224 @@
+# coding: utf-8
+"""
+Opt-in instrumentation of proxy calls.
+
+When `metrics` of a proxy is set (see `ProxyBase.enable_metrics`), each call
+records, per command code:
+
+ - call count, error count, request and response bytes,
+ - latency histograms of each phase of the call (see `PHASES`).
+
+The histograms use log-linear buckets (like HdrHistogram), so recording is
+O(1), memory is bounded, and reported percentiles are within 0.8% of the true
+values across the full range of latencies (ns to hours).
+
+When `metrics` is `None` (the default), the cost per call is a single
+attribute check.
+
+Example:
+
+    metrics = proxy.enable_metrics()
+    ...
+    print(metrics.snapshot()['add']['phases']['first_byte']['p99'])
+    print(metrics.prometheus())
+"""
+from typing import Dict, List, Optional
+
+# Phases of a call, in order:
+#
+#  - `encode`: Generated method called until request packet built.
+#  - `write`: Request written to transport.
+#  - `first_byte`: Request written until first reply byte received.
+#  - `parse`: First reply byte received until reply packet parsed.
+#  - `decode`: Reply packet parsed until result decoded.
+PHASES = ('encode', 'write', 'first_byte', 'parse', 'decode')
+# Quantiles reported in snapshots and Prometheus summaries.
+QUANTILES = (0.5, 0.9, 0.99, 0.999)
+
+# Number of bits of sub-bucket resolution (i.e., buckets cover at most
+# 2 ** -(SUB_BUCKET_BITS - 1) = 2 ** -7 < 0.8% of their values).
+SUB_BUCKET_BITS = 8
+SUB_BUCKET_COUNT = 1 << SUB_BUCKET_BITS
+SUB_BUCKET_HALF = SUB_BUCKET_COUNT >> 1
+
+
+class LatencyHistogram:
+    """
+    Histogram of latencies (in nanoseconds) with log-linear buckets.
+
+    Values below `SUB_BUCKET_COUNT` are recorded exactly; larger values are
+    recorded in buckets covering `2 ** -(SUB_BUCKET_BITS - 1)` of their
+    magnitude.
+    """
+    __slots__ = ('counts', 'count', 'total', 'min', 'max')
+
+    def __init__(self):
+        self.counts = [0] * ((64 - SUB_BUCKET_BITS + 2) * SUB_BUCKET_HALF)
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = 0
+
+    @staticmethod
+    def bucket_index(value: int) -> int:
+        if value < SUB_BUCKET_COUNT:
+            return value
+        shift = value.bit_length() - SUB_BUCKET_BITS
+        return (shift << (SUB_BUCKET_BITS - 1)) + (value >> shift)
+
+    @staticmethod
+    def bucket_value(index: int) -> int:
+        """
+        Return highest value recorded in bucket `index`.
+        """
+        if index < SUB_BUCKET_COUNT:
+            return index
+        shift = (index >> (SUB_BUCKET_BITS - 1)) - 1
+        return ((index - (shift << (SUB_BUCKET_BITS - 1)) + 1) << shift) - 1
+
+    def record(self, value: int) -> None:
+        value = max(int(value), 0)
+        self.counts[self.bucket_index(value)] += 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, quantile: float) -> int:
+        """
+        Return value (in nanoseconds) at `quantile` (e.g., 0.99), or 0 if no
+        values were recorded.
+        """
+        if not self.count:
+            return 0
+        target = max(1, int(round(quantile * self.count)))
+        cumulative = 0
+        for index, count in enumerate(self.counts):
+            cumulative += count
+            if cumulative >= target:
+                return min(self.bucket_value(index), self.max)
+        return self.max
+
+    def snapshot(self) -> Dict[str, float]:
+        """
+        Return summary of recorded values (in nanoseconds).
+        """
+        summary = {'count': self.count, 'sum': self.total,
+                   'min': self.min or 0, 'max': self.max,
+                   'mean': self.total / self.count if self.count else 0}
+        summary.update((_quantile_key(quantile), self.percentile(quantile))
+                       for quantile in QUANTILES)
+        return summary
+
+
+def _quantile_key(quantile: float) -> str:
+    # For example, 0.5 -> 'p50', 0.999 -> 'p999'.
+    return 'p' + ('%g' % (quantile * 100)).replace('.', '')
+
+
+class CommandMetrics:
+    """
+    Counters and phase latency histograms of a single command.
+    """
+    __slots__ = ('calls', 'errors', 'request_bytes', 'response_bytes',
+                 'phases')
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.request_bytes = 0
+        self.response_bytes = 0
+        self.phases = {phase: LatencyHistogram() for phase in PHASES}
+
+    def snapshot(self) -> dict:
+        return {'calls': self.calls, 'errors': self.errors,
+                'request_bytes': self.request_bytes,
+                'response_bytes': self.response_bytes,
+                'phases': {phase: histogram.snapshot()
+                           for phase, histogram in self.phases.items()
+                           if histogram.count}}
+
+
+class Metrics:
+    """
+    Metrics of each command called through a proxy.
+
+    Arguments
+    ---------
+
+     - `names`: Mapping from command code to command name, used to label
+       commands in snapshots (optional, unknown codes are labelled in hex).
+    """
+    def __init__(self, names: Optional[Dict[int, str]] = None):
+        self.names = dict(names or {})
+        self.commands = {}
+
+    def command(self, code: int) -> CommandMetrics:
+        """
+        Return metrics of command `code`, created on first use.
+        """
+        metrics = self.commands.get(code)
+        if metrics is None:
+            metrics = self.commands[code] = CommandMetrics()
+        return metrics
+
+    def name(self, code: int) -> str:
+        return self.names.get(code, '0x%04x' % code)
+
+    def reset(self) -> None:
+        self.commands.clear()
+
+    def snapshot(self) -> Dict[str, dict]:
+        """
+        Return metrics of each command, keyed by command name.
+
+        Latencies are in nanoseconds.
+        """
+        return {self.name(code): metrics.snapshot()
+                for code, metrics in sorted(self.commands.items())}
+
+    def prometheus(self, prefix: str = 'arduino_rpc') -> str:
+        """
+        Return metrics in the Prometheus text exposition format.
+
+        Counters are labelled by `command`; phase latencies (in seconds) are
+        exported as a summary labelled by `command` and `phase`.
+        """
+        lines: List[str] = []
+        counters = (('calls', 'Number of calls.'),
+                    ('errors', 'Number of failed calls.'),
+                    ('request_bytes', 'Request payload bytes sent.'),
+                    ('response_bytes', 'Response payload bytes received.'))
+        commands = sorted(self.commands.items())
+        for attribute, help_ in counters:
+            metric = f'{prefix}_{attribute}_total'
+            lines += [f'# HELP {metric} {help_}', f'# TYPE {metric} counter']
+            lines += [f'{metric}{{command="{self.name(code)}"}} '
+                      f'{getattr(metrics, attribute)}'
+                      for code, metrics in commands]
+        metric = f'{prefix}_phase_seconds'
+        lines += [f'# HELP {metric} Latency of each phase of a call.',
+                  f'# TYPE {metric} summary']
+        for code, metrics in commands:
+            for phase, histogram in metrics.phases.items():
+                if not histogram.count:
+                    continue
+                labels = f'command="{self.name(code)}",phase="{phase}"'
+                lines += [f'{metric}{{{labels},quantile="{quantile}"}} '
+                          f'{histogram.percentile(quantile) * 1e-9:.9g}'
+                          for quantile in QUANTILES]
+                lines += [f'{metric}_sum{{{labels}}} '
+                          f'{histogram.total * 1e-9:.9g}',
+                          f'{metric}_count{{{labels}}} {histogram.count}']
+        return '\n'.join(lines) + '\n'
+
+
+def command_names(proxy_class: type) -> Dict[int, str]:
+    """
+    Return mapping from command code to method name of a generated `Proxy`
+    class (i.e., from the `_CMD_*` class attributes).
+    """
+    return {getattr(proxy_class, name): name[len('_CMD_'):].lower()
+            for name in dir(proxy_class) if name.startswith('_CMD_')}
@@ -0,0 +1,327 @@
+# coding: utf-8
+"""
+Native-code device emulation: compile the generated `CommandProcessor` (and
+the `CommandPacketHandler` from the Arduino library) for the host as a shared
+library, and connect a `Proxy` to it through an in-memory serial port.
+
+Request dispatch, request structure layout and array data offset fixups are
+then exercised with the *actual* generated C++ code at native speed, without
+a device in the loop.
+
+Example:
+
+    df_sig_info = get_multilevel_method_sig_frame('Node.h', 'Node',
+                                                  pointer_width=64)
+    library = build_native_emulator(df_sig_info, 'Node.h', 'Node', 'build')
+    proxy = Proxy(NativeEmulatedSerial(library))
+
+.. note::
+    The generated `Proxy` and signature frame must use the pointer width of
+    the host compiler (e.g., `pointer_width=64` on x86-64 Linux, or
+    `pointer_width=32` with `-m32`), and the header declaring the wrapped
+    class must compile for the host (i.e., without `Arduino.h`).
+"""
+import ctypes
+import subprocess
+import sys
+import time
+from typing import List, Optional, Union
+
+import jinja2
+import nadamq
+import pandas as pd
+from path_helpers import path
+
+from .emulator import STREAM_POLL_INTERVAL
+from . import get_includes, get_library_directory
+from .rpc_data_frame import (get_c_command_processor_header_code,
+                             get_c_commands_header_code)
+
+
+def get_native_emulator_code(obj_header: str, obj_class: str, namespace: str,
+                             packet_size: int = 80, pointer_width: int = 64) -> str:
+    """
+    Generate C++ source of a shared library wrapping an instance of
+    `obj_class` in the generated `CommandProcessor` and the
+    `CommandPacketHandler`, writing response packets to an in-memory stream
+    (i.e., the `OStream`).
+
+    The library exports the following C functions:
+
+     - `rpc_create()`/`rpc_destroy(device)`: Allocate/free emulated device.
+     - `rpc_write(device, data, length)`: Parse request bytes, processing
+       each complete packet.  Returns number of response bytes available.
+     - `rpc_read(device, data, length)`: Read up to `length` response bytes.
+     - `rpc_poll_streams(device, now_ms)`: Call
+       `CommandPacketHandler::poll_streams`.  Returns number of response
+       bytes available.
+     - `rpc_process_command(device, request, length, output, output_length)`:
+       Call `CommandProcessor::process_command` directly (no framing) and
+       copy the response to `output`.  Returns response length, or -1 if the
+       command failed.
+    """
+    template = jinja2.Template(r'''
+#include <stdint.h>
+#include <string.h>
+#include <sstream>
+
+#ifndef PACKET_SIZE
+#define PACKET_SIZE {{ packet_size }}
+#endif
+
+#include <PacketParser.h>
+#include "{{ obj_header }}"
+#include "Commands.h"
+#include "CommandProcessor.h"
+#include <ArduinoRpc/CommandPacketHandler.h>
+
+static_assert(sizeof(UInt8Array) == sizeof(uint32_t) + {{ pointer_width // 8 }},
+              "`*Array` structure size does not match `pointer_width` used to "
+              "generate the host code.");
+
+typedef {{ namespace }}::CommandProcessor<{{ obj_class }}> processor_t;
+typedef CommandPacketHandler<std::stringstream, processor_t> handler_t;
+
+
+struct NativeDevice {
+  {{ obj_class }} obj;
+  processor_t processor;
+  std::stringstream output;
+  handler_t handler;
+  PacketParser<FixedPacket> parser;
+  FixedPacket packet;
+  uint8_t buffer[PACKET_SIZE];
+
+  NativeDevice() : processor(obj), handler(output, processor) {
+    packet.reset_buffer(sizeof(buffer), buffer);
+    parser.reset(&packet);
+  }
+
+  size_t available() {
+    return static_cast<size_t>(output.tellp() - output.tellg());
+  }
+};
+
+
+extern "C" {
+
+void *rpc_create() { return new NativeDevice(); }
+
+void rpc_destroy(void *device) { delete static_cast<NativeDevice *>(device); }
+
+size_t rpc_write(void *device_, uint8_t *data, size_t length) {
+  NativeDevice &device = *static_cast<NativeDevice *>(device_);
+  for (size_t i = 0; i < length; i++) {
+    device.parser.parse_byte(&data[i]);
+    if (device.parser.message_completed_) {
+      device.handler.process_packet(device.packet);
+      device.packet.reset_buffer(sizeof(device.buffer), device.buffer);
+      device.parser.reset(&device.packet);
+    } else if (device.parser.parse_error_) {
+      device.parser.reset(&device.packet);
+    }
+  }
+  return device.available();
+}
+
+size_t rpc_read(void *device_, uint8_t *data, size_t length) {
+  NativeDevice &device = *static_cast<NativeDevice *>(device_);
+  device.output.read(reinterpret_cast<char *>(data), length);
+  size_t count = device.output.gcount();
+  if (device.available() == 0) {
+    /* All output consumed, so release stream contents. */
+    device.output.str("");
+    device.output.clear();
+  }
+  return count;
+}
+
+size_t rpc_poll_streams(void *device_, uint32_t now_ms) {
+  NativeDevice &device = *static_cast<NativeDevice *>(device_);
+  device.handler.poll_streams(now_ms);
+  return device.available();
+}
+
+size_t rpc_buffer_size(void *device_) {
+  return sizeof(static_cast<NativeDevice *>(device_)->buffer);
+}
+
+int32_t rpc_process_command(void *device_, uint8_t *request, uint16_t length,
+                            uint8_t *output, uint16_t output_length) {
+  NativeDevice &device = *static_cast<NativeDevice *>(device_);
+  if (length > sizeof(device.buffer)) { return -1; }
+  UInt8Array request_arr;
+  request_arr.data = device.buffer;
+  request_arr.length = length;
+  memcpy(device.buffer, request, length);
+  UInt8Array buffer;
+  buffer.data = device.buffer;
+  buffer.length = sizeof(device.buffer);
+  UInt8Array result = device.processor.process_command(request_arr, buffer);
+  if (result.data == NULL || result.length > output_length) { return -1; }
+  memcpy(output, result.data, result.length);
+  return result.length;
+}
+
+}  // extern "C"
+'''.strip())
+    return template.render(obj_header=obj_header, obj_class=obj_class,
+                           namespace=namespace, packet_size=packet_size,
+                           pointer_width=pointer_width)
+
+
+def build_native_emulator(df_sig_info: pd.DataFrame, obj_header: Union[str, path],
+                          obj_class: str, output_dir: Union[str, path],
+                          namespace: str = 'native', packet_size: int = 80,
+                          pointer_width: int = 64, compiler: str = 'g++',
+                          cxxflags: Optional[List[str]] = None,
+                          dispatch: str = 'switch') -> path:
+    """
+    Generate `Commands.h`, `CommandProcessor.h` and the native emulator
+    source (see `get_native_emulator_code`) in `output_dir` and compile them,
+    along with the `nadamq` sources, as a shared library.
+
+    Arguments
+    ---------
+
+     - `df_sig_info`: A `pandas.DataFrame` with one row per method argument (as
+       returned by `arduino_rpc.code_gen.get_multilevel_method_sig_frame`).
+     - `obj_header`: Header declaring `obj_class` (must compile for the host).
+     - `obj_class`: C++ class wrapped by the `CommandProcessor`.
+     - `output_dir`: Directory to write generated sources and library to.
+     - `pointer_width`: Pointer size (in bits) of the host target (e.g., 32 if
+       `-m32` is included in `cxxflags`).
+     - `cxxflags`: Extra compiler flags (default: `['-O2']`), e.g.,
+       `-DRPC_MAX_STREAMS=2` to enable streams (see `CommandPacketHandler.h`).
+     - `dispatch`: Command dispatch of the `CommandProcessor` (see
+       `get_c_command_processor_header_code`).
+
+    Returns
+    -------
+    path_helpers.path
+        Path to compiled shared library.
+    """
+    output_dir = path(output_dir).abspath()
+    output_dir.makedirs(exist_ok=True)
+    obj_header = path(obj_header).abspath()
+
+    output_dir.joinpath('Commands.h').write_text(
+        get_c_commands_header_code(df_sig_info, namespace))
+    output_dir.joinpath('CommandProcessor.h').write_text(
+        get_c_command_processor_header_code(df_sig_info, namespace,
+                                            dispatch=dispatch))
+    source = output_dir.joinpath('native_emulator.cpp')
+    source.write_text(get_native_emulator_code(obj_header, obj_class, namespace,
+                                               packet_size=packet_size,
+                                               pointer_width=pointer_width))
+    library = output_dir.joinpath('native_emulator' +
+                                  ('.dll' if sys.platform == 'win32' else '.so'))
+
+    include_dirs = ([output_dir, obj_header.parent] + nadamq.get_includes() +
+                    list(get_library_directory().walkdirs('src')) + get_includes())
+    command = ([compiler, '-std=c++11', '-shared', '-fPIC', '-o', library] +
+               (['-O2'] if cxxflags is None else list(cxxflags)) +
+               [f'-I{include_dir}' for include_dir in include_dirs] +
+               [source] + nadamq.get_sources())
+    subprocess.check_call([str(arg) for arg in command])
+    print(f"Generated '{library.name}' > {library}")
+    return library
+
+
+class NativeEmulatedSerial:
+    """
+    File-like serial port connected to an emulated device compiled with
+    `build_native_emulator`.
+
+    Each request packet written to the port is processed immediately by the
+    native code and the response is buffered for reading.  Reads of an empty
+    buffer wait up to `timeout` seconds (`0` returns immediately) for stream
+    results, like `serial.Serial`.
+    """
+    def __init__(self, library: Union[str, path], timeout: Optional[float] = 0):
+        self.library = ctypes.CDLL(str(library))
+        self.library.rpc_create.restype = ctypes.c_void_p
+        self.library.rpc_destroy.argtypes = [ctypes.c_void_p]
+        for name in ('rpc_write', 'rpc_read'):
+            function = getattr(self.library, name)
+            function.argtypes = [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_size_t]
+            function.restype = ctypes.c_size_t
+        self.library.rpc_process_command.argtypes = [ctypes.c_void_p,
+                                                     ctypes.c_char_p,
+                                                     ctypes.c_uint16,
+                                                     ctypes.c_void_p,
+                                                     ctypes.c_uint16]
+        self.library.rpc_process_command.restype = ctypes.c_int32
+        self.library.rpc_poll_streams.argtypes = [ctypes.c_void_p,
+                                                  ctypes.c_uint32]
+        self.library.rpc_poll_streams.restype = ctypes.c_size_t
+        self.library.rpc_buffer_size.argtypes = [ctypes.c_void_p]
+        self.library.rpc_buffer_size.restype = ctypes.c_size_t
+        self.timeout = timeout
+        self._device = self.library.rpc_create()
+        # Size of the packet buffer of the device.
+        self.buffer_size = self.library.rpc_buffer_size(self._device)
+        self.in_waiting = 0
+
+    def fileno(self):
+        import io
+
+        raise io.UnsupportedOperation('Emulated port has no file descriptor.')
+
+    def write(self, data) -> int:
+        data = bytes(data)
+        self.in_waiting = self.library.rpc_write(self._device, data, len(data))
+        return len(data)
+
+    def poll_streams(self) -> None:
+        """
+        Emulate an iteration of the main loop of the device, i.e., send the
+        results of streams that are due.
+        """
+        now_ms = int(time.monotonic() * 1e3) & 0xFFFFFFFF
+        self.in_waiting = self.library.rpc_poll_streams(self._device, now_ms)
+
+    def readinto(self, buffer) -> int:
+        self.poll_streams()
+        # Wait up to `timeout` seconds for the next result of a stream.
+        end = None if self.timeout is None else time.monotonic() + self.timeout
+        while not self.in_waiting:
+            remaining = None if end is None else end - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                break
+            time.sleep(STREAM_POLL_INTERVAL if remaining is None else
+                       min(remaining, STREAM_POLL_INTERVAL))
+            self.poll_streams()
+        count = min(len(buffer), self.in_waiting)
+        if count:
+            target = (ctypes.c_char * count).from_buffer(buffer)
+            count = self.library.rpc_read(self._device, target, count)
+            self.in_waiting -= count
+        return count
+
+    def read(self, size: int = 1) -> bytes:
+        buffer = bytearray(size)
+        return bytes(buffer[:self.readinto(buffer)])
+
+    def process_command(self, request: bytes, output: bytearray) -> int:
+        """
+        Process serialized command request directly (no packet framing) and
+        write the response to `output`.
+
+        Returns
+        -------
+        int
+            Response length, or -1 if the command failed (or the request is
+            larger than the packet buffer of the device).
+        """
+        if len(request) > self.buffer_size:
+            return -1
+        target = (ctypes.c_char * len(output)).from_buffer(output)
+        return self.library.rpc_process_command(self._device, request,
+                                                len(request), target,
+                                                len(output))
+
+    def close(self) -> None:
+        if self._device is not None:
+            self.library.rpc_destroy(self._device)
+            self._device = None
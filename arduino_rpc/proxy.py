@@ -1,21 +1,1611 @@
 # coding: utf-8
+import queue
+import struct
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import Sequence
+from concurrent.futures import Future
+from contextlib import contextmanager, nullcontext
+from functools import partial
+from time import perf_counter_ns
+from typing import List, Optional, Tuple
+
 import numpy as np
-from nadamq.NadaMq import cPacketParser
+from nadamq.NadaMq import (cPacket, cPacketParser, crc_finalize, crc_init,
+                          crc_update, PACKET_TYPES)
+
+from .metrics import CommandMetrics, Metrics, command_names
+from .transport import Transport, as_transport
+
+# Packet start flag, followed by interface unique identifier (2 bytes) and
+# packet type (1 byte).  `DATA` and `STREAM` packets are followed by the
+# payload length (2 bytes), the payload, and a CRC checksum (2 bytes).
+START_FLAG = b'|||'
+HEADER_SIZE = len(START_FLAG) + 3
+LENGTH_SIZE = 2
+CRC_SIZE = 2
+# Header of `DATA` (and `STREAM`) packets, i.e., start flag, identifier, type
+# and payload length (big-endian), and checksum.
+FRAME_HEADER = struct.Struct('>3sHBH')
+FRAME_CRC = struct.Struct('>H')
+PAYLOAD_PACKET_TYPES = (PACKET_TYPES.DATA, PACKET_TYPES.STREAM)
+# Types of packets sent by `CommandPacketHandler` (the header has no
+# checksum, so a packet of any other type is corrupted).
+REPLY_PACKET_TYPES = PAYLOAD_PACKET_TYPES + (PACKET_TYPES.ACK,
+                                             PACKET_TYPES.NACK)
+
+# Reserved command code of a batch request (see `ProxyBase.batch`).
+CMD_BATCH = 0xFFFF
+# Length prefix of each record in a batch request/response.
+RECORD_LENGTH = struct.Struct('<H')
+# Record length in a batch response marking a failed command.
+RECORD_ERROR = 0xFFFF
+# Reserved command code of a fragment of a request too large for a single
+# packet, followed by the offset of the fragment and the total length of the
+# request (see `ProxyBase._send_chunked`).
+CMD_CHUNK = 0xFFFC
+CHUNK_HEADER = struct.Struct('<HHH')
+# Reserved command code of a request for the result of a command to be sent
+# in several packets, followed by the maximum chunk size.  The device replies
+# with the total length of the result, followed by the chunks (see
+# `ProxyBase.iter_chunks`).
+CMD_CHUNKED_RESPONSE = 0xFFFB
+CHUNKED_RESPONSE_HEADER = struct.Struct('<HH')
+RESPONSE_LENGTH = struct.Struct('<I')
+
+
+class CommandTimeoutError(TimeoutError):
+    """
+    Raised when the reply to a command is not received before its deadline.
+    """
+
+
+class FramingError(IOError):
+    """
+    Raised when a corrupted packet (e.g., checksum mismatch) is received.
+
+    `iuid` is the identifier in the header of the corrupted packet (which may
+    itself be corrupted).
+    """
+    def __init__(self, message: str, iuid: Optional[int] = None):
+        super().__init__(message)
+        self.iuid = iuid
+
+
+def frame_iuid(data: bytearray, start: int, end: int) -> Optional[int]:
+    """
+    Return identifier in the header of the packet frame starting at `start`,
+    or `None` if the header is incomplete.
+    """
+    if end - start < HEADER_SIZE:
+        return None
+    return int.from_bytes(data[start + len(START_FLAG):
+                               start + HEADER_SIZE - 1], 'big')
+
+
+def frame_size(data: bytearray, start: int, end: int) -> Optional[int]:
+    """
+    Return size of the packet frame starting at `start` declared by its
+    header (i.e., including the payload length), or `None` if the header is
+    incomplete.
+    """
+    if end - start < HEADER_SIZE:
+        return None
+    if data[start + HEADER_SIZE - 1] not in PAYLOAD_PACKET_TYPES:
+        return HEADER_SIZE
+    if end - start < HEADER_SIZE + LENGTH_SIZE:
+        return None
+    payload_length = int.from_bytes(data[start + HEADER_SIZE:
+                                         start + HEADER_SIZE + LENGTH_SIZE],
+                                    'big')
+    return HEADER_SIZE + LENGTH_SIZE + payload_length + CRC_SIZE
+
+
+def _earliest(*deadlines: Optional[float]) -> Optional[float]:
+    """
+    Return earliest of the specified deadlines, ignoring `None`.
+    """
+    deadlines = [d for d in deadlines if d is not None]
+    return min(deadlines) if deadlines else None
+
+
+def find_packet(data: bytearray, start: int = 0,
+                end: Optional[int] = None) -> Tuple[int, Optional[int]]:
+    """
+    Locate the first complete packet frame in `data[start:end]`.
+
+    Returns
+    -------
+    (int, int)
+        Start and end offset of the packet frame.  If no complete frame is
+        available, the end offset is `None` and the start offset is the
+        position to resume searching from once more data is available (bytes
+        before this position contain no packet and may be discarded).
+    """
+    if end is None:
+        end = len(data)
+    frame_start = data.find(START_FLAG, start, end)
+    if frame_start < 0:
+        # Keep trailing bytes that may be the beginning of a start flag.
+        return max(start, end - len(START_FLAG) + 1), None
+    size = frame_size(data, frame_start, end)
+    if size is None or end - frame_start < size:
+        return frame_start, None
+    return frame_start, frame_start + size
+
+
+def parse_frame(parser: cPacketParser, data, start: int, end: int):
+    """
+    Parse the complete packet frame `data[start:end]` and return the packet
+    (which belongs to `parser`), or `None` if the frame is corrupted (i.e.,
+    checksum mismatch, parser error or type of packet not sent by
+    `CommandPacketHandler`).
+    """
+    parser.reset()
+    try:
+        packet = parser.parse(memoryview(data)[start:end])
+    except RuntimeError:
+        return None
+    if (packet is None or not parser.message_completed or
+            packet.type_ not in REPLY_PACKET_TYPES):
+        return None
+    return packet
+
+
+def followed_by_frame(parser: cPacketParser, data, start: int,
+                      end: int) -> bool:
+    """
+    Return `True` if the incomplete packet frame at `start` is followed by a
+    complete, valid frame in `data[:end]`.
+
+    The device sends each frame in full before the next, so the header of
+    the incomplete frame is then corrupted (e.g., its payload length), rather
+    than the rest of the frame not having arrived yet.
+    """
+    next_start = data.find(START_FLAG, start + len(START_FLAG), end)
+    while next_start >= 0:
+        frame_start, frame_end = find_packet(data, next_start, end)
+        if frame_end is None:
+            return False
+        if parse_frame(parser, data, frame_start, frame_end) is not None:
+            return True
+        next_start = data.find(START_FLAG, frame_start + len(START_FLAG), end)
+    return False
+
+
+def chunked_response_request(request: bytes, itemsize: int, chunk_size: int,
+                             max_packet_size: int = 0xFFFF) -> bytes:
+    """
+    Return payload of a request for the result of command `request` to be
+    sent in chunks of at most `chunk_size` bytes (rounded down to a multiple
+    of the `itemsize` of the result type, so values never straddle chunks).
+
+    `max_packet_size` is the size of the largest packet the host can receive.
+    """
+    chunk_size = min(chunk_size, 0xFFFF, max_packet_size - HEADER_SIZE -
+                     LENGTH_SIZE - CRC_SIZE)
+    chunk_size = max(chunk_size - chunk_size % itemsize, itemsize)
+    return CHUNKED_RESPONSE_HEADER.pack(CMD_CHUNKED_RESPONSE,
+                                        chunk_size) + request
+
+
+def as_array(value, dtype: str) -> np.ndarray:
+    """
+    Return array argument `value` of a generated `Proxy` method as a
+    C-contiguous array of type `dtype`, without copying (or converting) it if
+    it already is one.
+
+    `value` may be any buffer-protocol object (e.g., `bytes`, `bytearray`,
+    `memoryview`, `numpy` array), a sequence, or a `str` (encoded as UTF-8 if
+    `dtype` is an 8-bit type, otherwise one value per character).  `bytes`
+    and `bytearray` objects have one value per byte.
+    """
+    if isinstance(value, str):
+        value = (value.encode('utf8') if np.dtype(dtype).itemsize == 1 else
+                 [ord(character) for character in value])
+    if isinstance(value, (bytes, bytearray)):
+        value = np.frombuffer(value, dtype=np.uint8)
+    return np.ascontiguousarray(value, dtype=dtype)
+
+
+class Request:
+    """
+    `DATA` packet of a command request, i.e., a packed request structure
+    (see `arduino_rpc.schema.get_request_format`) followed by the data of
+    each array argument.
+
+    The frame is assembled in a single buffer, so each array is copied
+    exactly once, directly from the argument (see `as_array`), and written to
+    the transport as is.  Implements the interface of
+    `nadamq.NadaMq.cPacket` used by proxies.
+
+    Arguments
+    ---------
+
+     - `request_struct`: Packed request structure, i.e., `struct.Struct`.
+     - `values`: Values of `request_struct` (command code first).
+     - `arrays`: Data of array arguments, in order (see `as_array`).
+    """
+    __slots__ = ('iuid', 'type_', 'buffer_size', '_frame')
+
+    def __init__(self, request_struct: struct.Struct, values: tuple,
+                 arrays: tuple = ()):
+        self.iuid = 0
+        self.type_ = PACKET_TYPES.DATA
+        start = FRAME_HEADER.size
+        self.buffer_size = request_struct.size + sum(array.nbytes
+                                                     for array in arrays)
+        frame = bytearray(start + self.buffer_size + CRC_SIZE)
+        request_struct.pack_into(frame, start, *values)
+        view = memoryview(frame)
+        offset = start + request_struct.size
+        for array in arrays:
+            view[offset:offset + array.nbytes] = memoryview(array).cast('B')
+            offset += array.nbytes
+        crc = crc_finalize(crc_update(crc_init(), view[start:offset]))
+        FRAME_CRC.pack_into(frame, offset, crc)
+        self._frame = frame
+
+    def data(self) -> bytes:
+        return bytes(self._frame[FRAME_HEADER.size:-CRC_SIZE])
+
+    def tostring(self) -> bytearray:
+        FRAME_HEADER.pack_into(self._frame, 0, START_FLAG, self.iuid,
+                               self.type_, self.buffer_size)
+        return self._frame
+
+
+def _is_sequence(value) -> bool:
+    if isinstance(value, np.ndarray):
+        return value.ndim > 0
+    return (isinstance(value, Sequence) and
+            not isinstance(value, (str, bytes, bytearray)))
+
+
+def call_count(args: tuple) -> int:
+    """
+    Return number of calls of `ProxyBase.many` with arguments `args`, i.e.,
+    the common length of the sequence arguments (`1` if all arguments are
+    scalars).
+    """
+    counts = {len(arg) for arg in args if _is_sequence(arg)}
+    if len(counts) > 1:
+        raise ValueError('Sequence arguments must have the same length.')
+    return counts.pop() if counts else 1
+
+
+def call_arguments(args: tuple, i: int) -> tuple:
+    """
+    Return arguments of call `i` of `ProxyBase.many` with arguments `args`.
+    """
+    return tuple(arg[i] if _is_sequence(arg) else arg for arg in args)
+
+
+def batch_capacity(packet_size: int, request_size: int,
+                   response_size: int) -> int:
+    """
+    Return maximum number of records of equal size in a batch packet (see
+    `ProxyBase._batch_append`).
+    """
+    # Records and command code must fit in the packet...
+    capacity = (packet_size - RECORD_LENGTH.size) // (RECORD_LENGTH.size +
+                                                      request_size)
+    if response_size > request_size:
+        # ...and responses, written from the start of the packet buffer, must
+        # never overtake the unprocessed requests.
+        capacity = min(capacity, packet_size // (RECORD_LENGTH.size +
+                                                 response_size))
+    return max(capacity, 1)
+
+
+def _record_future(metrics: CommandMetrics, future: Future) -> None:
+    """
+    Record response size or failure of a queued call (see
+    `ProxyBase._call_instrumented`).
+    """
+    if future.cancelled() or future.exception() is not None:
+        metrics.errors += 1
+        return
+    result = future.result()
+    metrics.response_bytes += (len(result.data()) if hasattr(result, 'data')
+                               and callable(result.data) else result.nbytes)
+
+
+def _copy_future(target: Future, source: Future) -> None:
+    """
+    Resolve `target` with the result (or exception) of `source`.
+    """
+    exception = source.exception()
+    if exception is not None:
+        target.set_exception(exception)
+    else:
+        target.set_result(source.result())
 
 
 class ProxyBase:
+    # Size of packet buffer of device (i.e., `PACKET_SIZE` in `RPCBuffer.h`).
+    PACKET_SIZE = 80
+    # Size of buffer of device to reassemble requests larger than
+    # `PACKET_SIZE` in (i.e., `RPC_CHUNK_BUFFER_SIZE` in
+    # `CommandPacketHandler.h`, which is 0, i.e., disabled, by default).
+    MAX_REQUEST_SIZE = 0
+    # Maximum number of fragments of a chunked request in flight at once.
+    chunk_window = 2
+    # Maximum number of bytes of a result per packet of a chunked response
+    # (see `iter_chunks`).
+    response_chunk_size = 1 << 10
+    # Maximum number of seconds to block in a single wait for data from the
+    # device (`None` blocks until data arrives).
+    poll_timeout = 1.
+    # Size of receive buffer (in bytes) allocated once per proxy instance.
+    receive_buffer_size = 8 << 10
+    # Maximum number of seconds to wait for the reply to each command
+    # (`None` waits indefinitely).  See also `deadline`.
+    timeout = None
+
+    _transport_instance = None
+    _parser = None
+    _receive_buffer = None
+    _receive_start = 0
+    _receive_end = 0
+    # Maximum number of outstanding requests (see `pipeline`).
+    _pipeline_window = None
+    _in_flight = None
+    _last_iuid = 0
+    # Pending batch records (see `batch`).
+    _batch = None
+    # Absolute deadline (in `time.monotonic` seconds) of calls in the current
+    # `deadline` block.
+    _deadline = None
+    # Call metrics (see `enable_metrics`), or `None` if disabled.
+    metrics = None
+    # Times (`time.perf_counter_ns`) the last request write started/ended,
+    # and the first byte of data was received after it (only recorded if
+    # `metrics` is set).
+    _write_start = 0
+    _write_end = 0
+    _first_byte = 0
+    # Active streams by identifier (see `stream`).
+    _streams = None
+    # Last packet returned by `_receive_packet` and its offsets in the receive
+    # buffer.
+    _received_packet = None
+    _received_frame = None
+    # Queue of calls submitted by other threads to the I/O thread, and the
+    # I/O thread (see `start_io_thread`).
+    _io_requests = None
+    _io_thread = None
+    # Maximum number of seconds the I/O thread waits for replies before
+    # sending newly submitted requests.
+    io_poll_interval = 1e-3
+    # Names of commands that may safely be sent again (e.g., reads), and
+    # number of times to resend them if the reply is corrupted, rejected or
+    # times out.
+    idempotent_commands = frozenset()
+    retries = 2
+    _idempotent_codes = None
+    # Number of corrupted packets skipped, bytes discarded while resyncing
+    # to the next packet start flag, and resent requests.
+    framing_errors = 0
+    discarded_bytes = 0
+    retried_calls = 0
+
+    @property
+    def _transport(self) -> Transport:
+        """
+        Transport connecting the proxy to the device.
+
+        Derived on first use from `self._serial`, which may be a `Transport`
+        or any object accepted by `as_transport` (e.g., `serial.Serial` or a
+        connected socket).
+        """
+        if self._transport_instance is None:
+            self._transport_instance = as_transport(self._serial)
+        return self._transport_instance
+
+    def _init_receive(self) -> None:
+        """
+        Allocate the packet parser and receive buffer of the proxy.
+
+        The parser and receive buffer are allocated on first use and reused
+        for every subsequent command, so the request/response path does not
+        allocate.
+        """
+        self._parser = cPacketParser()
+        self._receive_bytes = bytearray(self.receive_buffer_size)
+        self._receive_buffer = memoryview(self._receive_bytes)
+
+    def _readinto(self, buffer: memoryview,
+                  timeout: Optional[float] = None) -> int:
+        """
+        Block until data is available from the device (or `timeout` expires,
+        `poll_timeout` by default) and read available bytes into `buffer`.
+
+        Waiting does not consume CPU (see `arduino_rpc.transport`).
+
+        Returns
+        -------
+        int
+            Number of bytes read (zero if the timeout expired).
+        """
+        if timeout is None:
+            timeout = self.poll_timeout
+        return self._transport.readinto(buffer, timeout)
+
+    def _receive_packet(self, deadline: Optional[float] = None,
+                        streams: bool = False, wake: Optional[float] = None):
+        """
+        Wait for the next packet from the device.
+
+        Raises `CommandTimeoutError` if no packet is received before
+        `deadline` (in `time.monotonic` seconds).  If `wake` (in
+        `time.monotonic` seconds) is specified, return `None` at that time if
+        no packet was received.
+
+        Bytes of a partially received packet are kept when the deadline (or
+        `wake`) expires, so the rest of the packet may be received by the
+        next call.  Only corrupted packets are skipped, i.e., checksum
+        mismatch, parser error, or incomplete packets larger than the receive
+        buffer or followed by a complete packet (see `followed_by_frame`).
+
+        Stream packets (see `stream`) are added to the buffer of the
+        corresponding stream and skipped, unless `streams` is `True`.
+
+        Bytes received after the end of the packet are kept in the receive
+        buffer for the next call, so several replies may arrive in a single
+        read (e.g., when pipelining requests).
+
+        .. note::
+            The returned packet belongs to the packet parser of the proxy and
+            is only valid until the next packet is received.
+        """
+        if self._parser is None:
+            self._init_receive()
+        data = self._receive_bytes
+        buffer = self._receive_buffer
+        parser = self._parser
+
+        while True:
+            start, end = find_packet(data, self._receive_start, self._receive_end)
+            if start > self._receive_start:
+                # Bytes before start flag (e.g., noise) are discarded.
+                self.discarded_bytes += start - self._receive_start
+            if end is not None:
+                self._receive_start = end
+                result = parse_frame(parser, data, start, end)
+                if result is None:
+                    self._resync(start)
+                    raise FramingError('Corrupted packet received.',
+                                       frame_iuid(data, start, end))
+                if streams or result.type_ != PACKET_TYPES.STREAM:
+                    self._received_packet = result
+                    self._received_frame = start, end
+                    return result
+                self._route_stream(result)
+                continue
+            # Move partial packet to start of buffer to make room for more.
+            size = self._receive_end - start
+            if start > 0:
+                buffer[:size] = buffer[start:self._receive_end]
+            self._receive_start, self._receive_end = 0, size
+            declared_size = frame_size(data, 0, size)
+            if (size == len(buffer) or (declared_size or 0) > len(buffer) or
+                    followed_by_frame(parser, data, 0, size)):
+                # Header of incomplete frame is corrupted (e.g., payload
+                # length larger than receive buffer, or overlapping the
+                # next frame).
+                self._resync(0)
+                raise FramingError('Corrupted packet received.',
+                                   frame_iuid(data, 0, size))
+            timeout = self.poll_timeout
+            wait_until = _earliest(deadline, wake)
+            if wait_until is not None:
+                now = time.monotonic()
+                remaining = wait_until - now
+                if remaining <= 0:
+                    if deadline is not None and deadline <= now:
+                        raise CommandTimeoutError('Timed out waiting for '
+                                                  'reply.')
+                    return None
+                timeout = remaining if timeout is None else min(timeout, remaining)
+            count = self._readinto(buffer[size:], timeout)
+            if count and self.metrics is not None and not self._first_byte:
+                self._first_byte = perf_counter_ns()
+            self._receive_end += count
+
+    def _resync(self, start: int) -> None:
+        """
+        Skip the start flag of the corrupted frame at `start` in the receive
+        buffer, such that scanning resumes at the next start flag (without
+        resetting the connection).
+        """
+        self.framing_errors += 1
+        self.discarded_bytes += len(START_FLAG)
+        self._receive_start = start + len(START_FLAG)
+
+    def _is_idempotent(self, packet) -> bool:
+        """
+        Return `True` if the command of request `packet` is listed in
+        `idempotent_commands`.
+        """
+        names = self.idempotent_commands
+        if not names:
+            return False
+        if self._idempotent_codes is None or self._idempotent_codes[0] != names:
+            self._idempotent_codes = (names, {getattr(self,
+                                                      '_CMD_' + name.upper())
+                                              for name in names})
+        return (int.from_bytes(packet.data()[:2], 'little') in
+                self._idempotent_codes[1])
+
+    def _request_deadline(self) -> Optional[float]:
+        """
+        Return deadline of a request sent now, i.e., the earliest of the
+        enclosing `deadline` block and `timeout` seconds from now.
+        """
+        if self.timeout is None:
+            return self._deadline
+        return _earliest(self._deadline, time.monotonic() + self.timeout)
+
+    def _next_iuid(self) -> int:
+        # Cycle through identifiers 1-0xFFFF (0 marks untagged packets).
+        self._last_iuid = self._last_iuid % 0xFFFF + 1
+        return self._last_iuid
+
+    def _write_packet(self, packet) -> None:
+        data = packet.tostring()
+        if self.metrics is None:
+            self._transport.write(data)
+            return
+        self._write_start = perf_counter_ns()
+        self._transport.write(data)
+        self._first_byte = 0
+        self._write_end = perf_counter_ns()
+
     def _send_command(self, packet):
-        self._serial.write(packet.tostring())
-        parser = cPacketParser()
-        result = None
+        """
+        Send command packet to device and wait for the response packet.
+
+        Raises `CommandTimeoutError` if the reply is not received before the
+        deadline of the request (see `timeout` and `deadline`), or
+        `FramingError` if the reply is corrupted.  Commands listed in
+        `idempotent_commands` are first resent (up to `retries` times).
+
+        .. note::
+            The returned packet belongs to the packet parser of the proxy and
+            is only valid until the next command is sent.
+        """
+        if packet.buffer_size > self.PACKET_SIZE:
+            return self._send_chunked(packet.data())
+        if self._in_flight:
+            # Other requests are outstanding, so wait for the matching reply.
+            future = self._submit(packet)
+            while not future.done():
+                self._dispatch_response()
+            return future.result()
+        attempts = 1 + (self.retries if self._is_idempotent(packet) else 0)
+        for attempt in range(attempts):
+            if attempt:
+                self.retried_calls += 1
+            deadline = self._request_deadline()
+            packet.iuid = iuid = self._next_iuid()
+            self._write_packet(packet)
+            try:
+                response = self._receive_reply(iuid, deadline)
+                if (response.type_ != PACKET_TYPES.NACK or
+                        attempt == attempts - 1):
+                    return response
+                # Header of reply may be corrupted (it has no checksum).
+            except (FramingError, CommandTimeoutError):
+                # Resend idempotent command, unless the deadline of the
+                # enclosing `deadline` block has passed.
+                if attempt == attempts - 1 or (self._deadline is not None and
+                                               self._deadline <=
+                                               time.monotonic()):
+                    raise
 
+    def _receive_reply(self, iuid: int, deadline: Optional[float] = None):
+        """
+        Wait for the reply to request `iuid`.
+
+        Raises `FramingError` if the reply is corrupted, or
+        `CommandTimeoutError` if no reply is received before `deadline`.
+        """
         while True:
-            response = self._serial.read(self._serial.inWaiting())
-            if response == '':
+            try:
+                response = self._receive_packet(deadline)
+            except FramingError as exception:
+                if exception.iuid in (iuid, 0):
+                    raise
+                # Corrupted packet was not the reply.
                 continue
-            result = parser.parse(np.fromstring(response, dtype='uint8'))
-            if parser.message_completed:
-                break
-            elif parser.error:
-                raise IOError('Error parsing.')
+            # Discard late replies to earlier (e.g., timed out) requests.
+            if response.iuid in (iuid, 0):
+                return response
+
+    @staticmethod
+    def _decode_response(response, dtype: Optional[str] = None,
+                         array: bool = False, out: Optional[np.ndarray] = None,
+                         data=None):
+        """
+        Decode command response packet as type `dtype`.
+
+        Return the response packet if `dtype` is `None`, an array if `array`
+        is `True`, otherwise the first (scalar) value.
+
+        If `out` is specified, the array is decoded into `out` (see
+        `_decode_into`) from `data`, the payload of `response` (default:
+        `response.data()`, or, e.g., a view of the receive buffer returned by
+        `_received_payload`).
+
+        Raises `IOError` if the command failed (i.e., the device did not reply
+        with a `DATA` packet).
+        """
+        if dtype is None:
+            return response
+        if response.type_ != PACKET_TYPES.DATA:
+            raise IOError('Command failed.')
+        if out is not None:
+            return ProxyBase._decode_into(response.data() if data is None
+                                          else data, dtype, out)
+        result = np.frombuffer(response.data(), dtype=dtype)
+        return result if array else result[0]
+
+    @staticmethod
+    def _decode_into(data, dtype: str, out: np.ndarray) -> np.ndarray:
+        """
+        Copy array response `data` into the start of `out` (a C-contiguous
+        array of type `dtype`, e.g., preallocated acquisition storage) without
+        allocating a new array.
+
+        Returns
+        -------
+        numpy.ndarray
+            View of `out` containing the decoded values.
+        """
+        count = len(data) // np.dtype(dtype).itemsize
+        ProxyBase._check_out(dtype, out, count)
+        memoryview(out).cast('B')[:len(data)] = data
+        return out[:count]
+
+    @staticmethod
+    def _check_out(dtype: str, out: np.ndarray, count: int) -> None:
+        """
+        Raise `ValueError` unless `out` is a C-contiguous array of type
+        `dtype` with space for `count` values.
+        """
+        if out.dtype != dtype or not out.flags.c_contiguous:
+            raise ValueError(f'`out` must be a C-contiguous `{dtype}` array.')
+        if count > out.size:
+            raise ValueError(f'Response has {count} values, but `out` has '
+                             f'space for {out.size}.')
+
+    def _received_payload(self, response):
+        """
+        Return payload of `response`, without copying if it is the packet
+        last received (i.e., as a view of the receive buffer, valid until the
+        next packet is received).
+        """
+        if response is not self._received_packet:
+            return response.data()
+        start, end = self._received_frame
+        return self._receive_buffer[start + HEADER_SIZE + LENGTH_SIZE:
+                                    end - CRC_SIZE]
+
+    def _call(self, packet, dtype: Optional[str] = None, array: bool = False,
+              encode_start: int = 0, out: Optional[np.ndarray] = None,
+              chunk_size: Optional[int] = None):
+        """
+        Send command packet and return decoded response (see
+        `_decode_response`).
+
+        Within a `batch` or `pipeline` block, return a
+        `concurrent.futures.Future` that resolves to the decoded response
+        instead.
+
+        `encode_start` is the time (`time.perf_counter_ns`) the generated
+        method was called if `metrics` is enabled, otherwise `0`.
+
+        If `out` is specified, an array response is decoded into `out` (see
+        `_decode_into`).
+
+        If `chunk_size` is specified, an array response is sent by the device
+        in chunks of up to `chunk_size` bytes (see `_call_chunked`).
+        """
+        if (self._io_requests is not None and
+                threading.get_ident() != self._io_thread.ident):
+            return self._call_threaded(packet, dtype, array,
+                                       encode_start=encode_start, out=out,
+                                       chunk_size=chunk_size)
+        if chunk_size is not None:
+            return self._call_chunked(packet, dtype, chunk_size, out)
+        if self.metrics is not None:
+            return self._call_instrumented(packet, dtype, array, encode_start,
+                                           out)
+        if self._batch is not None or self._pipeline_window is not None:
+            return self._queue(packet, dtype, array, out)
+        response = self._send_command(packet)
+        if out is not None:
+            return self._decode_response(response, dtype, array, out,
+                                         self._received_payload(response))
+        return self._decode_response(response, dtype, array)
+
+    def _queue(self, packet, dtype: Optional[str], array: bool,
+               out: Optional[np.ndarray] = None) -> Future:
+        """
+        Add command to the current `batch` (or send as part of the current
+        `pipeline`) and return future of the decoded response.
+        """
+        if self._batch is not None:
+            if packet.buffer_size > self.PACKET_SIZE - 2 * RECORD_LENGTH.size:
+                # Request does not fit in a batch packet, so send pending
+                # batch and then the request by itself.
+                self._flush_batch()
+                future = self._resolve(packet, dtype, array)
+            else:
+                future = self._batch_append(packet.data(), dtype, array)
+        elif packet.buffer_size > self.PACKET_SIZE:
+            future = self._resolve(packet, dtype, array)
+        else:
+            future = self._submit(packet, dtype, array)
+        if out is None:
+            return future
+        result = Future()
+
+        def copy_result(future):
+            try:
+                values = memoryview(future.result()).cast('B')
+                result.set_result(self._decode_into(values, dtype, out))
+            except BaseException as exception:
+                result.set_exception(exception)
+
+        future.add_done_callback(copy_result)
+        return result
+
+    def _resolve(self, packet, dtype: Optional[str], array: bool) -> Future:
+        """
+        Send command packet, wait for the response and return it as a
+        resolved future.
+        """
+        future = Future()
+        try:
+            response = self._send_command(packet)
+            if dtype is None:
+                # Detach from packet parser.
+                response = cPacket(iuid=response.iuid, type_=response.type_,
+                                   data=response.data())
+            future.set_result(self._decode_response(response, dtype, array))
+        except Exception as exception:
+            future.set_exception(exception)
+        return future
+
+    def _call_instrumented(self, packet, dtype: Optional[str], array: bool,
+                           encode_start: int,
+                           out: Optional[np.ndarray] = None):
+        """
+        Instrumented version of `_call`, recording metrics of the call to
+        `metrics`.
+
+        Only the `encode` phase is timed for calls queued in a `batch` or
+        `pipeline` block, since their replies are received (and parsed)
+        together with the replies of other calls.
+        """
+        encode_end = perf_counter_ns()
+        request = packet.data()
+        metrics = self.metrics.command(int.from_bytes(request[:2], 'little'))
+        metrics.calls += 1
+        metrics.request_bytes += len(request)
+        if encode_start:
+            metrics.phases['encode'].record(encode_end - encode_start)
+        if self._batch is not None or self._pipeline_window is not None:
+            future = self._queue(packet, dtype, array, out)
+            future.add_done_callback(partial(_record_future, metrics))
+            return future
+        try:
+            response = self._send_command(packet)
+            parse_end = perf_counter_ns()
+            payload = self._received_payload(response)
+            metrics.response_bytes += len(payload)
+            if out is not None:
+                result = self._decode_response(response, dtype, array, out,
+                                               payload)
+            else:
+                result = self._decode_response(response, dtype, array)
+        except Exception:
+            metrics.errors += 1
+            raise
+        decode_end = perf_counter_ns()
+        phases = metrics.phases
+        # Reply may already have been received while waiting for another
+        # reply.
+        first_byte = self._first_byte or self._write_end
+        phases['write'].record(self._write_end - self._write_start)
+        phases['first_byte'].record(first_byte - self._write_end)
+        phases['parse'].record(parse_end - first_byte)
+        phases['decode'].record(decode_end - parse_end)
         return result
+
+    def _receive_chunks(self, request: bytes, dtype: str,
+                        chunk_size: Optional[int] = None):
+        """
+        Send command request for a chunked response and yield `(offset,
+        total length, payload)` of each chunk of the result as it arrives.
+
+        Each payload is a view of the receive buffer, only valid until the
+        next chunk is received.
+
+        .. note::
+            Chunks are received directly, so pending batch records are sent
+            and outstanding (i.e., pipelined) replies are received first.
+        """
+        if self._batch is not None and self._batch['records']:
+            self._flush_batch()
+        self._drain()
+        payload = chunked_response_request(request, np.dtype(dtype).itemsize,
+                                           chunk_size or
+                                           self.response_chunk_size,
+                                           self.receive_buffer_size)
+        if len(payload) > self.PACKET_SIZE:
+            raise ValueError('Request of a chunked response must fit in a '
+                             'single packet.')
+        packet = cPacket(data=payload, type_=PACKET_TYPES.DATA)
+        response = self._send_command(packet)
+        if (response.type_ != PACKET_TYPES.DATA or
+                len(response.data()) != RESPONSE_LENGTH.size):
+            raise IOError('Command failed.')
+        total_length, = RESPONSE_LENGTH.unpack(response.data())
+        offset = 0
+        while offset < total_length:
+            response = self._receive_packet(self._request_deadline())
+            if response.iuid not in (packet.iuid, 0):
+                # Late reply to an earlier (e.g., timed out) request.
+                continue
+            payload = self._received_payload(response)
+            if response.type_ != PACKET_TYPES.DATA or not payload:
+                raise IOError('Chunked response interrupted.')
+            yield offset, total_length, payload
+            offset += len(payload)
+
+    def _call_chunked(self, packet, dtype: str, chunk_size: int,
+                      out: Optional[np.ndarray] = None):
+        """
+        Send command packet and decode the chunked array response (see
+        `iter_chunks`) into a new array (or into `out`, if specified), filled
+        in place as each chunk arrives.
+
+        Within a `batch` or `pipeline` block, the call is not queued, but the
+        result is still returned as a (resolved) `concurrent.futures.Future`.
+        """
+        queued = self._batch is not None or self._pipeline_window is not None
+        metrics = None
+        if self.metrics is not None:
+            request = packet.data()
+            metrics = self.metrics.command(int.from_bytes(request[:2],
+                                                          'little'))
+            metrics.calls += 1
+            metrics.request_bytes += len(request)
+        future = Future()
+        try:
+            itemsize = np.dtype(dtype).itemsize
+            values = None
+            for offset, total_length, payload in \
+                    self._receive_chunks(packet.data(), dtype, chunk_size):
+                if values is None:
+                    count = total_length // itemsize
+                    if out is None:
+                        out = np.empty(count, dtype=dtype)
+                    else:
+                        self._check_out(dtype, out, count)
+                    values = memoryview(out).cast('B')
+                values[offset:offset + len(payload)] = payload
+                if metrics is not None:
+                    metrics.response_bytes += len(payload)
+            if values is None:
+                # Empty result.
+                out = np.empty(0, dtype=dtype) if out is None else out[:0]
+            else:
+                out = out[:count]
+        except Exception as exception:
+            if metrics is not None:
+                metrics.errors += 1
+            if not queued:
+                raise
+            future.set_exception(exception)
+            return future
+        if not queued:
+            return out
+        future.set_result(out)
+        return future
+
+    def iter_chunks(self, method, *args, chunk_size: Optional[int] = None,
+                    **kwargs):
+        """
+        Call generated `Proxy` method `method` (returning an array) and yield
+        the result in chunks (i.e., `numpy` arrays) as they arrive, e.g., to
+        process a large sample buffer of the device while it is transferred.
+
+        The device sends the result in packets of up to `chunk_size` bytes
+        (`response_chunk_size` by default) directly from device memory (see
+        `CommandPacketHandler::process_chunked_response`).
+
+        Example:
+
+            for block in proxy.iter_chunks(proxy.read_samples, 10000):
+                ...
+
+        To receive the whole result as a single array, call the method with
+        a `chunk_size`, e.g., `proxy.read_samples(10000, chunk_size=1024)`.
+        """
+        request, dtype, array = self._capture_request(method, *args, **kwargs)
+        if not array:
+            raise ValueError('Command does not return an array.')
+        for _, _, payload in self._receive_chunks(request, dtype, chunk_size):
+            yield np.frombuffer(payload, dtype=dtype).copy()
+
+    def enable_metrics(self, metrics: Optional[Metrics] = None) -> Metrics:
+        """
+        Record metrics of each call (see `arduino_rpc.metrics`) to `metrics`
+        (a new `Metrics` instance labelled with the command names of the
+        proxy by default).
+
+        Set `metrics` attribute to `None` to disable recording.
+
+        Returns
+        -------
+        arduino_rpc.metrics.Metrics
+            Metrics recorded by the proxy.
+        """
+        if metrics is None:
+            metrics = Metrics(command_names(type(self)))
+            # E.g., batch packets sent by `many`.
+            metrics.names.setdefault(CMD_BATCH, 'batch')
+        self.metrics = metrics
+        return metrics
+
+    def _send_chunked(self, request: bytes):
+        """
+        Send command request larger than `PACKET_SIZE` as a sequence of
+        fragments, with up to `chunk_window` fragments in flight, and wait
+        for the response packet.
+
+        The device reassembles the request (see
+        `CommandPacketHandler::process_chunk`), acknowledges each fragment
+        and answers the last fragment with the response to the command.
+        """
+        if len(request) > self.MAX_REQUEST_SIZE:
+            raise ValueError(f'Request of {len(request)} bytes is larger than '
+                             f'`PACKET_SIZE` ({self.PACKET_SIZE} bytes) and '
+                             f'`MAX_REQUEST_SIZE` ({self.MAX_REQUEST_SIZE} '
+                             'bytes, see `RPC_CHUNK_BUFFER_SIZE`).')
+        chunk_size = self.PACKET_SIZE - CHUNK_HEADER.size
+        window = max(self.chunk_window, self._pipeline_window or 1)
+        futures = []
+        for offset in range(0, len(request), chunk_size):
+            chunk = (CHUNK_HEADER.pack(CMD_CHUNK, offset, len(request)) +
+                     request[offset:offset + chunk_size])
+            futures.append(self._submit(cPacket(data=chunk,
+                                                type_=PACKET_TYPES.DATA),
+                                        window=window))
+        for future in futures:
+            while not future.done():
+                self._dispatch_response()
+        responses = [future.result() for future in futures]
+        if any(response.type_ != PACKET_TYPES.DATA for response in responses):
+            raise IOError('Chunked request rejected by device.')
+        return responses[-1]
+
+    def _submit(self, packet, dtype: Optional[str] = None,
+                array: bool = False, window: Optional[int] = None) -> Future:
+        """
+        Send command packet tagged with a new request identifier without
+        waiting for the reply, blocking while the pipeline window (or
+        `window` requests, if specified) is full.
+        """
+        if self._in_flight is None:
+            self._in_flight = OrderedDict()
+        deadline = self._request_deadline()
+        window = window or self._pipeline_window or 1
+        while len(self._in_flight) >= window:
+            self._dispatch_response()
+        future = Future()
+        if deadline is not None and deadline <= time.monotonic():
+            # Deadline passed while waiting for the window, so drop request.
+            future.set_exception(CommandTimeoutError('Deadline expired before '
+                                                     'request was sent.'))
+            return future
+        packet.iuid = self._next_iuid()
+        self._in_flight[packet.iuid] = (future, dtype, array, deadline)
+        self._write_packet(packet)
+        return future
+
+    def _dispatch_response(self, wake: Optional[float] = None) -> None:
+        """
+        Receive one reply and resolve the future of the matching request.
+
+        If the earliest deadline of the outstanding requests expires first,
+        fail all expired requests with `CommandTimeoutError` instead (late
+        replies to expired requests are discarded).
+
+        If `wake` (in `time.monotonic` seconds) is specified, return at that
+        time if no reply was received (see `_receive_packet`).
+        """
+        deadline = _earliest(*(entry[3] for entry in self._in_flight.values()))
+        try:
+            packet = self._receive_packet(deadline, wake=wake)
+        except FramingError as exception:
+            self._fail_corrupted(exception)
+            return
+        except CommandTimeoutError:
+            now = time.monotonic()
+            for iuid, (future, _, _, deadline) in list(self._in_flight.items()):
+                if deadline is not None and deadline <= now:
+                    del self._in_flight[iuid]
+                    future.set_exception(CommandTimeoutError('Timed out '
+                                                             'waiting for '
+                                                             'reply.'))
+            return
+        if packet is None:
+            return
+        self._resolve_response(packet)
+
+    def _resolve_response(self, packet) -> None:
+        """
+        Resolve the future of the request matching reply `packet`.
+        """
+        if packet.iuid in self._in_flight:
+            future, dtype, array, _ = self._in_flight.pop(packet.iuid)
+        elif packet.iuid == 0 and self._in_flight:
+            # Device does not echo request identifiers; replies arrive in
+            # request order.
+            _, (future, dtype, array, _) = self._in_flight.popitem(last=False)
+        else:
+            # Reply to a request that is no longer outstanding.
+            return
+        if dtype is None:
+            # Detach from packet parser, which is reused for the next reply.
+            packet = cPacket(iuid=packet.iuid, type_=packet.type_,
+                             data=packet.data())
+        try:
+            future.set_result(self._decode_response(packet, dtype, array))
+        except IOError as exception:
+            # Fail this request only (e.g., command rejected by the device).
+            future.set_exception(exception)
+
+    def _fail_corrupted(self, exception: FramingError) -> None:
+        """
+        Fail the outstanding request whose reply was corrupted (if any).
+        """
+        entry = self._in_flight.pop(exception.iuid, None)
+        if entry is not None:
+            entry[0].set_exception(exception)
+
+    def _route_stream(self, packet) -> None:
+        """
+        Add payload of stream packet to the buffer of the stream.
+        """
+        stream = (self._streams or {}).get(packet.iuid)
+        if stream is not None:
+            stream.push(packet.data())
+
+    def _pump(self, deadline: Optional[float] = None) -> None:
+        """
+        Receive one packet, i.e., a stream packet or a reply to an
+        outstanding (i.e., pipelined) request.
+        """
+        try:
+            packet = self._receive_packet(deadline, streams=True)
+        except FramingError as exception:
+            if self._in_flight:
+                self._fail_corrupted(exception)
+            return
+        if packet.type_ == PACKET_TYPES.STREAM:
+            self._route_stream(packet)
+        elif self._in_flight:
+            self._resolve_response(packet)
+
+    def _capture_request(self, method, *args, **kwargs):
+        """
+        Return serialized command request, response type and array flag of a
+        call to generated `Proxy` method `method` (without sending it).
+        """
+        packet, dtype, array = self._capture_packet(method, *args, **kwargs)
+        return packet.data(), dtype, array
+
+    def _capture_packet(self, method, *args, **kwargs):
+        """
+        Return command packet, response type and array flag of a call to
+        generated `Proxy` method `method` (without sending it).
+
+        The method is called on a bare instance of the proxy class, so the
+        proxy itself is not modified (e.g., while the I/O thread runs).
+        """
+        captured = []
+        capture = object.__new__(type(self))
+        capture._call = (lambda packet, dtype=None, array=False, **kwargs:
+                         captured.append((packet, dtype, array)))
+        method.__func__(capture, *args, **kwargs)
+        return captured[0]
+
+    def _call_future(self, packet, dtype: Optional[str] = None,
+                     array: bool = False) -> Future:
+        """
+        Send command packet through `_call` within a `pipeline` block, or
+        submit it to the I/O thread if it runs, and return future of the
+        decoded response.
+        """
+        if (self._io_requests is not None and
+                threading.get_ident() != self._io_thread.ident):
+            future = Future()
+            self._io_requests.put((future, (packet, dtype, array), {}))
+            return future
+        return self._call(packet, dtype, array)
+
+    @contextmanager
+    def stream(self, method, *args, interval_ms: int = 0,
+               buffer_size: int = 1 << 20, **kwargs):
+        """
+        Context manager to stream the result of a command, i.e., have the
+        device call `method(*args)` every `interval_ms` milliseconds (or on
+        every iteration of its main loop if `0`) and push each result to the
+        host.
+
+        Yields a `arduino_rpc.stream.Stream`, which yields `numpy` blocks of
+        results as they arrive.  The stream is stopped when the block exits.
+
+        Example:
+
+            with proxy.stream(proxy.analog_read, 0, interval_ms=1) as samples:
+                block = samples.read(1000)
+
+        .. note::
+            The device must call `CommandPacketHandler::poll_streams` in its
+            main loop.
+        """
+        from .stream import Stream, start_request, stop_request
+
+        request, dtype, _ = self._capture_request(method, *args, **kwargs)
+        if dtype is None:
+            raise ValueError('Command has no result to stream.')
+        if self._streams is None:
+            self._streams = {}
+        stream_id = next(i for i in range(1, 0x10000) if i not in self._streams)
+        stream = Stream(self, stream_id, dtype, buffer_size=buffer_size)
+        self._streams[stream_id] = stream
+        try:
+            self._stream_command(start_request(stream_id, interval_ms, request))
+            try:
+                yield stream
+            finally:
+                self._stream_command(stop_request(stream_id))
+        finally:
+            stream.active = False
+            del self._streams[stream_id]
+
+    def _stream_command(self, payload: bytes) -> None:
+        response = self._send_command(cPacket(data=payload,
+                                              type_=PACKET_TYPES.DATA))
+        if response.type_ != PACKET_TYPES.DATA:
+            raise IOError('Stream request rejected by device (e.g., no free '
+                          'stream, or streaming disabled, see '
+                          '`RPC_MAX_STREAMS`).')
+
+    def start_io_thread(self, window: int = 8) -> None:
+        """
+        Make the proxy thread-safe: start an I/O thread that owns the
+        transport and sends the calls of all other threads, pipelining up to
+        `window` requests (see `pipeline`).
+
+        Calling threads only encode requests and wait for their replies, so
+        many threads may share the proxy without serializing on a lock.
+
+        .. note::
+            While the I/O thread runs, `batch`, `pipeline`, `deadline` and
+            `stream` blocks must not be used.
+        """
+        if self._io_thread is not None:
+            raise RuntimeError('I/O thread already started.')
+        # `SimpleQueue` is implemented in C without Python-level locks, so
+        # submitting a call never blocks on other callers.
+        self._io_requests = queue.SimpleQueue()
+        self._io_thread = threading.Thread(target=self._io_loop,
+                                           args=(window, ), daemon=True,
+                                           name='arduino-rpc-io')
+        self._io_thread.start()
+
+    def stop_io_thread(self) -> None:
+        """
+        Wait for outstanding calls and stop the I/O thread (see
+        `start_io_thread`).
+        """
+        if self._io_thread is None:
+            return
+        self._io_requests.put(None)
+        self._io_thread.join()
+        self._io_thread = None
+        self._io_requests = None
+
+    @contextmanager
+    def threaded(self, window: int = 8):
+        """
+        Context manager to share the proxy between threads (see
+        `start_io_thread`).
+
+        Example:
+
+            with proxy.threaded(), ThreadPoolExecutor(8) as executor:
+                values = list(executor.map(proxy.analog_read, range(6)))
+        """
+        self.start_io_thread(window)
+        try:
+            yield self
+        finally:
+            self.stop_io_thread()
+
+    def _call_threaded(self, *args, **kwargs):
+        """
+        Submit call to the I/O thread and wait for the result.
+        """
+        future = Future()
+        self._io_requests.put((future, args, kwargs))
+        return future.result()
+
+    def _io_loop(self, window: int) -> None:
+        """
+        Send calls submitted to the I/O thread as pipelined requests and
+        resolve their futures as replies arrive.
+
+        Blocks on the request queue while no requests are outstanding;
+        otherwise, waits for replies for at most `io_poll_interval` seconds
+        at a time before sending newly submitted requests.
+        """
+        self._pipeline_window = window
+        requests = self._io_requests
+        try:
+            while True:
+                try:
+                    item = requests.get(block=not self._in_flight)
+                except queue.Empty:
+                    try:
+                        self._dispatch_response(wake=time.monotonic() +
+                                                self.io_poll_interval)
+                    except Exception as exception:
+                        # E.g., transport error, so fail outstanding calls.
+                        for future, *_ in self._in_flight.values():
+                            future.set_exception(exception)
+                        self._in_flight.clear()
+                    continue
+                if item is None:
+                    break
+                future, args, kwargs = item
+                try:
+                    result = self._call(*args, **kwargs)
+                except Exception as exception:
+                    future.set_exception(exception)
+                else:
+                    result.add_done_callback(partial(_copy_future, future))
+        finally:
+            self._pipeline_window = None
+            self._drain()
+
+    def _drain(self) -> None:
+        """
+        Wait for replies to all outstanding requests.
+        """
+        while self._in_flight:
+            self._dispatch_response()
+
+    @contextmanager
+    def pipeline(self, window: int = 8):
+        """
+        Context manager to pipeline requests, i.e., send up to `window`
+        requests before waiting for replies.
+
+        Within the block, generated `Proxy` methods return a
+        `concurrent.futures.Future` for each call.  All outstanding replies
+        are received when the block exits.
+
+        Each request is tagged with an identifier in the packet header, which
+        is echoed back by `CommandPacketHandler` on the device.
+
+        Example:
+
+            with proxy.pipeline(window=16):
+                futures = [proxy.analog_read(i) for i in range(6)]
+            values = [f.result() for f in futures]
+        """
+        previous = self._pipeline_window
+        self._pipeline_window = window
+        try:
+            yield self
+        finally:
+            self._pipeline_window = previous
+            self._drain()
+
+    def _batch_append(self, request: bytes, dtype: Optional[str],
+                      array: bool) -> Future:
+        """
+        Append command request to the pending batch, sending the pending
+        batch first if the request would not fit in the same packet.
+        """
+        # Size of scalar response (the size of array responses is unknown, so
+        # the device stops processing a batch if a response does not fit).
+        response_size = np.dtype(dtype).itemsize if dtype and not array else 0
+        batch = self._batch
+        payload_size = batch['payload_size'] + RECORD_LENGTH.size + len(request)
+        # Responses are written from the start of the device packet buffer,
+        # while unprocessed requests are read from the end, so the responses
+        # must never overtake the requests.
+        excess = batch['excess'] + response_size - len(request)
+        max_excess = max(batch['max_excess'], excess)
+        if batch['records'] and (payload_size > self.PACKET_SIZE or
+                                 max_excess > self.PACKET_SIZE - payload_size +
+                                 RECORD_LENGTH.size):
+            self._flush_batch()
+            return self._batch_append(request, dtype, array)
+        future = Future()
+        batch['records'].append((RECORD_LENGTH.pack(len(request)) + request,
+                                 future, dtype, array,
+                                 self._request_deadline()))
+        batch.update(payload_size=payload_size, excess=excess,
+                     max_excess=max_excess)
+        return future
+
+    def _flush_batch(self) -> None:
+        """
+        Send pending batch records in a single packet and resolve the future
+        of each record from the concatenated responses.
+
+        Records with an expired deadline are dropped (i.e., fail with
+        `CommandTimeoutError`) without being sent, and the batch packet must
+        be answered before the earliest deadline of the remaining records.
+        """
+        batch = self._batch
+        now = time.monotonic()
+        records = []
+        for record in batch['records']:
+            deadline = record[-1]
+            if deadline is not None and deadline <= now:
+                record[1].set_exception(CommandTimeoutError('Deadline expired '
+                                                            'before request '
+                                                            'was sent.'))
+            else:
+                records.append(record)
+        try:
+            if not records:
+                return
+            payload = (RECORD_LENGTH.pack(CMD_BATCH) +
+                       b''.join(record for record, *_ in records))
+            deadline = _earliest(*(record[-1] for record in records))
+            with self.deadline(at=deadline):
+                response = self._send_command(cPacket(data=payload,
+                                                      type_=PACKET_TYPES.DATA))
+            if response.type_ != PACKET_TYPES.DATA:
+                raise IOError('Batch request rejected by device.')
+            data = memoryview(response.data())
+            offset = 0
+            for _, future, dtype, array, _ in records:
+                if offset + RECORD_LENGTH.size > len(data):
+                    future.set_exception(IOError('Batch response truncated.'))
+                    continue
+                length, = RECORD_LENGTH.unpack_from(data, offset)
+                offset += RECORD_LENGTH.size
+                if length == RECORD_ERROR:
+                    future.set_exception(IOError('Command failed.'))
+                    continue
+                record = cPacket(data=data[offset:offset + length].tobytes(),
+                                 type_=PACKET_TYPES.DATA)
+                offset += length
+                future.set_result(self._decode_response(record, dtype, array))
+        except Exception as exception:
+            for _, future, *_ in records:
+                if not future.done():
+                    future.set_exception(exception)
+            raise
+        finally:
+            batch.update(records=[], payload_size=RECORD_LENGTH.size, excess=0,
+                         max_excess=0)
+
+    @contextmanager
+    def deadline(self, timeout: Optional[float] = None,
+                 at: Optional[float] = None):
+        """
+        Context manager requiring the replies to all calls in the block
+        (including calls in `batch` and `pipeline` blocks) to be received
+        within `timeout` seconds from now, or before the absolute deadline
+        `at` (in `time.monotonic` seconds).
+
+        Calls that miss the deadline raise (or resolve with)
+        `CommandTimeoutError`; queued calls whose deadline has already passed
+        are dropped without being sent.  Nested deadlines may only shorten the
+        enclosing deadline.
+
+        Example:
+
+            with proxy.deadline(0.5):
+                proxy.ram_free()
+        """
+        if at is None and timeout is not None:
+            at = time.monotonic() + timeout
+        previous = self._deadline
+        self._deadline = _earliest(previous, at)
+        try:
+            yield self
+        finally:
+            self._deadline = previous
+
+    @contextmanager
+    def batch(self):
+        """
+        Context manager to send several commands in a single packet.
+
+        Within the block, generated `Proxy` methods return a
+        `concurrent.futures.Future` for each call.  Calls are packed into as
+        few packets as `PACKET_SIZE` allows, each executed in order by
+        `CommandPacketHandler` on the device and answered with a single reply
+        packet.  Pending calls are sent when the block exits (or discarded
+        if the block raises an exception).
+
+        Example:
+
+            with proxy.batch() as b:
+                for i, value in enumerate(values):
+                    b.set_x(i, value)
+                y = b.get_y()
+            print(y.result())
+        """
+        if self._batch is not None:
+            # Nested batch; calls are added to the enclosing batch.
+            yield self
+            return
+        self._batch = {'records': [], 'payload_size': RECORD_LENGTH.size,
+                       'excess': 0, 'max_excess': 0}
+        try:
+            yield self
+        except BaseException:
+            for _, future, *_ in self._batch['records']:
+                future.cancel()
+            raise
+        else:
+            self._flush_batch()
+        finally:
+            self._batch = None
+
+    def _many_payloads(self, method, args: tuple, count: int, request: bytes,
+                       dtype: Optional[str],
+                       array: bool) -> Optional[List[Tuple[int, int, bytes]]]:
+        """
+        Encode `count` calls of generated `Proxy` method `method` (see `many`)
+        in a single structured array operation and return `(index of first
+        call, number of calls, payload)` of each batch packet (see `batch`).
+
+        Return `None` if the calls cannot be encoded this way, i.e., if the
+        method has array arguments or returns an array.
+        """
+        request_struct = getattr(self, f'_REQUEST_{method.__name__.upper()}',
+                                 None)
+        if (array or request_struct is None or
+                len(request) != request_struct.size):
+            return None
+        # Record length, command code and arguments of each batch record.
+        record_dtype = np.dtype([('length', '<u2'), ('command', '<u2')] +
+                                [(f'arg{i}', '<' + format_)
+                                 for i, format_ in
+                                 enumerate(request_struct.format[2:])])
+        records = np.empty(count, dtype=record_dtype)
+        records['length'] = request_struct.size
+        records['command'] = RECORD_LENGTH.unpack_from(request)[0]
+        try:
+            for i, arg in enumerate(args):
+                records[f'arg{i}'] = arg
+        except (TypeError, ValueError):
+            # E.g., array argument.
+            return None
+        if records[:1].tobytes()[RECORD_LENGTH.size:] != request:
+            return None
+        capacity = batch_capacity(self.PACKET_SIZE, request_struct.size,
+                                  np.dtype(dtype).itemsize if dtype else 0)
+        data = records.tobytes()
+        header = RECORD_LENGTH.pack(CMD_BATCH)
+        return [(start, min(capacity, count - start),
+                 header + data[start * record_dtype.itemsize:
+                               (start + capacity) * record_dtype.itemsize])
+                for start in range(0, count, capacity)]
+
+    @staticmethod
+    def _decode_many(responses: list, dtype: Optional[str], count: int):
+        """
+        Decode `(index of first call, number of calls, response packet)` of
+        each batch packet sent by `many` into a single array of results
+        (`None` if `dtype` is `None`).
+        """
+        fields = [('length', '<u2')] + ([('value', dtype)] if dtype else [])
+        response_dtype = np.dtype(fields)
+        size = response_dtype.itemsize - RECORD_LENGTH.size
+        results = np.empty(count, dtype=dtype) if dtype else None
+        for start, length, response in responses:
+            if response.type_ != PACKET_TYPES.DATA:
+                raise IOError('Batch request rejected by device.')
+            data = response.data()
+            # Failed records (`RECORD_ERROR`) have no value, so the size of
+            # the response differs.
+            if len(data) != length * response_dtype.itemsize:
+                raise IOError('Command failed.')
+            records = np.frombuffer(data, dtype=response_dtype)
+            if (records['length'] != size).any():
+                raise IOError('Command failed.')
+            if dtype:
+                results[start:start + length] = records['value']
+        return results
+
+    @staticmethod
+    def _stack_results(results: list, dtype: Optional[str], array: bool):
+        """
+        Return results of calls of `many` as a single array (`None` if
+        `dtype` is `None`, a list of arrays if `array` is `True`).
+        """
+        if dtype is None:
+            return None
+        return results if array else np.array(results, dtype=dtype)
+
+    def many(self, method, *args, window: int = 8):
+        """
+        Call generated `Proxy` method `method` once for each value of the
+        sequence arguments in `args` (e.g., to sweep a parameter), and return
+        the results stacked in a single array (a list of arrays if the method
+        returns an array, or `None` if it returns nothing).
+
+        Each argument is either a scalar, passed to every call, or a sequence
+        (e.g., a `numpy` array) with one value per call.
+
+        If all arguments and the result of the method are scalars, all
+        requests are encoded in a single structured array operation, packed
+        into as few batch packets as `PACKET_SIZE` allows (see `batch`), and
+        sent with up to `window` packets outstanding (recorded as `batch`
+        commands in `metrics`).  Other methods are called once per value in a
+        `pipeline` of `window` requests.
+
+        If the I/O thread runs, the requests are submitted to the I/O thread
+        instead (i.e., pipelined with its window).
+
+        Example:
+
+            voltages = proxy.many(proxy.analog_read_at, 0, np.arange(10000))
+
+        .. note::
+            May not be called within a `batch` block.
+        """
+        if self._batch is not None:
+            raise RuntimeError('`many` may not be called within a `batch` '
+                               'block.')
+        count = call_count(args)
+        # Capture first call (or a call with zero for each sequence argument
+        # if there are no calls, to get the response type).
+        first = (call_arguments(args, 0) if count else
+                 tuple(0 if _is_sequence(arg) else arg for arg in args))
+        packet, dtype, array = self._capture_packet(method, *first)
+        if not count:
+            if dtype is None:
+                return None
+            return [] if array else np.empty(0, dtype=dtype)
+        request = packet.data()
+        payloads = self._many_payloads(method, args, count, request, dtype,
+                                       array)
+        # Calls are pipelined by the I/O thread if it runs.
+        threaded = self._io_requests is not None
+        with nullcontext() if threaded else self.pipeline(window):
+            if payloads is None:
+                futures = [self._call_future(*self._capture_packet(
+                               method, *call_arguments(args, i)))
+                           for i in range(count)]
+            else:
+                futures = [(start, length,
+                            self._call_future(cPacket(data=payload,
+                                                      type_=PACKET_TYPES.DATA)))
+                           for start, length, payload in payloads]
+        if payloads is None:
+            return self._stack_results([future.result()
+                                        for future in futures], dtype, array)
+        return self._decode_many([(start, length, future.result())
+                                  for start, length, future in futures],
+                                 dtype, count)
@@ -0,0 +1,110 @@
+# coding: utf-8
+"""
+Preallocated ring buffer for long acquisitions.
+
+Results are decoded directly into the storage of the ring buffer (i.e., using
+the `out` argument of generated `Proxy` methods returning an array, or of
+`Stream.read`), so an acquisition of any length allocates no arrays per
+call.
+
+Example:
+
+    ring = RingBuffer(1 << 20, 'uint16', max_block=64)
+    while acquiring:
+        ring.call(proxy.analog_read_block, 0)
+    latest = ring.latest(1000)
+"""
+from typing import Optional
+
+import numpy as np
+
+
+class RingBuffer:
+    """
+    Ring buffer of the last `capacity` values of type `dtype`.
+
+    Values are written in blocks of up to `max_block` values: `reserve`
+    returns a contiguous view to write the next block to, and `commit`
+    appends the values written.  The storage has `max_block` spare values
+    after the end, so a block is always contiguous; values written past the
+    end are moved to the start of the storage on `commit`.
+    """
+    def __init__(self, capacity: int, dtype: str, max_block: int = 256):
+        if max_block > capacity:
+            raise ValueError('`max_block` must not exceed `capacity`.')
+        self.capacity = capacity
+        self.max_block = max_block
+        self._storage = np.empty(capacity + max_block, dtype=dtype)
+        self._position = 0
+        # Total number of values written.
+        self.count = 0
+
+    @property
+    def dtype(self) -> np.dtype:
+        return self._storage.dtype
+
+    def __len__(self) -> int:
+        return min(self.count, self.capacity)
+
+    def reserve(self, size: Optional[int] = None) -> np.ndarray:
+        """
+        Return contiguous view of storage to write up to `size` values
+        (`max_block` by default) to.
+        """
+        if size is None:
+            size = self.max_block
+        elif size > self.max_block:
+            raise ValueError(f'Block size is limited to {self.max_block}.')
+        return self._storage[self._position:self._position + size]
+
+    def commit(self, count: int) -> None:
+        """
+        Append the first `count` values written to the view returned by
+        `reserve`.
+        """
+        if count > self.max_block:
+            raise ValueError(f'Block size is limited to {self.max_block}.')
+        position = self._position + count
+        if position >= self.capacity:
+            position -= self.capacity
+            self._storage[:position] = self._storage[self.capacity:
+                                                     self.capacity + position]
+        self._position = position
+        self.count += count
+
+    def extend(self, values: np.ndarray) -> None:
+        """
+        Append (i.e., copy) `values`.
+        """
+        values = np.asarray(values, dtype=self.dtype)
+        for start in range(0, len(values), self.max_block):
+            block = values[start:start + self.max_block]
+            self.reserve(len(block))[:] = block
+            self.commit(len(block))
+
+    def call(self, method, *args, **kwargs) -> np.ndarray:
+        """
+        Call generated `Proxy` method returning an array, decoding the result
+        directly into the ring buffer (i.e., `method(*args, out=...)`).
+
+        Returns
+        -------
+        numpy.ndarray
+            View of the values appended (only valid until overwritten).
+        """
+        result = method(*args, out=self.reserve(), **kwargs)
+        self.commit(len(result))
+        return result
+
+    def latest(self, count: Optional[int] = None) -> np.ndarray:
+        """
+        Return copy of the last `count` values (all values by default), in
+        the order they were written.
+        """
+        count = len(self) if count is None else min(count, len(self))
+        start = self._position - count
+        if start >= 0:
+            return self._storage[start:self._position].copy()
+        return np.concatenate([self._storage[self.capacity + start:
+                                             self.capacity],
+                               self._storage[:self._position]])
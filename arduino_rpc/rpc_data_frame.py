@@ -8,6 +8,7 @@ from path_helpers import path
 
 from . import get_library_directory
 from .dtypes import NP_STD_INT_TYPE, STD_ARRAY_TYPES
+from .schema import get_proxy_code, get_schema
 
 
 def get_c_commands_header_code(df_sig_info: pd.DataFrame, namespace: str,
@@ -75,7 +76,7 @@ typedef PacketParser<FixedPacket> parser_t;
 
 def get_c_command_processor_header_code(df_sig_info: pd.DataFrame, namespace: str,
                                         extra_header: Optional[str] = None, extra_footer: Optional[str] = None,
-                                        **kwargs):
+                                        dispatch: str = 'switch', **kwargs):
     # TODO: Update doc string to reflect generating command processor header
     """
     Generate C++ command processor header code, which decodes a command from an
@@ -90,14 +91,71 @@ def get_c_command_processor_header_code(df_sig_info: pd.DataFrame, namespace: st
      - `namespace`: Namespace to wrap `CommandProcessor` header in.
      - `extra_header`: Extra text to insert before the namespace (optional).
      - `extra_footer`: Extra text to insert after the namespace (optional).
+     - `dispatch`: `'switch'` to dispatch commands with a `switch` statement
+       (default), or `'table'` to call a handler function looked up in a
+       table (in flash on AVR) indexed by the command code relative to the
+       first command code.  The table has one entry per code between the first
+       and last command codes, so it is only dense if the command codes are
+       contiguous.
     """
-    template = jinja2.Template(r'''
+    if dispatch not in ('switch', 'table'):
+        raise ValueError(f'Unknown dispatch: `{dispatch}` (expected `switch` or `table`).')
+    template = jinja2.Template(r"""
+{%- macro command_body(method_name, camel_name, arg_count, df_method_i) -%}
+{%- if arg_count > 0 -%}
+/* Cast buffer as request. */
+{{ camel_name }}Request &request = *(reinterpret_cast
+    <{{ camel_name }}Request *>(&request_arr.data[2]));
+{% endif -%}
+{%- if df_method_i.ndims.max() > 0 -%}
+/* Add relative array data offsets to start payload structure. */
+{% for i, array_i in df_method_i[df_method_i.ndims > 0].iterrows() -%}
+request.{{ array_i['arg_name'] }}.data = ({{ array_i.atom_type }} *)((uint8_t *)&request + (uintptr_t)request.{{ array_i['arg_name'] }}.data);
+{% endfor -%}
+{%- endif -%}
+{%- if df_method_i.return_atom_type.iloc[0] is not none -%}
+{{ camel_name }}Response response;
+
+response.result = {% endif -%}
+obj_.{{ method_name }}({% if arg_count > 0 %}{{ ', '.join('request.' + df_method_i.arg_name) }}{% endif %});
+{% if df_method_i.return_atom_type.iloc[0] is not none -%}
+/* Copy result to output buffer. */
+{% if df_method_i.return_ndims.iloc[0] > 0 -%}
+/* Result type is an array, so need to do `memcpy` for array data. */
+uint32_t length = (response.result.length *
+                   sizeof(response.result.data[0]));
+
+result.data = (uint8_t *)response.result.data;
+result.length = length;
+{%- else -%}
+/* Cast start of buffer as reference of result type and assign result. */
+{{ camel_name }}Response &output = *(reinterpret_cast
+    <{{ camel_name }}Response *>(&buffer.data[0]));
+output = response;
+result.data = buffer.data;
+result.length = sizeof(output);
+{%- endif %}
+{%- else -%}
+result.data = buffer.data;
+result.length = 0;
+{%- endif %}
+{%- endmacro -%}
 #ifndef ___{{ namespace.upper() }}__COMMAND_PROCESSOR___
 #define ___{{ namespace.upper() }}__COMMAND_PROCESSOR___
 
 #include "CArrayDefs.h"
 #include "Commands.h"
-
+{% if dispatch == 'table' %}
+#ifndef ARDUINO_RPC_PROGMEM
+#if defined(__AVR__)
+#include <avr/pgmspace.h>
+/* Store handler table in flash. */
+#define ARDUINO_RPC_PROGMEM PROGMEM
+#else
+#define ARDUINO_RPC_PROGMEM
+#endif
+#endif
+{% endif %}
 {% if extra_header is not none %}
 {{ extra_header }}
 {% endif %}
@@ -116,6 +174,19 @@ class CommandProcessor {
    * must contain response values. */
 protected:
   Obj &obj_;
+{%- if dispatch == 'table' %}
+
+  typedef UInt8Array (*handler_t)(Obj &obj_, UInt8Array request_arr,
+                                  UInt8Array buffer);
+{% for (method_i, method_name, camel_name, arg_count), df_method_i in df_sig_info.groupby(['method_i', 'method_name', 'camel_name', 'arg_count']) %}
+  static UInt8Array
+  process_{{ method_name }}(Obj &obj_, UInt8Array request_arr, UInt8Array buffer) {
+    UInt8Array result;
+    {{ command_body(method_name, camel_name, arg_count, df_method_i)|indent(4) }}
+    return result;
+  }
+{% endfor %}
+{%- endif %}
 public:
   CommandProcessor(Obj &obj) : obj_(obj) {}
 
@@ -129,52 +200,38 @@ public:
 
     UInt8Array result;
     uint16_t &command = *reinterpret_cast<uint16_t *>(&request_arr.data[0]);
-
+{% if dispatch == 'table' %}
+    /* Handler of each command code from `{{ '0x%02x' % handlers[0][0] }}` to `{{ '0x%02x' % handlers[-1][0] }}` (`NULL` for
+     * unused codes). */
+    static const handler_t handlers[] ARDUINO_RPC_PROGMEM = {
+{%- for code, method_name in handlers %}
+      {% if method_name is none %}NULL{% else %}&process_{{ method_name }}{% endif %},  // {{ '0x%02x' % code }}
+{%- endfor %}
+    };
+    /* Codes below the first command code wrap around to large indexes. */
+    const uint16_t index = command - {{ '0x%02x' % handlers[0][0] }};
+    handler_t handler = NULL;
+
+    if (index < sizeof(handlers) / sizeof(handlers[0])) {
+#if defined(__AVR__)
+      handler = reinterpret_cast<handler_t>(pgm_read_ptr(&handlers[index]));
+#else
+      handler = handlers[index];
+#endif
+    }
+    if (handler == NULL) {
+      result.length = 0xFFFFFFFF;
+      result.data = NULL;
+      return result;
+    }
+    return handler(obj_, request_arr, buffer);
+{%- else %}
     // Interpret first byte of request as command code.
     switch (command) {
 {% for (method_i, method_name, camel_name, arg_count), df_method_i in df_sig_info.groupby(['method_i', 'method_name', 'camel_name', 'arg_count']) %}
         case CMD_{{ method_name.upper() }}:
           {
-            /* Cast buffer as request. */
-    {% if arg_count > 0 %}
-            {{ camel_name }}Request &request = *(reinterpret_cast
-                                          <{{ camel_name }}Request *>
-                                          (&request_arr.data[2]));
-    {% endif %}
-    {% if df_method_i.ndims.max() > 0 %}
-            /* Add relative array data offsets to start payload structure. */
-    {% for i, array_i in df_method_i[df_method_i.ndims > 0].iterrows() %}
-            request.{{ array_i['arg_name'] }}.data = ({{ array_i.atom_type }} *)((uint8_t *)&request + (unsigned int)request.{{ array_i['arg_name'] }}.data);
-    {%- endfor %}
-    {%- endif -%}
-
-    {%- if df_method_i.return_atom_type.iloc[0] is not none %}
-            {{ camel_name }}Response response;
-
-            response.result = {%- endif %}
-            obj_.{{ method_name }}({% if arg_count > 0 %}{{ ', '.join('request.' + df_method_i.arg_name) }}{% endif %});
-    {% if df_method_i.return_atom_type.iloc[0] is not none %}
-            /* Copy result to output buffer. */
-    {%- if df_method_i.return_ndims.iloc[0] > 0 %}
-            /* Result type is an array, so need to do `memcpy` for array data. */
-            uint32_t length = (response.result.length *
-                               sizeof(response.result.data[0]));
-
-            result.data = (uint8_t *)response.result.data;
-            result.length = length;
-    {%- else %}
-            /* Cast start of buffer as reference of result type and assign result. */
-            {{ camel_name }}Response &output = *(reinterpret_cast
-                                                 <{{ camel_name }}Response *>
-                                                 (&buffer.data[0]));
-            output = response;
-            result.data = buffer.data;
-            result.length = sizeof(output);
-    {%- endif %}
-    {%- else %}
-        result.data = buffer.data;
-        result.length = 0;
-    {%- endif %}
+            {{ command_body(method_name, camel_name, arg_count, df_method_i)|indent(12) }}
           }
           break;
 {% endfor %}
@@ -183,6 +240,7 @@ public:
         result.data = NULL;
     }
     return result;
+{%- endif %}
   }
 };
 
@@ -193,15 +251,23 @@ public:
 {% endif %}
 
 #endif  // ifndef ___{{ namespace.upper() }}___
-'''.strip())
+""".strip())
+    codes = dict(df_sig_info.drop_duplicates(subset='method_i')[['method_i', 'method_name']].values)
+    handlers = [(code, codes.get(code)) for code in range(min(codes), max(codes) + 1)]
+    if dispatch == 'table' and len(codes) < len(handlers) // 2:
+        import warnings
+
+        warnings.warn(f'Handler table has {len(handlers)} entries for {len(codes)} commands (command codes are '
+                      'not contiguous).')
     return template.render(df_sig_info=df_sig_info, namespace=namespace,
                            extra_header=extra_header,
-                           extra_footer=extra_footer, **kwargs)
+                           extra_footer=extra_footer, dispatch=dispatch,
+                           handlers=handlers, **kwargs)
 
 
 def get_python_code(df_sig_info: pd.DataFrame,
                     extra_header: Optional[str] = None, extra_footer: Optional[str] = None,
-                    pointer_width: int = 16):
+                    pointer_width: int = 16, async_: bool = False):
     """
     Generate Python `Proxy` class, with one method for each corresponding
     method signature in `df_sig_info`.  Each method on the `Proxy` class:
@@ -218,123 +284,24 @@ def get_python_code(df_sig_info: pd.DataFrame,
        returned by `arduino_rpc.code_gen.get_multilevel_method_sig_frame`).
      - `extra_header`: Extra text to insert before class definition (optional).
      - `extra_footer`: Extra text to insert after class definition (optional).
+     - `async_`: If `True`, derive `Proxy` from
+       `arduino_rpc.async_proxy.AsyncProxyBase` and generate coroutine
+       methods (optional).
+
+    Methods returning an array accept an optional `out` argument: a
+    preallocated `numpy` array to decode the result into (e.g., a block of an
+    `arduino_rpc.ring_buffer.RingBuffer`), returning a view of `out`, and an
+    optional `chunk_size`: if specified, the device sends the result in
+    packets of up to `chunk_size` bytes, decoded into a single array as they
+    arrive (see `arduino_rpc.proxy.ProxyBase.iter_chunks`).
+
+    The generated module only imports `numpy`, `nadamq` and the
+    `arduino_rpc` proxy base class at runtime; code generation dependencies
+    (e.g., `pandas`, `clang`) are not required to use it.
     """
-    # TODO: The size of an `*Array` struct depends on the architecture.
-    #
-    # Specifically, on 8-bit AVR processors, addresses are 16-bit, but on
-    # 32-bit processors (e.g., Teensy 3.2 ARM) addresses are 32-bit.  Since one
-    # of the `*Array` struct member variables (i.e., `data`) is a pointer, the
-    # size of the structure differs based on the pointer size for the
-    # architecture.
-    #
-    # How should we handle this?
-    #
-    # Take a pointer bit-width as an argument, `pointer_width=32`.
-    template = jinja2.Template(r'''
-import pandas as pd
-import numpy as np
-from nadamq.NadaMq import cPacket, PACKET_TYPES
-{%- if extra_header is not none %}
-{% if 'ProxyBase' not in extra_header -%}
-from arduino_rpc.proxy import ProxyBase
-{% endif -%}{%- endif %}
-
-try:
-    from google.protobuf.message import Message
-    _translate = (lambda arg: arg.SerializeToString()
-                  if isinstance(arg, Message) else arg)
-except ImportError:
-    _translate = lambda arg: arg
-
-{% if extra_header is not none -%}
-{{ extra_header }}
-{%- endif %}
-
-
-class Proxy(ProxyBase):
-{%- for i, (method_i, method_name) in 
-        df_sig_info.drop_duplicates(subset='method_i')[['method_i', 'method_name']].iterrows() %}
-    _CMD_{{ method_name.upper() }} = {{ '0x%02x' % method_i }}
-{%- endfor %}
-    MAX_COMMAND_CODE = {{ df_sig_info.method_i.max() }}
-{% for (method_i, method_name, camel_name, arg_count), df_method_i in 
-        df_sig_info.groupby(['method_i', 'method_name', 'camel_name', 'arg_count']) %}
-    def {{ method_name }}(self{% if arg_count > 0 %}, {{ ', '.join(df_method_i.arg_name) }}{% endif %}):
-        command = np.dtype('uint16').type(self._CMD_{{ method_name.upper() }})
-{%- if arg_count > 0 %}
-        ARG_STRUCT_SIZE = {{ df_method_i.struct_size.sum() }}
-{%- if df_method_i.ndims.max() > 0 %}
-{% for i, array_i in df_method_i[df_method_i.ndims > 0].iterrows() %}
-        {{ array_i['arg_name'] }} = _translate({{ array_i['arg_name'] }})
-        if isinstance({{ array_i['arg_name'] }}, str):
-            {{ array_i['arg_name'] }} = map(ord, {{ array_i['arg_name'] }})
-        elif isinstance({{ array_i['arg_name'] }}, bytes):
-            {{ array_i['arg_name'] }} = list(bytes({{ array_i['arg_name'] }}))
-        # Argument is an array, so cast to appropriate array type.
-        {{ array_i['arg_name'] }} = np.ascontiguousarray({{ array_i['arg_name'] }}, dtype='{{ array_i.atom_np_type }}')
-{%- endfor %}
-        array_info = pd.DataFrame([
-{%- for arg_name in df_method_i.loc[df_method_i.ndims > 0, 'arg_name'] -%}
-        {{ arg_name }}.shape[0], {% endfor -%}],
-                                  index=[
-{%- for arg_name in df_method_i.loc[df_method_i.ndims > 0, 'arg_name'] -%}
-        '{{ arg_name }}', {% endfor -%}],
-                                  columns=['length'])
-        array_info['start'] = array_info.length.cumsum() - array_info.length
-        array_data = b''.join([
-{%- for arg_name in df_method_i.loc[df_method_i.ndims > 0, 'arg_name'] -%}
-        {{ arg_name }}.tobytes(), {% endfor -%}])
-{%- else %}
-        array_data = b''
-{%- endif %}
-        payload_size = ARG_STRUCT_SIZE + len(array_data)
-        struct_data = np.array([(
-{%- for i, (arg_name, ndims, np_atom_type) in df_method_i[['arg_name', 'ndims', 'atom_np_type']].iterrows() -%}
-{%- if ndims > 0 -%}
-        array_info.length['{{ arg_name }}'], ARG_STRUCT_SIZE + array_info.start['{{ arg_name }}'], {# #}
-{%- else -%}
-        {{ arg_name }}, {# #}
-{%- endif -%}
-{% endfor %})],
-                               dtype=[
-{%- for i, (arg_name, ndims, np_atom_type) in df_method_i[['arg_name', 'ndims', 'atom_np_type']].iterrows() -%}
-{%- if ndims > 0 -%}
-        ('{{ arg_name }}_length', 'uint32'), ('{{ arg_name }}_data', 'uint{{ pointer_width }}'), {% else -%}
-        ('{{ arg_name }}', '{{ np_atom_type }}'), {% endif %}{% endfor %}])
-        payload_data = struct_data.tobytes() + array_data
-{%- else %}
-        payload_size = 0
-        payload_data = b''
-{%- endif %}
-
-        payload_data = command.tobytes() + payload_data
-        packet = cPacket(data=payload_data, type_=PACKET_TYPES.DATA)
-        response = self._send_command(packet)
-{% if df_method_i.return_atom_type.iloc[0] is not none %}
-        result = np.frombuffer(response.data(), dtype='{{ df_method_i.return_atom_np_type.iloc[0] }}')
-{% if df_method_i.return_ndims.iloc[0] > 0 %}
-        # Return type is an array, so return entire array.
-        return result
-{% else %}
-        # Return type is a scalar, so return first entry of array.
-        return result[0]
-{% endif -%}{%- else %}
-        return response  
-{% endif -%}
-{%- endfor %}
-
-{% if extra_footer is not none -%}
-{{ extra_footer }}
-{%- endif %}
-'''.strip())
-    df_sig_info_ = df_sig_info.copy()
-    # Avoid shadowing builtins
-    builtin_names = ['str', 'list', 'dict', 'set', 'len', 'sum', 'max',
-                     'min', 'open', 'input', 'id', 'format', 'range', 'type']
-    df_sig_info_.arg_name = df_sig_info_.arg_name.replace({name: name + '_' for name in builtin_names})
-    return template.render(df_sig_info=df_sig_info_, extra_header=extra_header,
-                           extra_footer=extra_footer, pointer_width=pointer_width,
-                           )
+    return get_proxy_code(get_schema(df_sig_info, pointer_width=pointer_width),
+                          extra_header=extra_header, extra_footer=extra_footer,
+                          async_=async_)
 
 
 def get_struct_sig_info_frame(df_sig_info: pd.DataFrame, pointer_width: int = 16) -> pd.DataFrame:
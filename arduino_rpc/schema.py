@@ -0,0 +1,320 @@
+# coding: utf-8
+"""
+Method signature schemas, and `Proxy` classes built from them at runtime.
+
+A schema holds the columns of a method signature frame (as returned by
+`arduino_rpc.code_gen.get_multilevel_method_sig_frame`) required to encode
+requests and decode responses, i.e., everything `get_proxy_code` needs to
+generate the Python `Proxy` class.  Schemas may be saved as JSON or, if
+`msgpack` is installed, msgpack, so a deployment may ship a small schema file
+instead of a generated module (or `libclang` to generate one):
+
+    # At build time (requires `pandas` and `clang`):
+    write_schema(get_schema(df_sig_info), 'node.schema.json')
+
+    # At runtime (requires only `numpy`, `nadamq` and `jinja2`):
+    Proxy = get_proxy_class('node.schema.json')
+    proxy = Proxy(serial_device)
+
+`Proxy` classes are cached by schema hash, so only the first call for each
+schema renders and compiles the class.
+"""
+import hashlib
+import json
+import os
+import struct
+from typing import Dict, List, Optional, Tuple, Union
+
+import jinja2
+import numpy as np
+
+SCHEMA_VERSION = 1
+# Columns of a method signature frame stored in a schema.
+SCHEMA_COLUMNS = ('method_i', 'method_name', 'arg_count', 'arg_name', 'ndims',
+                  'atom_np_type', 'return_atom_np_type', 'return_ndims')
+# File extensions of msgpack encoded schemas (all others are JSON).
+MSGPACK_EXTENSIONS = ('.msgpack', '.mpk')
+
+# `struct` format character of each `numpy` type kind and size (in bytes).
+STRUCT_FORMATS = {('b', 1): '?', ('i', 1): 'b', ('u', 1): 'B', ('i', 2): 'h',
+                  ('u', 2): 'H', ('i', 4): 'i', ('u', 4): 'I', ('i', 8): 'q',
+                  ('u', 8): 'Q', ('f', 4): 'f', ('f', 8): 'd'}
+
+# Argument names renamed (with a `_` suffix) in generated methods to avoid
+# shadowing builtins...
+BUILTIN_NAMES = ('str', 'list', 'dict', 'set', 'len', 'sum', 'max', 'min',
+                 'open', 'input', 'id', 'format', 'range', 'type',
+                 # ...or clashing with the `out` and `chunk_size` arguments of
+                 # methods returning an array.
+                 'out', 'chunk_size')
+
+# `Proxy` classes built by `get_proxy_class`, keyed by `(schema hash, async_)`.
+_PROXY_CLASSES: Dict[Tuple[str, bool], type] = {}
+
+PYTHON_TEMPLATE = jinja2.Template(r'''
+import struct
+from time import perf_counter_ns
+
+from arduino_rpc.proxy import Request, as_array
+{%- if extra_header is none or base_class not in extra_header %}
+{% if async_ -%}
+from arduino_rpc.async_proxy import AsyncProxyBase
+{%- else -%}
+from arduino_rpc.proxy import ProxyBase
+{%- endif %}
+{%- endif %}
+
+try:
+    from google.protobuf.message import Message
+    _translate = (lambda arg: arg.SerializeToString()
+                  if isinstance(arg, Message) else arg)
+except ImportError:
+    _translate = lambda arg: arg
+
+{% if extra_header is not none -%}
+{{ extra_header }}
+{%- endif %}
+
+
+class Proxy({{ base_class }}):
+{%- for method in methods %}
+    _CMD_{{ method.name.upper() }} = {{ '0x%02x' % method.code }}
+{%- endfor %}
+    MAX_COMMAND_CODE = {{ methods|map(attribute='code')|max }}
+    # Packed command code and `*Request` structure of each command.
+{%- for method in methods %}
+    _REQUEST_{{ method.name.upper() }} = struct.Struct('{{ method.format }}')
+{%- endfor %}
+{% for method in methods|sort(attribute='code') %}
+    {% if async_ %}async {% endif %}def {{ method.name }}(self{% for arg in method.args %}, {{ arg.name }}{% endfor %}{% if method.return_ndims > 0 %}, out=None, chunk_size=None{% endif %}):
+        encode_start = perf_counter_ns() if self.metrics is not None else 0
+{%- set arrays = method.args|selectattr('ndims')|list %}
+{%- if arrays %}
+{%- for array_i in arrays %}
+        # Argument is an array, so cast to appropriate array type (without
+        # copying if it already is one).
+        {{ array_i.name }} = as_array(_translate({{ array_i.name }}), '{{ array_i.np_type }}')
+{%- endfor %}
+        # Array data follows the request structure, at offsets (in bytes)
+        # relative to the start of the structure.
+{%- for array_i in arrays %}
+{%- if loop.first %}
+        {{ array_i.name }}_offset = {{ method.size - 2 }}
+{%- else %}
+        {{ array_i.name }}_offset = {{ loop.previtem.name }}_offset + {{ loop.previtem.name }}.nbytes
+{%- endif %}
+{%- endfor %}
+        packet = Request(self._REQUEST_{{ method.name.upper() }}, (self._CMD_{{ method.name.upper() }}, {# #}
+{%- for arg in method.args -%}
+{%- if arg.ndims > 0 -%}
+        {{ arg.name }}.size, {{ arg.name }}_offset{% else %}{{ arg.name }}{% endif %}{% if not loop.last %}, {% endif %}
+{%- endfor %}),
+                         ({{ arrays|join(', ', attribute='name') }}, ))
+{%- else %}
+        packet = Request(self._REQUEST_{{ method.name.upper() }}, (self._CMD_{{ method.name.upper() }}{% for arg in method.args %}, {{ arg.name }}{% else %}, {% endfor %}))
+{%- endif %}
+{%- if method.return_np_type is not none %}
+{%- if method.return_ndims > 0 %}
+        # Return type is an array, so return entire array.
+        return {% if async_ %}await {% endif %}self._call(packet, '{{ method.return_np_type }}', True,
+{{ ' ' * (32 if async_ else 26) }}encode_start=encode_start, out=out,
+{{ ' ' * (32 if async_ else 26) }}chunk_size=chunk_size)
+{% else %}
+        # Return type is a scalar, so return first entry of array.
+        return {% if async_ %}await {% endif %}self._call(packet, '{{ method.return_np_type }}',
+{{ ' ' * (32 if async_ else 26) }}encode_start=encode_start)
+{% endif -%}{%- else %}
+        return {% if async_ %}await {% endif %}self._call(packet, encode_start=encode_start)
+{% endif -%}
+{%- endfor %}
+
+{% if extra_footer is not none -%}
+{{ extra_footer }}
+{%- endif %}
+'''.strip())
+
+
+def _to_builtin(value):
+    # Convert `numpy` scalars (and `NaN`) to JSON/msgpack serializable values.
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float) and value != value:
+        return None
+    return value
+
+
+def get_schema(df_sig_info, pointer_width: int = 16) -> dict:
+    """
+    Return schema of the methods in a signature frame.
+
+    Arguments
+    ---------
+
+     - `df_sig_info`: A `pandas.DataFrame` with one row per method argument (as
+       returned by `arduino_rpc.code_gen.get_multilevel_method_sig_frame`).
+     - `pointer_width`: Pointer size (in bits) of the device.
+    """
+    rows = df_sig_info[list(SCHEMA_COLUMNS)].itertuples(index=False)
+    return {'version': SCHEMA_VERSION, 'pointer_width': pointer_width,
+            'columns': list(SCHEMA_COLUMNS),
+            'data': [[_to_builtin(v) for v in row] for row in rows]}
+
+
+def schema_hash(schema: dict) -> str:
+    """
+    Return SHA-256 hex digest of the canonical JSON encoding of a schema.
+    """
+    encoded = json.dumps(schema, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(encoded.encode('utf8')).hexdigest()
+
+
+def write_schema(schema: dict, filepath: Union[str, os.PathLike]) -> None:
+    """
+    Write schema to file, encoded as msgpack if the file extension is one of
+    `MSGPACK_EXTENSIONS`, or JSON otherwise.
+    """
+    if os.path.splitext(filepath)[1] in MSGPACK_EXTENSIONS:
+        import msgpack
+
+        with open(filepath, 'wb') as output:
+            output.write(msgpack.packb(schema))
+    else:
+        with open(filepath, 'w') as output:
+            json.dump(schema, output, indent=1)
+
+
+def read_schema(filepath: Union[str, os.PathLike]) -> dict:
+    """
+    Read schema written by `write_schema`.
+
+    Raises
+    ------
+
+     - `ValueError`: If the schema version is not supported.
+    """
+    if os.path.splitext(filepath)[1] in MSGPACK_EXTENSIONS:
+        import msgpack
+
+        with open(filepath, 'rb') as input_:
+            schema = msgpack.unpackb(input_.read())
+    else:
+        with open(filepath, 'r') as input_:
+            schema = json.load(input_)
+    if schema.get('version') != SCHEMA_VERSION:
+        raise ValueError(f'Unsupported schema version: `{schema.get("version")}` '
+                         f'(expected `{SCHEMA_VERSION}`).')
+    return schema
+
+
+def get_request_format(args: List[dict], pointer_width: int = 16) -> str:
+    """
+    Return `struct` format of the command code followed by the packed
+    `*Request` structure of a method (as generated by
+    `arduino_rpc.rpc_data_frame.get_c_commands_header_code`), little-endian.
+
+    Each array argument is an `*Array` structure, i.e., a `uint32_t` length
+    and a data pointer of `pointer_width` bits (sent as the offset of the
+    array data relative to the start of the request structure).
+
+    Arguments
+    ---------
+
+     - `args`: Method arguments, each a dictionary with `ndims` and
+       `np_type` (i.e., `numpy` atom type) keys.
+     - `pointer_width`: Pointer size (in bits) of the device.
+    """
+    format_ = '<H'
+    for arg in args:
+        if arg['ndims'] > 0:
+            format_ += 'I' + STRUCT_FORMATS['u', pointer_width // 8]
+        else:
+            dtype = np.dtype(arg['np_type'])
+            format_ += STRUCT_FORMATS[dtype.kind, dtype.itemsize]
+    return format_
+
+
+def get_methods(schema: dict) -> List[dict]:
+    """
+    Return methods of a schema, in order of first occurrence.
+
+    Each method is a dictionary with the keys:
+
+     - `name`, `code`: Method name and command code.
+     - `args`: Arguments, each a dictionary with `name`, `ndims` and
+       `np_type` keys.  Names shadowing a builtin (see `BUILTIN_NAMES`) are
+       suffixed with `_`.
+     - `return_np_type`, `return_ndims`: `numpy` atom type (`None` if the
+       method has no return value) and dimensions of the return value.
+     - `format`, `size`: `struct` format and size of the packed request (see
+       `get_request_format`).
+    """
+    pointer_width = schema['pointer_width']
+    methods = {}
+    for values in schema['data']:
+        row = dict(zip(schema['columns'], values))
+        if row['method_name'] not in methods:
+            methods[row['method_name']] = {'name': row['method_name'],
+                                           'code': int(row['method_i']),
+                                           'args': [],
+                                           'return_np_type': row['return_atom_np_type'],
+                                           'return_ndims': int(row['return_ndims'] or 0)}
+        if row['arg_count'] and row['arg_name'] is not None:
+            name = row['arg_name']
+            methods[row['method_name']]['args'].append({'name': name + '_' if name in BUILTIN_NAMES else name,
+                                                        'ndims': int(row['ndims'] or 0),
+                                                        'np_type': row['atom_np_type']})
+    methods = list(methods.values())
+    for method in methods:
+        method['format'] = get_request_format(method['args'], pointer_width)
+        method['size'] = struct.calcsize(method['format'])
+    return methods
+
+
+def get_proxy_code(schema: dict, extra_header: Optional[str] = None,
+                   extra_footer: Optional[str] = None, async_: bool = False) -> str:
+    """
+    Generate Python `Proxy` class code from a schema (see
+    `arduino_rpc.rpc_data_frame.get_python_code`).
+
+    Arguments
+    ---------
+
+     - `schema`: Schema, as returned by `get_schema` or `read_schema`.
+     - `extra_header`: Extra text to insert before class definition (optional).
+     - `extra_footer`: Extra text to insert after class definition (optional).
+     - `async_`: If `True`, derive `Proxy` from
+       `arduino_rpc.async_proxy.AsyncProxyBase` and generate coroutine
+       methods (optional).
+    """
+    return PYTHON_TEMPLATE.render(methods=get_methods(schema),
+                                  extra_header=extra_header,
+                                  extra_footer=extra_footer, async_=async_,
+                                  base_class='AsyncProxyBase' if async_ else 'ProxyBase')
+
+
+def get_proxy_class(schema: Union[dict, str, os.PathLike], async_: bool = False) -> type:
+    """
+    Return `Proxy` class for a schema, building it on first use.
+
+    Classes are cached by schema hash, i.e., calls with equal schemas (e.g.,
+    read from the same file) return the same class.
+
+    Arguments
+    ---------
+
+     - `schema`: Schema, or path of schema file (see `read_schema`).
+     - `async_`: If `True`, return `asyncio` `Proxy` class (i.e., derived from
+       `arduino_rpc.async_proxy.AsyncProxyBase`).
+    """
+    if not isinstance(schema, dict):
+        schema = read_schema(schema)
+    key = schema_hash(schema), bool(async_)
+    proxy_class = _PROXY_CLASSES.get(key)
+    if proxy_class is None:
+        module_name = f'{__name__}.proxy_{key[0][:12]}'
+        code = compile(get_proxy_code(schema, async_=async_),
+                       f'<{module_name}>', 'exec')
+        namespace = {'__name__': module_name}
+        exec(code, namespace)
+        proxy_class = _PROXY_CLASSES.setdefault(key, namespace['Proxy'])
+    return proxy_class
@@ -0,0 +1,204 @@
+# coding: utf-8
+"""
+Device-push streaming of command results.
+
+The host asks the device to process a command request periodically (every
+`interval_ms` milliseconds, or on every iteration of the main loop if `0`)
+and to send each result as an unsolicited `STREAM` packet, tagged with a
+stream identifier in the `iuid` field of the packet header (see
+`CommandPacketHandler::poll_streams`).  Results are buffered by the proxy as
+they arrive and consumed as `numpy` blocks, so throughput is bounded by the
+link rather than by the round-trip time of each request.
+
+Example:
+
+    with proxy.stream(proxy.analog_read, 0, interval_ms=1) as samples:
+        for block in samples:
+            ...
+
+    async with proxy.stream(proxy.analog_read, 0) as samples:
+        async for block in samples:
+            ...
+"""
+import asyncio
+import struct
+import time
+from typing import Optional
+
+import numpy as np
+
+from .proxy import CommandTimeoutError, ProxyBase
+
+# Reserved command codes to start/stop a stream.
+CMD_STREAM_START = 0xFFFE
+CMD_STREAM_STOP = 0xFFFD
+# Command code, stream identifier and interval (start only).
+STREAM_START = struct.Struct('<HHI')
+STREAM_STOP = struct.Struct('<HH')
+
+
+def start_request(stream_id: int, interval_ms: int, request: bytes) -> bytes:
+    """
+    Return payload of a request to stream the result of the serialized
+    command `request`.
+    """
+    return STREAM_START.pack(CMD_STREAM_START, stream_id, interval_ms) + request
+
+
+def stop_request(stream_id: int) -> bytes:
+    return STREAM_STOP.pack(CMD_STREAM_STOP, stream_id)
+
+
+class StreamBase:
+    """
+    Buffer of results received for a stream.
+
+    Arguments
+    ---------
+
+     - `stream_id`: Stream identifier (i.e., `iuid` of stream packets).
+     - `dtype`: Type of each value of the command result.
+     - `buffer_size`: Maximum number of bytes to buffer.  If results are not
+       consumed fast enough, the oldest buffered results are discarded (see
+       `dropped`).
+    """
+    def __init__(self, stream_id: int, dtype: str,
+                 buffer_size: int = 1 << 20):
+        self.id = stream_id
+        self.dtype = np.dtype(dtype)
+        self.buffer_size = buffer_size
+        # Number of results received and discarded (buffer overflow).
+        self.received = 0
+        self.dropped = 0
+        self.active = True
+        self._data = bytearray()
+
+    def push(self, data: bytes) -> None:
+        """
+        Append payload of a stream packet to the buffer.
+        """
+        self.received += 1
+        self._data += data
+        excess = len(self._data) - self.buffer_size
+        if excess > 0:
+            # Discard whole values only.
+            excess += -excess % self.dtype.itemsize
+            self.dropped += excess // self.dtype.itemsize
+            del self._data[:excess]
+
+    @property
+    def available(self) -> int:
+        """
+        Number of buffered values.
+        """
+        return len(self._data) // self.dtype.itemsize
+
+    def _take(self, count: Optional[int] = None,
+              out: Optional[np.ndarray] = None) -> np.ndarray:
+        if count is None:
+            count = self.available
+            if out is not None:
+                count = min(count, out.size)
+        size = count * self.dtype.itemsize
+        if out is not None:
+            block = ProxyBase._decode_into(memoryview(self._data)[:size],
+                                           self.dtype, out)
+        else:
+            block = np.frombuffer(bytes(self._data[:size]), dtype=self.dtype)
+        del self._data[:size]
+        return block
+
+
+class Stream(StreamBase):
+    """
+    Stream of results received by a `ProxyBase` (see `ProxyBase.stream`).
+
+    Iterating yields a block (i.e., `numpy` array) of all values received
+    since the previous block, waiting until at least one value is available.
+    """
+    def __init__(self, proxy, stream_id: int, dtype: str, **kwargs):
+        super().__init__(stream_id, dtype, **kwargs)
+        self._proxy = proxy
+
+    def read(self, count: Optional[int] = None,
+             timeout: Optional[float] = None,
+             out: Optional[np.ndarray] = None) -> np.ndarray:
+        """
+        Return the next `count` values (or all buffered values, at least one,
+        if `count` is `None`), waiting for results from the device as needed.
+
+        Raises `CommandTimeoutError` if the values are not received within
+        `timeout` seconds (values received so far remain buffered).
+
+        If `out` is specified, values are copied into `out` (e.g., a block of
+        a `arduino_rpc.ring_buffer.RingBuffer`) and a view of `out` is
+        returned.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.available < (count or 1):
+            if not self.active:
+                raise EOFError('Stream stopped.')
+            self._proxy._pump(deadline)
+        return self._take(count, out)
+
+    def __iter__(self):
+        while self.active or self.available:
+            yield self.read()
+
+
+class AsyncStream(StreamBase):
+    """
+    Stream of results received by an `AsyncProxyBase` (see
+    `AsyncProxyBase.stream`).
+
+    Asynchronous iteration yields a block (i.e., `numpy` array) of all values
+    received since the previous block, waiting until at least one value is
+    available.
+    """
+    def __init__(self, stream_id: int, dtype: str, **kwargs):
+        super().__init__(stream_id, dtype, **kwargs)
+        self._received = asyncio.Event()
+
+    def push(self, data: bytes) -> None:
+        super().push(data)
+        self._received.set()
+
+    def close(self) -> None:
+        self.active = False
+        self._received.set()
+
+    async def read(self, count: Optional[int] = None,
+                   timeout: Optional[float] = None,
+                   out: Optional[np.ndarray] = None) -> np.ndarray:
+        """
+        Return the next `count` values (or all buffered values, at least one,
+        if `count` is `None`), waiting for results from the device as needed.
+
+        Raises `CommandTimeoutError` if the values are not received within
+        `timeout` seconds (values received so far remain buffered).
+
+        If `out` is specified, values are copied into `out` (e.g., a block of
+        a `arduino_rpc.ring_buffer.RingBuffer`) and a view of `out` is
+        returned.
+        """
+        loop = asyncio.get_running_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+        while self.available < (count or 1):
+            if not self.active:
+                raise EOFError('Stream stopped.')
+            self._received.clear()
+            remaining = None if deadline is None else deadline - loop.time()
+            try:
+                await asyncio.wait_for(self._received.wait(), remaining)
+            except asyncio.TimeoutError:
+                raise CommandTimeoutError('Timed out waiting for stream.')
+        return self._take(count, out)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> np.ndarray:
+        try:
+            return await self.read()
+        except EOFError:
+            raise StopAsyncIteration
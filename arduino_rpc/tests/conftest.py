@@ -0,0 +1,170 @@
+# coding: utf-8
+"""
+Fixtures to test generated `Proxy` classes against an emulated device (see
+`arduino_rpc.emulator`), without hardware or `libclang`.
+"""
+import os
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from arduino_rpc.emulator import DeviceEmulator, EmulatedSerial
+from arduino_rpc.schema import get_proxy_class, get_schema
+from arduino_rpc.transport import FileDescriptorTransport
+
+# Signature frame of the `Node` class below, as returned by
+# `arduino_rpc.code_gen.get_multilevel_method_sig_frame` for the
+# corresponding C++ class.
+SIG_INFO_COLUMNS = ['method_i', 'method_name', 'camel_name', 'arg_count',
+                    'arg_name', 'ndims', 'atom_type', 'atom_np_type',
+                    'struct_atom_type', 'struct_size', 'return_atom_type',
+                    'return_atom_np_type', 'return_ndims',
+                    'return_struct_atom_type', 'class_name', 'header_name']
+SIG_INFO_ROWS = [
+    (0x10, 'ram_free', 'RamFree', 0, None, 0, None, None, None, 0,
+     'uint32_t', 'uint32', 0, 'uint32_t'),
+    (0x11, 'set_x', 'SetX', 1, 'value', 0, 'float', 'float32', 'float', 4,
+     None, None, 0, None),
+    (0x12, 'str_echo', 'StrEcho', 1, 'msg', 1, 'uint8_t', 'uint8',
+     'UInt8Array', 6, 'uint8_t', 'uint8', 1, 'UInt8Array'),
+    (0x13, 'add', 'Add', 2, 'a', 0, 'int32_t', 'int32', 'int32_t', 4,
+     'int32_t', 'int32', 0, 'int32_t'),
+    (0x13, 'add', 'Add', 2, 'b', 0, 'int32_t', 'int32', 'int32_t', 4,
+     'int32_t', 'int32', 0, 'int32_t'),
+    (0x14, 'samples', 'Samples', 1, 'count', 0, 'uint16_t', 'uint16',
+     'uint16_t', 2, 'uint16_t', 'uint16', 1, 'UInt16Array'),
+]
+# Size of chunked request buffer of emulated device (and `MAX_REQUEST_SIZE`
+# of proxies).
+CHUNK_BUFFER_SIZE = 256
+
+
+class Node:
+    """
+    Python implementation of the methods of the emulated device.
+    """
+    def __init__(self):
+        self.x = 0
+        self.calls = 0
+
+    def ram_free(self):
+        self.calls += 1
+        return self.calls
+
+    def set_x(self, value):
+        self.x = value
+
+    def str_echo(self, msg):
+        return msg
+
+    def add(self, a, b):
+        return a + b
+
+    def samples(self, count):
+        return np.arange(count)
+
+
+def get_sig_info() -> pd.DataFrame:
+    rows = [row + ('Node', 'Node.h') for row in SIG_INFO_ROWS]
+    df_sig_info = pd.DataFrame(rows, columns=SIG_INFO_COLUMNS).astype(object)
+    return df_sig_info.where(df_sig_info.notna(), None)
+
+
+def get_emulator(node: Node) -> DeviceEmulator:
+    # Opt in to chunked requests and streams (disabled by default, like on
+    # the device).
+    return DeviceEmulator(get_sig_info(), node, max_streams=2,
+                          chunk_buffer_size=CHUNK_BUFFER_SIZE)
+
+
+class Proxy(get_proxy_class(get_schema(get_sig_info()))):
+    MAX_REQUEST_SIZE = CHUNK_BUFFER_SIZE
+    timeout = 5
+
+    def __init__(self, serial):
+        self._serial = serial
+
+
+class PipeDevice:
+    """
+    Emulated device connected through a pair of pipes, which replies after
+    `delay` seconds, and then sends one byte of the reply every
+    `byte_interval` seconds (i.e., like a slow serial link).
+    """
+    def __init__(self, node: Node, delay: float = 0,
+                 byte_interval: float = 0):
+        self.delay = delay
+        self.byte_interval = byte_interval
+        self.port = EmulatedSerial(get_emulator(node))
+        self._request_read, self._request_write = os.pipe()
+        self._reply_read, self._reply_write = os.pipe()
+        self.transport = FileDescriptorTransport(self._reply_read,
+                                                 self._request_write)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            data = os.read(self._request_read, 4096)
+            if not data:
+                break
+            self.port.write(data)
+            reply = self.port.read(self.port.in_waiting)
+            time.sleep(self.delay)
+            if self.byte_interval:
+                for i in range(len(reply)):
+                    time.sleep(self.byte_interval)
+                    os.write(self._reply_write, reply[i:i + 1])
+            else:
+                os.write(self._reply_write, reply)
+        os.close(self._reply_write)
+        os.close(self._request_read)
+
+    def close(self):
+        os.close(self._request_write)
+        self._thread.join()
+        os.close(self._reply_read)
+
+
+@pytest.fixture
+def sig_info():
+    return get_sig_info()
+
+
+@pytest.fixture
+def node():
+    return Node()
+
+
+@pytest.fixture
+def emulator(node):
+    return get_emulator(node)
+
+
+@pytest.fixture
+def proxy_class():
+    return Proxy
+
+
+@pytest.fixture
+def proxy(emulator):
+    return Proxy(EmulatedSerial(emulator))
+
+
+@pytest.fixture
+def pipe_proxy(node):
+    """
+    Return function returning a proxy connected to a `PipeDevice` (keyword
+    arguments are passed to `PipeDevice`).
+    """
+    devices = []
+
+    def open_proxy(**kwargs):
+        devices.append(PipeDevice(node, **kwargs))
+        return Proxy(devices[-1].transport)
+    yield open_proxy
+    for device in devices:
+        device.close()
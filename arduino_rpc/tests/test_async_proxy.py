@@ -0,0 +1,95 @@
+# coding: utf-8
+import asyncio
+
+import numpy as np
+import pytest
+
+from arduino_rpc.emulator import EmulatedSerial
+from arduino_rpc.proxy import CommandTimeoutError
+from arduino_rpc.schema import get_proxy_class, get_schema
+
+
+@pytest.fixture
+def async_proxy_class(sig_info):
+    class AsyncProxy(get_proxy_class(get_schema(sig_info), async_=True)):
+        timeout = 5
+
+    return AsyncProxy
+
+
+def run(emulator, proxy_class, coroutine, delay: float = 0):
+    """
+    Run `coroutine(proxy)` with an `asyncio` proxy connected to `emulator`
+    through a local TCP connection, replying after `delay` seconds.
+    """
+    port = EmulatedSerial(emulator)
+
+    async def handle(reader, writer):
+        while True:
+            data = await reader.read(4096)
+            if not data:
+                break
+            port.write(data)
+            await asyncio.sleep(delay)
+            writer.write(port.read(port.in_waiting))
+        writer.close()
+
+    async def main():
+        server = await asyncio.start_server(handle, '127.0.0.1', 0)
+        try:
+            proxy = await proxy_class.open_connection(
+                '127.0.0.1', server.sockets[0].getsockname()[1])
+            async with proxy:
+                return await coroutine(proxy)
+        finally:
+            server.close()
+            await server.wait_closed()
+    return asyncio.run(main())
+
+
+def test_call(emulator, node, async_proxy_class):
+    async def call(proxy):
+        assert await proxy.add(3, 4) == 7
+        assert bytes(await proxy.str_echo(b'hello')) == b'hello'
+        await proxy.set_x(2.5)
+        assert (await proxy.samples(5) == np.arange(5)).all()
+        # Concurrent calls are pipelined.
+        return await asyncio.gather(*(proxy.add(i, 1) for i in range(20)))
+
+    assert run(emulator, async_proxy_class, call) == list(range(1, 21))
+    assert node.x == 2.5
+
+
+def test_many(emulator, async_proxy_class):
+    async def many(proxy):
+        return (await proxy.many(proxy.add, np.arange(500), 5),
+                await proxy.many(proxy.str_echo, [b'ab', b'cd']))
+
+    result, echoes = run(emulator, async_proxy_class, many)
+    assert (result == np.arange(500) + 5).all()
+    assert [bytes(msg) for msg in echoes] == [b'ab', b'cd']
+
+
+def test_timeout(emulator, async_proxy_class):
+    async def call(proxy):
+        proxy.timeout = 0.05
+        with pytest.raises(CommandTimeoutError):
+            await proxy.add(1, 2)
+        proxy.timeout = 5
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(proxy.add(1, 2), 0.05)
+        # Late replies to the timed out calls are discarded.
+        return await proxy.add(5, 5)
+
+    assert run(emulator, async_proxy_class, call, delay=0.2) == 10
+
+
+def test_command_failed(emulator, async_proxy_class):
+    del emulator.commands[0x13]
+
+    async def call(proxy):
+        with pytest.raises(IOError):
+            await proxy.add(1, 2)
+        return await proxy.ram_free()
+
+    assert run(emulator, async_proxy_class, call) == 1
@@ -0,0 +1,213 @@
+# coding: utf-8
+import pandas as pd
+import pytest
+
+from arduino_rpc import code_gen
+from arduino_rpc.code_gen import (LAST_COMMAND_CODE, allocate_command_codes,
+                                  get_class_sig_frame,
+                                  get_multilevel_method_sig_frame,
+                                  read_code_map, write_code_map)
+from arduino_rpc.rpc_data_frame import get_c_command_processor_header_code
+
+
+def test_allocate_dense():
+    assert (allocate_command_codes(['a', 'b', 'c'], first_code=0x20) ==
+            {'a': 0x20, 'b': 0x21, 'c': 0x22})
+
+
+def test_allocate_stable():
+    codes = allocate_command_codes(['b', 'new', 'a'], {'a': 0x20, 'b': 0x22},
+                                   first_code=0x20)
+    assert codes == {'a': 0x20, 'b': 0x22, 'new': 0x21}
+
+
+def test_allocate_collision():
+    with pytest.raises(ValueError, match='collisions'):
+        allocate_command_codes(['a', 'b'], {'a': 0x20, 'b': 0x20})
+    # Retired codes may not collide either.
+    with pytest.raises(ValueError, match='collisions'):
+        allocate_command_codes(['a'], {'a': 0x20, 'removed': 0x20})
+
+
+def test_allocate_out_of_range():
+    with pytest.raises(ValueError, match='out of range'):
+        allocate_command_codes(['a'], {'a': LAST_COMMAND_CODE + 1})
+    with pytest.raises(ValueError, match='Not enough'):
+        allocate_command_codes(['a', 'b'], first_code=LAST_COMMAND_CODE)
+
+
+def test_allocate_below_first_code():
+    # Codes of an existing map may be lower than the first code of the
+    # methods of this build.
+    assert (allocate_command_codes(['a', 'b'], {'a': 0x10}, first_code=0x20) ==
+            {'a': 0x10, 'b': 0x20})
+
+
+def test_retired_codes_reserved():
+    code_map = {'a': 0x20, 'removed': 0x21, 'b': 0x22}
+    codes = allocate_command_codes(['a', 'b', 'new'], code_map, first_code=0x20)
+    assert codes == {'a': 0x20, 'removed': 0x21, 'b': 0x22, 'new': 0x23}
+    # Removed method gets its code back if it is added again.
+    codes = allocate_command_codes(['a', 'b', 'new', 'removed'], codes,
+                                   first_code=0x20)
+    assert codes['removed'] == 0x21
+
+
+def test_prune():
+    code_map = {'a': 0x20, 'removed': 0x21, 'b': 0x22}
+    assert (allocate_command_codes(['a', 'b', 'new'], code_map, first_code=0x20,
+                                   prune=True) ==
+            {'a': 0x20, 'new': 0x21, 'b': 0x22})
+
+
+def test_code_map_round_trip(tmp_path):
+    filepath = tmp_path / 'codes.json'
+    assert read_code_map(str(filepath)) == {}
+    codes = {'b': 0x21, 'a': 0x20, 'removed': 0x1234}
+    write_code_map(codes, str(filepath))
+    assert read_code_map(str(filepath)) == codes
+
+
+class FakeClang:
+    """
+    Replace `libclang` parsing in `arduino_rpc.code_gen`: each header lists the
+    names of its classes (one per line), each method of a class returns
+    `int32_t` and headers include the paths in `includes`.
+    """
+    def __init__(self, methods):
+        self.methods = methods
+        self.includes = {}
+        self.parsed = []
+
+    def open_cpp_source(self, header, *args, **kwargs):
+        self.parsed.append(header)
+        with open(header) as input_:
+            classes = input_.read().split()
+        includes = [type('Include', (), {'include': type('File', (), {'name': include})})
+                    for include in self.includes.get(header, [])]
+        translation_unit = type('TranslationUnit', (), {'get_includes': lambda self: includes})()
+        return type('Root', (), {'classes': classes, 'translation_unit': translation_unit})
+
+    def extract_class_declarations(self, root):
+        return {class_: class_ for class_ in root.classes}
+
+    def get_clang_methods_frame(self, class_, std_types=False):
+        return class_
+
+    def get_struct_sig_info_frame(self, class_, pointer_width=16):
+        names = self.methods[class_]
+        return pd.DataFrame({'method_i': range(0x20, 0x20 + len(names)), 'method_name': names,
+                             'arg_count': 0, 'return_atom_type': 'int32_t'})
+
+
+@pytest.fixture
+def clang(monkeypatch):
+    clang = FakeClang({'A': ['add', 'div'], 'B': ['mul'], 'Node': ['sub', 'add']})
+    for name in ('open_cpp_source', 'extract_class_declarations', 'get_clang_methods_frame',
+                 'get_struct_sig_info_frame'):
+        monkeypatch.setattr(code_gen, name, getattr(clang, name))
+    return clang
+
+
+@pytest.fixture
+def headers(tmp_path):
+    for class_ in ('A', 'B', 'Node'):
+        (tmp_path / f'{class_}.h').write_text(class_)
+    (tmp_path / 'include.h').write_text('1')
+    return [str(tmp_path / f'{class_}.h') for class_ in ('A', 'B', 'Node')]
+
+
+def test_parse_cache(clang, headers, tmp_path):
+    cache_dir = str(tmp_path / 'cache')
+    clang.includes[headers[2]] = [str(tmp_path / 'include.h')]
+    frame = get_class_sig_frame(headers[2], 'Node', cache_dir=cache_dir)
+    assert frame.method_name.tolist() == ['sub', 'add']
+    assert len(clang.parsed) == 1
+    # Cache hit.
+    assert get_class_sig_frame(headers[2], 'Node', cache_dir=cache_dir).equals(frame)
+    assert len(clang.parsed) == 1
+    # Different arguments are a different entry.
+    get_class_sig_frame(headers[2], 'Node', '-DX', cache_dir=cache_dir)
+    assert len(clang.parsed) == 2
+    # Entry is invalidated when an included header changes.
+    (tmp_path / 'include.h').write_text('2')
+    get_class_sig_frame(headers[2], 'Node', cache_dir=cache_dir)
+    assert len(clang.parsed) == 3
+    get_class_sig_frame(headers[2], 'Node', cache_dir=cache_dir)
+    assert len(clang.parsed) == 3
+    # Disabled cache.
+    get_class_sig_frame(headers[2], 'Node', cache_dir=False)
+    assert len(clang.parsed) == 4
+
+
+def test_parse_error(clang, headers, tmp_path):
+    with pytest.raises(IOError, match='Node.h'):
+        get_class_sig_frame(headers[2], 'Missing', cache_dir=False)
+    with pytest.raises(IOError, match='missing.h'):
+        get_class_sig_frame(str(tmp_path / 'missing.h'), 'Node', cache_dir=False)
+
+
+def test_multilevel_parse_cache(clang, headers, tmp_path):
+    cache_dir = str(tmp_path / 'cache')
+    frame = get_multilevel_method_sig_frame(headers, ['A', 'B', 'Node'], cache_dir=cache_dir)
+    assert len(clang.parsed) == 3
+    assert get_multilevel_method_sig_frame(headers, ['A', 'B', 'Node'], cache_dir=cache_dir).equals(frame)
+    assert len(clang.parsed) == 3
+    # Entry is invalidated when the header changes.
+    (tmp_path / 'B.h').write_text('B\n')
+    get_multilevel_method_sig_frame(headers, ['A', 'B', 'Node'], cache_dir=cache_dir)
+    assert clang.parsed[3:] == [headers[1]]
+
+
+def test_jobs(clang, headers, tmp_path, monkeypatch):
+    from concurrent.futures import ThreadPoolExecutor
+
+    pools = []
+
+    class Executor(ThreadPoolExecutor):
+        # Parse in threads, since the fake parser is not available in worker
+        # processes.
+        def __init__(self, max_workers):
+            pools.append(max_workers)
+            super().__init__(max_workers)
+
+    monkeypatch.setattr(code_gen, 'ProcessPoolExecutor', Executor)
+    frame = get_multilevel_method_sig_frame(headers, ['A', 'B', 'Node'], cache_dir=False)
+    assert not pools
+    assert get_multilevel_method_sig_frame(headers, ['A', 'B', 'Node'], cache_dir=False,
+                                           jobs=8).equals(frame)
+    assert pools == [3]
+    # Frames are merged in order of headers, so the *last* `add` is kept.
+    assert frame.drop_duplicates('method_name').class_name.tolist() == ['A', 'B', 'Node', 'Node']
+    # Only headers which are not cached are parsed.
+    cache_dir = str(tmp_path / 'cache')
+    get_class_sig_frame(headers[0], 'A', cache_dir=cache_dir)
+    del clang.parsed[:]
+    assert get_multilevel_method_sig_frame(headers, ['A', 'B', 'Node'], cache_dir=cache_dir,
+                                           jobs=4).equals(frame)
+    assert sorted(clang.parsed) == headers[1:]
+    assert pools[1] == 2
+
+
+def get_dispatch_sig_info(codes):
+    return pd.DataFrame({'method_i': codes, 'method_name': [f'm{code}' for code in codes],
+                         'camel_name': [f'M{code}' for code in codes], 'arg_count': 0, 'ndims': 0,
+                         'return_atom_type': None, 'return_ndims': 0})
+
+
+def test_table_dispatch():
+    code = get_c_command_processor_header_code(get_dispatch_sig_info([0x20, 0x21, 0x23]), 'ns',
+                                               dispatch='table')
+    assert 'switch (command)' not in code
+    # One handler per code from the first to the last command code.
+    assert '&process_m32,  // 0x20' in code
+    assert 'NULL,  // 0x22' in code
+    assert '&process_m35,  // 0x23' in code
+    assert 'command - 0x20' in code
+    assert 'case CMD_M32:' in get_c_command_processor_header_code(
+        get_dispatch_sig_info([0x20, 0x21]), 'ns')
+    with pytest.raises(ValueError, match='dispatch'):
+        get_c_command_processor_header_code(get_dispatch_sig_info([0x20]), 'ns', dispatch='jump')
+    with pytest.warns(UserWarning, match='not contiguous'):
+        get_c_command_processor_header_code(get_dispatch_sig_info([0x20, 0x120]), 'ns',
+                                            dispatch='table')
@@ -0,0 +1,174 @@
+# coding: utf-8
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytest
+from nadamq.NadaMq import cPacket, PACKET_TYPES
+
+from arduino_rpc.stream import start_request, stop_request
+
+
+def test_call(proxy, node):
+    assert proxy.add(3, 4) == 7
+    assert bytes(proxy.str_echo(b'hello')) == b'hello'
+    proxy.set_x(2.5)
+    assert node.x == 2.5
+    assert (proxy.samples(5) == np.arange(5)).all()
+
+
+def test_pipeline(proxy):
+    with proxy.pipeline(window=4):
+        futures = [proxy.add(i, 1) for i in range(20)]
+    assert [future.result() for future in futures] == list(range(1, 21))
+
+
+def test_batch(proxy, node):
+    with proxy.batch() as batch:
+        futures = [batch.add(i, i) for i in range(30)]
+        batch.set_x(1.5)
+    assert [future.result() for future in futures] == [2 * i for i in range(30)]
+    assert node.x == 1.5
+
+
+def test_batch_in_pipeline(proxy):
+    with proxy.pipeline(window=2):
+        with proxy.batch() as batch:
+            futures = [batch.add(i, 2) for i in range(10)]
+        future = proxy.add(1, 1)
+    assert [f.result() for f in futures] == list(range(2, 12))
+    assert future.result() == 2
+
+
+def test_chunked_request(proxy):
+    msg = bytes(range(200))
+    # Request is larger than a packet, so it is sent in chunks.
+    assert len(msg) > proxy.PACKET_SIZE
+    assert bytes(proxy.str_echo(msg)) == msg
+    with proxy.pipeline(window=4):
+        futures = [proxy.str_echo(msg), proxy.add(1, 2)]
+    assert bytes(futures[0].result()) == msg
+    assert futures[1].result() == 3
+
+
+def test_chunked_request_too_large(proxy):
+    with pytest.raises(ValueError):
+        proxy.str_echo(bytes(proxy.MAX_REQUEST_SIZE + 1))
+    assert proxy.add(1, 1) == 2
+
+
+def test_chunked_response(proxy):
+    result = proxy.samples(3000, chunk_size=1000)
+    assert result.dtype == np.uint16
+    assert (result == np.arange(3000)).all()
+    blocks = list(proxy.iter_chunks(proxy.samples, 500, chunk_size=101))
+    assert len(blocks) > 1
+    assert (np.concatenate(blocks) == np.arange(500)).all()
+    out = np.zeros(200, dtype='uint16')
+    result = proxy.samples(100, chunk_size=64, out=out)
+    assert (out[:100] == np.arange(100)).all()
+    assert (result == np.arange(100)).all()
+
+
+def test_many(proxy, node):
+    values = np.arange(1000)
+    result = proxy.many(proxy.add, values, 5)
+    assert (result == values + 5).all()
+    proxy.many(proxy.set_x, [1.5, 2.5])
+    assert node.x == 2.5
+    assert [bytes(msg) for msg in proxy.many(proxy.str_echo, [b'ab', b'cd'])] == [b'ab', b'cd']
+    with pytest.raises(ValueError):
+        proxy.many(proxy.add, [1, 2], [1, 2, 3])
+
+
+def test_many_empty(proxy):
+    result = proxy.many(proxy.add, [], 5)
+    assert result.dtype == np.int32 and result.size == 0
+    assert proxy.many(proxy.set_x, []) is None
+    assert proxy.many(proxy.str_echo, []) == []
+
+
+def test_many_metrics(proxy):
+    metrics = proxy.enable_metrics()
+    proxy.many(proxy.add, np.arange(100), 1)
+    proxy.many(proxy.str_echo, [b'ab', b'cd'])
+    snapshot = metrics.snapshot()
+    assert snapshot['batch']['calls'] > 1
+    assert snapshot['batch']['errors'] == 0
+    assert snapshot['str_echo']['calls'] == 2
+
+
+def test_many_io_thread(proxy):
+    values = np.arange(200)
+    with proxy.threaded():
+        with ThreadPoolExecutor(4) as executor:
+            results = list(executor.map(lambda i: proxy.many(proxy.add, values, i), range(8)))
+            echoes = executor.submit(proxy.many, proxy.str_echo, [b'ab', b'cd']).result()
+    assert all((result == values + i).all() for i, result in enumerate(results))
+    assert [bytes(msg) for msg in echoes] == [b'ab', b'cd']
+
+
+def test_stream(proxy):
+    with proxy.stream(proxy.ram_free, interval_ms=0) as stream:
+        # Calls are processed while the stream is active.
+        assert proxy.add(1, 2) == 3
+        block = stream.read(100)
+        assert len(block) == 100
+        assert (np.diff(block) == 1).all()
+    assert not proxy._streams
+    with pytest.raises(ValueError):
+        with proxy.stream(proxy.set_x, 1.0):
+            pass
+
+
+def test_streams_disabled(proxy, emulator):
+    # Streams are disabled by default, like on the device.
+    emulator.max_streams = 0
+    with pytest.raises(IOError):
+        with proxy.stream(proxy.ram_free):
+            pass
+    for payload in (start_request(1, 0, b'\x10\x00'), stop_request(1)):
+        reply = emulator.process_packet(cPacket(iuid=1, data=payload,
+                                                type_=PACKET_TYPES.DATA))
+        assert reply.type_ == PACKET_TYPES.NACK
+
+
+def test_stream_restart_invalid(emulator):
+    emulator.process_stream_command(memoryview(start_request(1, 5, b'\x10\x00')))
+    # Invalid restart (request too long) leaves the stream running.
+    request = bytes(emulator.stream_buffer_size + 1)
+    assert emulator.process_stream_command(memoryview(start_request(1, 0, request))) is None
+    assert emulator.streams[1][2] == b'\x10\x00'
+
+
+def test_io_thread(proxy):
+    def add_all(i):
+        return [proxy.add(i, j) for j in range(50)]
+
+    with proxy.threaded(window=8), ThreadPoolExecutor(4) as executor:
+        results = list(executor.map(add_all, range(8)))
+    assert results == [[i + j for j in range(50)] for i in range(8)]
+    assert proxy.add(1, 1) == 2
+
+
+@pytest.mark.parametrize('metrics', [False, True])
+def test_out_command_failed(proxy, emulator, metrics):
+    if metrics:
+        proxy.enable_metrics()
+    # Device rejects unknown commands (i.e., replies with a `NACK` packet).
+    del emulator.commands[0x14]
+    out = np.zeros(10, dtype='uint16')
+    with pytest.raises(IOError):
+        proxy.samples(5)
+    with pytest.raises(IOError):
+        proxy.samples(5, out=out)
+
+
+def test_pipeline_command_failed(proxy, emulator):
+    del emulator.commands[0x14]
+    out = np.zeros(10, dtype='uint16')
+    with proxy.pipeline(window=2):
+        futures = [proxy.samples(5), proxy.samples(5, out=out), proxy.add(1, 2)]
+    for future in futures[:2]:
+        with pytest.raises(IOError):
+            future.result()
+    assert futures[2].result() == 3
@@ -0,0 +1,55 @@
+# coding: utf-8
+import random
+
+import pytest
+
+from arduino_rpc.metrics import (SUB_BUCKET_BITS, SUB_BUCKET_COUNT, LatencyHistogram, Metrics)
+
+
+def test_bucket_bounds():
+    # Small values are recorded exactly.
+    for value in range(SUB_BUCKET_COUNT):
+        assert LatencyHistogram.bucket_value(LatencyHistogram.bucket_index(value)) == value
+    # Larger values are within the relative error of the bucket.
+    error = 2 ** -(SUB_BUCKET_BITS - 1)
+    for value in [SUB_BUCKET_COUNT, 1000, 12345, 10 ** 9, 3600 * 10 ** 9, 2 ** 63 - 1]:
+        index = LatencyHistogram.bucket_index(value)
+        assert index < len(LatencyHistogram().counts)
+        highest = LatencyHistogram.bucket_value(index)
+        assert value <= highest <= value * (1 + error)
+        # Next bucket starts after the highest value of this bucket.
+        assert LatencyHistogram.bucket_index(highest + 1) == index + 1
+
+
+def test_percentiles():
+    histogram = LatencyHistogram()
+    assert histogram.percentile(0.5) == 0
+    generator = random.Random(0)
+    values = [generator.randint(1, 10 ** 8) for _ in range(10000)]
+    for value in values:
+        histogram.record(value)
+    values.sort()
+    for quantile in (0.5, 0.9, 0.99, 0.999):
+        expected = values[int(round(quantile * len(values))) - 1]
+        assert histogram.percentile(quantile) == pytest.approx(expected, rel=0.008)
+    assert histogram.percentile(1) == max(values)
+    snapshot = histogram.snapshot()
+    assert snapshot['count'] == len(values)
+    assert snapshot['min'] == values[0] and snapshot['max'] == values[-1]
+    assert snapshot['p999'] == histogram.percentile(0.999)
+
+
+def test_metrics(proxy):
+    metrics = proxy.enable_metrics()
+    assert proxy.add(1, 2) == 3
+    with proxy.pipeline(window=2):
+        proxy.add(3, 4)
+    snapshot = metrics.snapshot()['add']
+    assert snapshot['calls'] == 2 and snapshot['errors'] == 0
+    assert snapshot['request_bytes'] == 20 and snapshot['response_bytes'] == 8
+    assert snapshot['phases']['encode']['count'] == 2
+    assert snapshot['phases']['first_byte']['count'] == 1
+    assert 'arduino_rpc_calls_total{command="add"} 2' in metrics.prometheus()
+    metrics.reset()
+    assert metrics.snapshot() == {}
+    assert Metrics().name(0x13) == '0x0013'
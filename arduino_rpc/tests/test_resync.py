@@ -0,0 +1,68 @@
+# coding: utf-8
+import pytest
+
+from arduino_rpc.emulator import EmulatedSerial
+from arduino_rpc.proxy import FramingError
+
+
+class CorruptingSerial(EmulatedSerial):
+    """
+    Emulated port which corrupts the replies to the next requests, i.e.,
+    prepends `garbage` to the next reply, and flips the last byte (i.e., the
+    checksum) of the next `corrupt` replies.
+    """
+    garbage = b''
+    corrupt = 0
+
+    def write(self, data) -> int:
+        count = super().write(data)
+        if self._responses:
+            if self.corrupt:
+                self._responses[-1] ^= 0xFF
+                self.corrupt -= 1
+            self._responses[:0] = self.garbage
+            self.garbage = b''
+        return count
+
+
+@pytest.fixture
+def port(emulator):
+    return CorruptingSerial(emulator)
+
+
+def test_resync_after_garbage(port, proxy_class):
+    proxy = proxy_class(port)
+    port.garbage = b'\x00|\xff||\x13'
+    assert proxy.add(1, 2) == 3
+    assert proxy.discarded_bytes > 0
+    assert proxy.add(2, 2) == 4
+
+
+def test_resync_after_corrupted_reply(port, proxy_class):
+    proxy = proxy_class(port)
+    port.corrupt = 1
+    with pytest.raises(FramingError):
+        proxy.add(1, 2)
+    assert proxy.framing_errors == 1
+    assert proxy.add(2, 2) == 4
+
+
+def test_retry_corrupted_reply(port, proxy_class):
+    proxy = proxy_class(port)
+    proxy.idempotent_commands = frozenset({'add'})
+    port.corrupt = 1
+    assert proxy.add(1, 2) == 3
+    assert proxy.retried_calls == 1
+
+
+def test_resync_in_pipeline(port, proxy_class):
+    proxy = proxy_class(port)
+    with proxy.pipeline(window=4):
+        futures = [proxy.add(i, 1) for i in range(4)]
+        port.corrupt = 1
+        port.garbage = b'\x7c\x7c\x00'
+        futures += [proxy.add(i, 1) for i in range(4, 8)]
+    results = [future.exception() or future.result() for future in futures]
+    assert results[:4] == [1, 2, 3, 4]
+    assert sum(isinstance(result, FramingError) for result in results) == 1
+    assert proxy.add(5, 5) == 10
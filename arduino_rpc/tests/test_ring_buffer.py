@@ -0,0 +1,37 @@
+# coding: utf-8
+import numpy as np
+import pytest
+
+from arduino_rpc.ring_buffer import RingBuffer
+
+
+def test_wrap_around():
+    ring = RingBuffer(10, 'int32', max_block=4)
+    assert len(ring) == 0 and ring.latest().size == 0
+    ring.extend(np.arange(7))
+    assert (ring.latest() == np.arange(7)).all()
+    # Block written past the end of the ring is moved to the start.
+    ring.extend(np.arange(7, 23))
+    assert len(ring) == 10 and ring.count == 23
+    assert (ring.latest() == np.arange(13, 23)).all()
+    assert (ring.latest(3) == np.arange(20, 23)).all()
+    assert ring.latest().dtype == np.int32
+
+
+def test_block_size():
+    with pytest.raises(ValueError):
+        RingBuffer(4, 'uint8', max_block=8)
+    ring = RingBuffer(16, 'uint8', max_block=4)
+    with pytest.raises(ValueError):
+        ring.reserve(5)
+    with pytest.raises(ValueError):
+        ring.commit(5)
+
+
+def test_call(proxy):
+    ring = RingBuffer(100, 'uint16', max_block=64)
+    for _ in range(5):
+        result = ring.call(proxy.samples, 30)
+        assert (result == np.arange(30)).all()
+    assert ring.count == 150
+    assert (ring.latest() == np.tile(np.arange(30), 5)[-100:]).all()
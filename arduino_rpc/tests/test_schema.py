@@ -0,0 +1,42 @@
+# coding: utf-8
+import json
+
+import pytest
+
+from arduino_rpc.schema import (SCHEMA_VERSION, get_methods, get_proxy_class, get_schema,
+                                read_schema, write_schema)
+
+
+@pytest.mark.parametrize('extension', ['.json', '.msgpack'])
+def test_round_trip(sig_info, proxy_class, tmp_path, extension):
+    if extension == '.msgpack':
+        pytest.importorskip('msgpack')
+    schema = get_schema(sig_info)
+    filepath = str(tmp_path / f'node.schema{extension}')
+    write_schema(schema, filepath)
+    assert read_schema(filepath) == schema
+    # Classes are cached by schema hash (`proxy_class` derives from the class of this schema).
+    assert get_proxy_class(filepath) is proxy_class.__bases__[0]
+    assert get_proxy_class(filepath, async_=True) is not get_proxy_class(filepath)
+
+
+def test_version(sig_info, tmp_path):
+    schema = dict(get_schema(sig_info), version=SCHEMA_VERSION + 1)
+    filepath = tmp_path / 'node.schema.json'
+    filepath.write_text(json.dumps(schema))
+    with pytest.raises(ValueError, match='version'):
+        read_schema(str(filepath))
+
+
+def test_methods(sig_info):
+    schema = get_schema(sig_info)
+    methods = {method['name']: method for method in get_methods(schema)}
+    assert list(methods) == ['ram_free', 'set_x', 'str_echo', 'add', 'samples']
+    assert methods['add']['format'] == '<Hii' and methods['add']['code'] == 0x13
+    # Array argument is a length and a 16-bit pointer.
+    assert methods['str_echo']['format'] == '<HIH'
+    assert methods['samples']['return_ndims'] == 1
+    # Arguments shadowing builtins are renamed.
+    sig_info.loc[sig_info.method_name == 'set_x', 'arg_name'] = 'out'
+    methods = {method['name']: method for method in get_methods(get_schema(sig_info))}
+    assert methods['set_x']['args'][0]['name'] == 'out_'
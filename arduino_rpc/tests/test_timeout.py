@@ -0,0 +1,60 @@
+# coding: utf-8
+import time
+
+import pytest
+
+from arduino_rpc.proxy import CommandTimeoutError
+
+
+def test_slow_reply_timeout(pipe_proxy):
+    proxy = pipe_proxy(delay=0.5)
+    proxy.timeout = 0.05
+    start = time.monotonic()
+    with pytest.raises(CommandTimeoutError):
+        proxy.add(1, 2)
+    assert time.monotonic() - start < 0.4
+
+
+def test_slow_reply_timeout_io_thread(pipe_proxy):
+    proxy = pipe_proxy(delay=0.5)
+    proxy.timeout = 0.05
+    with proxy.threaded():
+        start = time.monotonic()
+        with pytest.raises(CommandTimeoutError):
+            proxy.add(1, 2)
+        assert time.monotonic() - start < 0.4
+
+
+@pytest.mark.parametrize('threaded', [False, True])
+def test_slow_link(pipe_proxy, threaded):
+    # Replies take longer to arrive than the poll interval of the I/O thread,
+    # so partial packets must be kept between waits.
+    proxy = pipe_proxy(byte_interval=5e-4)
+    if threaded:
+        with proxy.threaded():
+            assert proxy.add(3, 4) == 7
+    else:
+        assert proxy.add(3, 4) == 7
+    assert proxy.framing_errors == 0
+    assert proxy.discarded_bytes == 0
+
+
+def test_late_reply_discarded(pipe_proxy):
+    proxy = pipe_proxy(delay=0.1)
+    proxy.timeout = 0.01
+    with pytest.raises(CommandTimeoutError):
+        proxy.add(1, 1)
+    proxy.timeout = 5
+    # Reply to the timed out call arrives before the reply to this call.
+    assert proxy.add(5, 5) == 10
+
+
+def test_deadline(pipe_proxy):
+    proxy = pipe_proxy(delay=0.2)
+    start = time.monotonic()
+    with proxy.deadline(0.05):
+        with proxy.pipeline(window=4):
+            futures = [proxy.add(i, 1) for i in range(4)]
+    assert all(isinstance(future.exception(), CommandTimeoutError)
+               for future in futures)
+    assert time.monotonic() - start < 0.5
@@ -0,0 +1,71 @@
+# coding: utf-8
+import io
+import os
+import socket
+
+import pytest
+
+from arduino_rpc.emulator import EmulatedSerial
+from arduino_rpc.transport import (FileDescriptorTransport, SerialTransport,
+                                   SocketTransport, Transport, as_transport)
+
+
+@pytest.fixture
+def pipe():
+    read_fd, write_fd = os.pipe()
+    transport = FileDescriptorTransport(read_fd, write_fd, closefd=True)
+    yield transport
+    transport.close()
+
+
+def test_abstract():
+    class ReadOnly(Transport):
+        def readinto(self, buffer, timeout=None):
+            return 0
+
+    with pytest.raises(TypeError):
+        ReadOnly()
+    with pytest.raises(TypeError):
+        Transport()
+
+
+def test_file_descriptor(pipe):
+    buffer = bytearray(16)
+    assert pipe.readinto(memoryview(buffer), timeout=0.01) == 0
+    pipe.writev([b'ab', memoryview(b'cd'), b''])
+    pipe.write(b'ef')
+    assert pipe.readinto(memoryview(buffer), timeout=1) == 6
+    assert buffer[:6] == b'abcdef'
+
+
+def test_file_descriptor_eof():
+    read_fd, write_fd = os.pipe()
+    os.close(write_fd)
+    with FileDescriptorTransport(read_fd, closefd=True) as transport:
+        with pytest.raises(ConnectionError):
+            transport.readinto(memoryview(bytearray(4)), timeout=1)
+
+
+def test_socket():
+    left, right = socket.socketpair()
+    with SocketTransport(left) as transport:
+        buffer = bytearray(16)
+        assert transport.readinto(memoryview(buffer), timeout=0.01) == 0
+        transport.writev([b'ab', memoryview(b'cd')])
+        assert right.recv(16) == b'abcd'
+        right.sendall(b'xyz')
+        assert transport.readinto(memoryview(buffer), timeout=1) == 3
+        assert buffer[:3] == b'xyz'
+        right.close()
+        with pytest.raises(ConnectionError):
+            transport.readinto(memoryview(buffer), timeout=1)
+
+
+def test_serial(emulator, proxy_class):
+    # Emulated port has no file descriptor, so the port is read directly.
+    transport = as_transport(EmulatedSerial(emulator))
+    assert isinstance(transport, SerialTransport)
+    with pytest.raises(io.UnsupportedOperation):
+        transport.fileno()
+    assert transport.readinto(memoryview(bytearray(16)), timeout=0.01) == 0
+    assert proxy_class(transport).add(1, 2) == 3
@@ -0,0 +1,278 @@
+# coding: utf-8
+"""
+Byte transports connecting a `ProxyBase` to a device.
+
+Each transport implements the same small interface:
+
+ - `write(data)`: Write all of `data`.
+ - `writev(buffers)`: Write all buffers in order (scatter/gather), in a single
+   system call where possible.
+ - `readinto(buffer, timeout)`: Wait up to `timeout` seconds (`None` waits
+   indefinitely) for data and read available bytes into `buffer`.  Returns
+   the number of bytes read, which is zero if the timeout expired.
+ - `close()`.
+
+Transports wait for data in the kernel (i.e., `select`/socket timeouts)
+instead of polling `inWaiting()`, and read directly into the receive buffer
+of the proxy.
+
+Example:
+
+    proxy = Proxy(SocketTransport.connect_tcp('ser2net.local', 4000))
+"""
+import abc
+import io
+import os
+import select
+import socket
+from typing import Iterable, Optional, Sequence, Union
+
+# Maximum number of buffers passed to a single `writev`/`sendmsg` call.
+try:
+    IOV_MAX = os.sysconf('SC_IOV_MAX')
+except (AttributeError, OSError, ValueError):
+    IOV_MAX = 1024
+
+
+def _advance(buffers: Sequence[memoryview],
+             count: int) -> Sequence[memoryview]:
+    """
+    Return buffers remaining after `count` bytes of `buffers` were written.
+    """
+    for i, buffer in enumerate(buffers):
+        if count < len(buffer):
+            return [buffer[count:]] + list(buffers[i + 1:])
+        count -= len(buffer)
+    return []
+
+
+class Transport(abc.ABC):
+    """
+    Base class of transports (see module documentation).
+
+    Subclasses must implement `readinto` and `writev`.
+    """
+    def fileno(self) -> int:
+        raise io.UnsupportedOperation('Transport has no file descriptor.')
+
+    @abc.abstractmethod
+    def readinto(self, buffer: memoryview,
+                 timeout: Optional[float] = None) -> int:
+        pass
+
+    @abc.abstractmethod
+    def writev(self, buffers: Iterable[Union[bytes, memoryview]]) -> None:
+        pass
+
+    def write(self, data: Union[bytes, memoryview]) -> None:
+        self.writev([data])
+
+    def close(self) -> None:
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class FileDescriptorTransport(Transport):
+    """
+    Transport over OS file descriptors, e.g., a pipe, FIFO or pseudo-terminal.
+
+    Reads wait in `select` and use `os.readv`; writes use `os.writev`,
+    retrying on partial writes (e.g., if the descriptor is non-blocking).
+
+    Arguments
+    ---------
+
+     - `read_fd`: Descriptor to read from.
+     - `write_fd`: Descriptor to write to (default: `read_fd`).
+     - `closefd`: If `True`, close descriptor(s) in `close()`.
+    """
+    def __init__(self, read_fd: int, write_fd: Optional[int] = None,
+                 closefd: bool = False):
+        self.read_fd = read_fd
+        self.write_fd = read_fd if write_fd is None else write_fd
+        self.closefd = closefd
+
+    @classmethod
+    def open(cls, path: str):
+        """
+        Open device file (e.g., pseudo-terminal or FIFO) for reading and
+        writing.
+        """
+        fd = os.open(path, os.O_RDWR | getattr(os, 'O_NOCTTY', 0))
+        return cls(fd, closefd=True)
+
+    def fileno(self) -> int:
+        return self.read_fd
+
+    def readinto(self, buffer: memoryview,
+                 timeout: Optional[float] = None) -> int:
+        readable, _, _ = select.select([self.read_fd], [], [], timeout)
+        if not readable:
+            return 0
+        try:
+            count = os.readv(self.read_fd, [buffer])
+        except BlockingIOError:
+            return 0
+        if not count:
+            # Descriptor is readable, but at end of file (e.g., other end of
+            # pipe or pseudo-terminal closed).
+            raise ConnectionError('Connection to device closed.')
+        return count
+
+    def writev(self, buffers: Iterable[Union[bytes, memoryview]]) -> None:
+        buffers = [memoryview(buffer) for buffer in buffers]
+        while buffers:
+            try:
+                count = os.writev(self.write_fd, buffers[:IOV_MAX])
+            except BlockingIOError:
+                select.select([], [self.write_fd], [])
+                continue
+            buffers = _advance(buffers, count)
+
+    def close(self) -> None:
+        if self.closefd:
+            for fd in {self.read_fd, self.write_fd}:
+                os.close(fd)
+            self.closefd = False
+
+
+class SerialTransport(FileDescriptorTransport):
+    """
+    Transport over a `serial.Serial` port (or any file-like object with
+    `readinto`, `write` and `in_waiting`, e.g., `EmulatedSerial`).
+
+    If the port exposes a file descriptor (pyserial on POSIX), the descriptor
+    is used directly (see `FileDescriptorTransport`), bypassing the polling
+    loops of pyserial.  Otherwise, the port is read with a blocking read of
+    the first byte, with the read timeout of the port set to the `timeout` of
+    `readinto`, followed by a read of the bytes already buffered.
+    """
+    def __init__(self, port):
+        self.port = port
+        self._timeout = getattr(port, 'timeout', None)
+        try:
+            fd = port.fileno()
+        except (AttributeError, io.UnsupportedOperation, ValueError):
+            fd = None
+        super().__init__(fd)
+
+    def fileno(self) -> int:
+        if self.read_fd is None:
+            return super(FileDescriptorTransport, self).fileno()
+        return self.read_fd
+
+    def readinto(self, buffer: memoryview,
+                 timeout: Optional[float] = None) -> int:
+        if self.read_fd is not None:
+            return super().readinto(buffer, timeout)
+        if timeout != self._timeout:
+            # Setting the timeout may reconfigure the port, so only set it
+            # when it changes (like `SocketTransport`).
+            self.port.timeout = timeout
+            self._timeout = timeout
+        count = self.port.readinto(buffer[:1])
+        if count:
+            pending = min(self.port.in_waiting, len(buffer) - 1)
+            if pending:
+                count += self.port.readinto(buffer[1:1 + pending])
+        return count
+
+    def writev(self, buffers: Iterable[Union[bytes, memoryview]]) -> None:
+        if self.write_fd is not None:
+            super().writev(buffers)
+        else:
+            self.port.write(b''.join(buffers))
+
+    def write(self, data: Union[bytes, memoryview]) -> None:
+        if self.write_fd is not None:
+            super().writev([data])
+        else:
+            self.port.write(data)
+
+    def close(self) -> None:
+        self.port.close()
+
+
+class SocketTransport(Transport):
+    """
+    Transport over a connected stream socket, e.g., TCP (ser2net-style
+    serial-to-network bridge) or Unix domain socket (local emulator).
+
+    Reads use `socket.recv_into` and writes use `socket.sendmsg`
+    (scatter/gather) where available.
+    """
+    def __init__(self, sock: socket.socket):
+        self.socket = sock
+        self._timeout = sock.gettimeout()
+
+    @classmethod
+    def connect_tcp(cls, host: str, port: int,
+                    timeout: Optional[float] = None):
+        """
+        Connect to TCP server, with Nagle's algorithm disabled such that
+        small request packets are sent immediately.
+        """
+        sock = socket.create_connection((host, port), timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return cls(sock)
+
+    @classmethod
+    def connect_unix(cls, path: str):
+        """
+        Connect to Unix domain socket at `path`.
+        """
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(path)
+        return cls(sock)
+
+    def fileno(self) -> int:
+        return self.socket.fileno()
+
+    def readinto(self, buffer: memoryview,
+                 timeout: Optional[float] = None) -> int:
+        if timeout != self._timeout:
+            self.socket.settimeout(timeout)
+            self._timeout = timeout
+        try:
+            count = self.socket.recv_into(buffer)
+        except (socket.timeout, BlockingIOError):
+            return 0
+        if not count:
+            raise ConnectionError('Connection to device closed.')
+        return count
+
+    def writev(self, buffers: Iterable[Union[bytes, memoryview]]) -> None:
+        if not hasattr(self.socket, 'sendmsg'):
+            self.socket.sendall(b''.join(buffers))
+            return
+        buffers = [memoryview(buffer) for buffer in buffers]
+        while buffers:
+            count = self.socket.sendmsg(buffers[:IOV_MAX])
+            buffers = _advance(buffers, count)
+
+    def write(self, data: Union[bytes, memoryview]) -> None:
+        self.socket.sendall(data)
+
+    def close(self) -> None:
+        self.socket.close()
+
+
+def as_transport(port) -> Transport:
+    """
+    Return transport for `port`.
+
+    `port` may be a `Transport` (returned as is), a connected `socket.socket`,
+    a file descriptor, or a `serial.Serial`-like file object.
+    """
+    if isinstance(port, Transport):
+        return port
+    elif isinstance(port, socket.socket):
+        return SocketTransport(port)
+    elif isinstance(port, int):
+        return FileDescriptorTransport(port)
+    return SerialTransport(port)